@@ -6,7 +6,10 @@
 
 Importing this module makes "bdist_esky" available as a distutils command.
 This command will freeze the given scripts and package them into a zipfile
-named with the application name, version and platform.
+named with the application name, version and platform.  The companion
+commands "bdist_esky_patch" and "bdist_esky_manifest" produce differential
+updates and a JSON manifest of the available downloads respectively, and
+"bdist_esky_chunks" adds the app to a content-addressed chunk store.
 
 The main interface is the 'Esky' class, which represents a frozen app.  An Esky
 must be given the path to the top-level directory of the frozen app, and a
@@ -30,9 +33,10 @@ from distutils.core import Command
 from distutils.util import convert_path
 
 import esky.patch
-from esky.util import get_platform, create_zipfile, \
+import esky.finder
+from esky.util import get_platform, create_zipfile, deep_extract_zipfile, \
                       split_app_version, join_app_version, ESKY_CONTROL_DIR, \
-                      ESKY_APPDATA_DIR, really_rmtree
+                      ESKY_APPDATA_DIR, really_rmtree, really_rename
 
 if sys.platform == "win32":
     from esky import winres
@@ -784,11 +788,20 @@ class bdist_esky_patch(Command):
                      "directory to put final built distributions in"),
                     ('from-version=', None,
                      "version against which to produce patch"),
+                    ('copy-from-root', None,
+                     "copy files moved between directories (needs esky "
+                     "patch version 2)"),
+                    ('base-digest', None,
+                     "let clients check the patch applies before fetching it"),
                    ]
 
+    boolean_options = ["copy-from-root","base-digest"]
+
     def initialize_options(self):
         self.dist_dir = None
         self.from_version = None
+        self.copy_from_root = False
+        self.base_digest = False
 
     def finalize_options(self):
         self.set_undefined_options('bdist',('dist_dir', 'dist_dir'))
@@ -822,18 +835,198 @@ class bdist_esky_patch(Command):
             print "patching", target_esky, "against", source_esky, "=>", patchfile
             if not self.dry_run:
                 try:
-                    esky.patch.main(["-Z","diff",source_esky,target_esky,patchfile])
+                    args = ["-Z","diff",source_esky,target_esky,patchfile]
+                    if self.copy_from_root:
+                        args.insert(0,"--copy-from-root")
+                    if self.base_digest:
+                        args.insert(0,"--base-digest")
+                    esky.patch.main(args)
                 except:
                     import traceback
                     traceback.print_exc()
                     raise
 
 
+class bdist_esky_manifest(Command):
+    """Create a JSON manifest of the eskys and patches in the dist dir.
+
+    This distutils command lists every zipfile and patch for the current
+    application found in the dist dir, along with its size and md5 digest,
+    in the format expected by esky.finder.ManifestVersionFinder.  Run it
+    after "bdist_esky" and "bdist_esky_patch", and publish the manifest
+    alongside the files it describes.
+    """
+
+    user_options = [
+                    ('dist-dir=', 'd',
+                     "directory containing the built distributions"),
+                    ('manifest-name=', None,
+                     "name of the manifest file [default: %s]"
+                     % (esky.finder.ESKY_MANIFEST,)),
+                   ]
+
+    def initialize_options(self):
+        self.dist_dir = None
+        self.manifest_name = None
+
+    def finalize_options(self):
+        self.set_undefined_options('bdist',('dist_dir', 'dist_dir'))
+        if self.manifest_name is None:
+            self.manifest_name = esky.finder.ESKY_MANIFEST
+
+    def run(self):
+        appname = split_app_version(self.distribution.get_fullname())[0]
+        files = []
+        for nm in sorted(os.listdir(self.dist_dir)):
+            if not nm.startswith(appname+"-"):
+                continue
+            if nm.endswith(".zip"):
+                (vdir,from_version) = (nm[:-4],None)
+            elif nm.endswith(".patch") and ".from-" in nm:
+                (vdir,from_version) = nm[:-6].rsplit(".from-",1)
+            else:
+                continue
+            (name,version,platform) = split_app_version(vdir)
+            if name != appname:
+                continue
+            md5 = hashlib.md5()
+            with open(os.path.join(self.dist_dir,nm),"rb") as f:
+                data = f.read(1024*64)
+                while data:
+                    md5.update(data)
+                    data = f.read(1024*64)
+            files.append({"name": nm,
+                          "appname": name,
+                          "version": version,
+                          "platform": platform,
+                          "from_version": from_version,
+                          "size": os.path.getsize(os.path.join(self.dist_dir,nm)),
+                          "md5": md5.hexdigest()})
+        manifest = os.path.join(self.dist_dir,self.manifest_name)
+        print "writing manifest of", len(files), "files =>", manifest
+        if not self.dry_run:
+            with open(manifest + ".new","w") as f:
+                json.dump({"format": 1, "files": files},f,indent=1,
+                          sort_keys=True)
+            really_rename(manifest + ".new",manifest)
+
+
+class bdist_esky_chunks(Command):
+    """Add the current version of the application to a chunk store.
+
+    This distutils command splits the contents of the current version's
+    esky into fixed-size chunks, and writes a chunk index and a pack file
+    of any chunks not already in the store, in the format expected by
+    esky.finder.ChunkVersionFinder.  Chunks are shared with the indexes of
+    other versions already in the dist dir, so each release only adds the
+    content that is new in it.  Publish the index and pack files alongside
+    the application's other downloads.
+    """
+
+    user_options = [
+                    ('dist-dir=', 'd',
+                     "directory containing the built distributions"),
+                    ('chunk-size=', None,
+                     "size of each chunk in bytes [default: %d]"
+                     % (esky.finder.DEFAULT_CHUNK_SIZE,)),
+                   ]
+
+    def initialize_options(self):
+        self.dist_dir = None
+        self.chunk_size = None
+
+    def finalize_options(self):
+        self.set_undefined_options('bdist',('dist_dir', 'dist_dir'))
+        if self.chunk_size is None:
+            self.chunk_size = esky.finder.DEFAULT_CHUNK_SIZE
+        self.chunk_size = int(self.chunk_size)
+
+    def run(self):
+        fullname = self.distribution.get_fullname()
+        platform = get_platform()
+        vdir = "%s.%s" % (fullname,platform,)
+        appname = split_app_version(vdir)[0]
+        target_esky = os.path.join(self.dist_dir,vdir+".zip")
+        if not os.path.exists(target_esky):
+            self.run_command("bdist_esky")
+        index_suffix = esky.finder.ESKY_CHUNK_INDEX_SUFFIX
+        indexfile = os.path.join(self.dist_dir,vdir+index_suffix)
+        packname = vdir + esky.finder.ESKY_CHUNK_PACK_SUFFIX
+        packfile = os.path.join(self.dist_dir,packname)
+        #  Find the chunks already in the store for other versions.
+        known = {}
+        for nm in sorted(os.listdir(self.dist_dir)):
+            if not nm.endswith(index_suffix) or nm == vdir+index_suffix:
+                continue
+            (name,_,nm_platform) = split_app_version(nm[:-len(index_suffix)])
+            if name != appname or nm_platform != platform:
+                continue
+            with open(os.path.join(self.dist_dir,nm),"r") as f:
+                index = json.load(f)
+            if index.get("chunk_size") == self.chunk_size:
+                known.update(index["chunks"])
+        print "adding", target_esky, "to chunk store =>", indexfile
+        if self.dry_run:
+            return
+        tdir = tempfile.mkdtemp()
+        try:
+            deep_extract_zipfile(target_esky,tdir)
+            files = []
+            dirs = []
+            chunks = {}
+            with open(packfile + ".new","wb") as pack:
+                for (dirpath,dirnames,filenames) in os.walk(tdir):
+                    dirnames.sort()
+                    relpath = os.path.relpath(dirpath,tdir)
+                    relpath = relpath.replace(os.sep,"/")
+                    if not dirnames and not filenames and relpath != ".":
+                        dirs.append(relpath)
+                    for nm in sorted(filenames):
+                        path = os.path.join(dirpath,nm)
+                        md5 = hashlib.md5()
+                        entry = {"path": nm if relpath == "." else
+                                         relpath + "/" + nm,
+                                 "mode": os.stat(path).st_mode & 0777,
+                                 "size": os.path.getsize(path),
+                                 "chunks": []}
+                        for (_,data) in esky.finder.iter_file_chunks(
+                                                    path,self.chunk_size):
+                            md5.update(data)
+                            digest = hashlib.md5(data).hexdigest()
+                            if digest not in known:
+                                known[digest] = [packname,pack.tell(),
+                                                 len(data)]
+                                pack.write(data)
+                            chunks[digest] = known[digest]
+                            entry["chunks"].append(digest)
+                        entry["md5"] = md5.hexdigest()
+                        files.append(entry)
+                new_chunks = pack.tell()
+            if new_chunks:
+                really_rename(packfile + ".new",packfile)
+            else:
+                os.unlink(packfile + ".new")
+            with open(indexfile + ".new","w") as f:
+                json.dump({"format": 1,
+                           "vdir": vdir,
+                           "chunk_size": self.chunk_size,
+                           "files": files,
+                           "dirs": dirs,
+                           "chunks": chunks},f,sort_keys=True)
+            really_rename(indexfile + ".new",indexfile)
+        finally:
+            really_rmtree(tdir)
+
+
 #  Monkey-patch distutils to include our commands by default.
 distutils.command.__all__.append("bdist_esky")
 distutils.command.__all__.append("bdist_esky_patch")
+distutils.command.__all__.append("bdist_esky_manifest")
+distutils.command.__all__.append("bdist_esky_chunks")
 sys.modules["distutils.command.bdist_esky"] = sys.modules["esky.bdist_esky"]
 sys.modules["distutils.command.bdist_esky_patch"] = sys.modules["esky.bdist_esky"]
+sys.modules["distutils.command.bdist_esky_manifest"] = sys.modules["esky.bdist_esky"]
+sys.modules["distutils.command.bdist_esky_chunks"] = sys.modules["esky.bdist_esky"]
 
 
 
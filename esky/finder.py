@@ -18,17 +18,45 @@ import re
 import urllib
 import urllib2
 import zipfile
-import shutil
 import tempfile
 import errno
+import time
+import json
+import hashlib
+import binascii
+import sys
+import heapq
+import httplib
+import socket
+import threading
+import inspect
+import Queue
+import multiprocessing.pool
+from collections import deque
+from contextlib import contextmanager
 from urlparse import urlparse, urljoin
 
 from esky.bootstrap import join_app_version
 from esky.errors import *
 from esky.util import deep_extract_zipfile, copy_ownership_info, \
                       ESKY_CONTROL_DIR, ESKY_APPDATA_DIR, \
-                      really_rmtree, really_rename
-from esky.patch import apply_patch, PatchError
+                      really_rmtree, really_rename, clone_file, clone_tree
+from esky.patch import apply_patch, read_base_digest, calculate_patch_digest,\
+                       calculate_file_digests, PatchError, \
+                       PATCH_BASE_DIGEST_SIZE, ESKY_FILELIST
+
+
+#  Default name of the JSON manifest file produced by "bdist_esky_manifest"
+#  and consumed by ManifestVersionFinder.
+ESKY_MANIFEST = "esky-manifest.json"
+
+#  Suffixes of the chunk index and chunk pack files produced by
+#  "bdist_esky_chunks" and consumed by ChunkVersionFinder.
+ESKY_CHUNK_INDEX_SUFFIX = ".chunks.json"
+ESKY_CHUNK_PACK_SUFFIX = ".chunks"
+
+#  Default size of the chunks in a chunk store.
+DEFAULT_CHUNK_SIZE = 64 * 1024
 
 
 class VersionFinder(object):
@@ -110,32 +138,117 @@ class DefaultVersionFinder(VersionFinder):
     Zipfiles suitable for use with this class can be produced using the
     "bdist_esky" distutils command.  It also supports simple differential
     updates as produced by the "bdist_esky_patch" command.
+
+    The cost of each available download is calculated by the callable
+    "link_cost" (by default a LinkCost instance) from the size of the file,
+    as given in the download listing.  If "probe_sizes" is true, the sizes
+    of any files not given in the listing are found by issuing HEAD requests
+    in parallel.
+
+    The parsed download listing is cached in the app's update directory,
+    and revalidated using a conditional GET.  If "check_interval" is given,
+    the listing is not re-checked at all until that many seconds after the
+    last check by any running instance of the app.
+
+    When an update needs several files (e.g. a chain of patches) they are
+    downloaded concurrently, over at most "max_connections" connections.
+    HTTP connections are kept alive and reused for subsequent requests.
+
+    If "pipelined" is true, updates that consist only of patches are applied
+    as they are downloaded rather than after the download has finished.
+    Each patch is still saved to disk as it arrives, so if it fails to apply
+    in this way the update falls back to the usual process.
+
+    To apply a patch, the current version is first staged in the update
+    directory.  Its files are reflinked where the filesystem supports it,
+    or otherwise hardlinked if "link_files" is true, so that only the files
+    touched by the patch cost any real I/O.
+
+    If "check_base_version" is true then before a patch is downloaded, the
+    digest of the version it applies to is read from the start of the patch
+    (using a "Range" request) and checked against the current version.  If
+    they don't match, e.g. because files in the current version have been
+    modified, no patches from the current version are used and a full
+    download is fetched instead.  This needs patches generated with the
+    "base_digest" option; other patches are used without checking.
+
+    If "download_cache" is given, it must be a DownloadCache object.  Files
+    whose md5 digest is given in the index are looked for in the cache
+    before being downloaded, and added to it once they have been downloaded
+    and verified.  Other files never use the cache.
+
+    If "rate_limiter" is given, it must be a RateLimiter object that will
+    be used to limit the bandwidth used by downloads.
     """
 
-    def __init__(self,download_url):
+    def __init__(self,download_url,link_cost=None,probe_sizes=False,
+                 check_interval=0,max_connections=4,pipelined=False,
+                 link_files=True,download_cache=None,rate_limiter=None,
+                 check_base_version=False):
         self.download_url = download_url
+        if link_cost is None:
+            link_cost = LinkCost()
+        self.link_cost = link_cost
+        self.probe_sizes = probe_sizes
+        self.check_interval = check_interval
+        self.max_connections = max_connections
+        self.pipelined = pipelined
+        self.link_files = link_files
+        self.download_cache = download_cache
+        self.rate_limiter = rate_limiter
+        self.check_base_version = check_base_version
+        self._connections = _ConnectionPool()
+        self._workdir_lock = threading.Lock()
+        self._created_workdirs = set()
+        self._index_key = download_url
+        self._link_digests = {}
+        self._link_sizes = {}
+        self._digest_checkpoints = {}
         super(DefaultVersionFinder,self).__init__()
         self.version_graph = VersionGraph()
 
+    def __getstate__(self):
+        #  Connections, locks and the state of in-progress downloads can't
+        #  be pickled, e.g. when the esky is passed to its cleanup process.
+        state = self.__dict__.copy()
+        for nm in ("_connections","_workdir_lock","_created_workdirs",
+                   "_digest_checkpoints"):
+            state.pop(nm,None)
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._connections = _ConnectionPool()
+        self._workdir_lock = threading.Lock()
+        self._created_workdirs = set()
+        self._digest_checkpoints = {}
+
     def _workdir(self,app,nm,create=True):
         """Get full path of named working directory, inside the given app."""
         updir = app._get_update_dir()
         workdir = os.path.join(updir,nm)
         if create:
-            # the failure of this may raise an error which notifies us to try root access
-            if os.path.exists(workdir) and len(os.listdir(workdir)) == 0:
-                try:
-                    os.rmdir(workdir)
-                except OSError:
-                    raise
-            for target in (updir,workdir):
-                try:
-                    os.mkdir(target)
-                except OSError, e:
-                    if e.errno not in (errno.EEXIST,183):
+            #  Concurrent downloads share the workdir, so it mustn't be
+            #  removed and recreated once this finder has started using it.
+            with self._workdir_lock:
+                if workdir in self._created_workdirs and \
+                   os.path.isdir(workdir):
+                    return workdir
+                # the failure of this may raise an error which notifies us to try root access
+                if os.path.exists(workdir) and len(os.listdir(workdir)) == 0:
+                    try:
+                        os.rmdir(workdir)
+                    except OSError:
                         raise
-                else:
-                    copy_ownership_info(app.appdir,target)
+                for target in (updir,workdir):
+                    try:
+                        os.mkdir(target)
+                    except OSError, e:
+                        if e.errno not in (errno.EEXIST,183):
+                            raise
+                    else:
+                        copy_ownership_info(app.appdir,target)
+                self._created_workdirs.add(workdir)
         return workdir
 
     def needs_cleanup(self,app):
@@ -166,8 +279,14 @@ class DefaultVersionFinder(VersionFinder):
         for nm in os.listdir(rddir):
             really_rmtree(os.path.join(rddir,nm))
 
-    def open_url(self,url):
-        f = urllib2.urlopen(url, timeout=30)
+    def open_url(self,url,headers=None):
+        """Open the given url, sending any extra request headers given.
+
+        Subclasses may override this with the older signature open_url(url),
+        in which case requests that would carry extra headers (conditional
+        fetches, resumed downloads, byte ranges) are made as plain GETs.
+        """
+        f = self._connections.open(url,headers)
         try:
             size = f.headers.get("content-length",None)
             if size is not None:
@@ -178,7 +297,154 @@ class DefaultVersionFinder(VersionFinder):
             f.size = size
         return f
 
+    def _open_url(self,url,headers=None):
+        """Open the given url via open_url(), with headers if it takes them."""
+        if headers and _accepts_headers(self.open_url):
+            return self.open_url(url,headers)
+        return self.open_url(url)
+
+    def get_file_size(self,url):
+        """Get the size of the file at the given url, or None if unknown."""
+        url = urljoin(self.download_url,url)
+        try:
+            f = self._connections.open(url,method="HEAD")
+        except (EnvironmentError,httplib.HTTPException):
+            return None
+        try:
+            return int(f.headers.get("content-length",None))
+        except (TypeError,ValueError):
+            return None
+        finally:
+            f.close()
+
+    def _add_links(self,links):
+        """Add (from_version,version,href,size,md5) links to the version graph.
+
+        The cost of each link is calculated from the size of the linked file.
+        If the md5 digest of the file is known, downloads are checked against
+        it as they stream in.  Sizes given along with a digest are taken to
+        be exact, and downloads of a different size are rejected early.
+        """
+        for (from_version,version,href,size,md5) in links:
+            cost = self.link_cost(size,from_version,version)
+            self.version_graph.add_link(from_version or "",version,href,cost)
+            if md5 is not None:
+                self._link_digests[href] = md5
+                if size is not None:
+                    self._link_sizes[href] = size
+
+    def _probe_link_sizes(self,links):
+        """Fill in unknown sizes in a list of links.
+
+        Unknown sizes are given as None, and are probed for in parallel if
+        self.probe_sizes is true.
+        """
+        links = list(links)
+        if self.probe_sizes:
+            unknown = sorted(set(l[2] for l in links if l[3] is None))
+            if unknown:
+                pool = multiprocessing.pool.ThreadPool(min(8,len(unknown)))
+                try:
+                    sizes = pool.map(self.get_file_size,unknown)
+                finally:
+                    pool.terminate()
+                sizes = dict(zip(unknown,sizes))
+                links = [(from_version,version,href,sizes[href],md5)
+                         if size is None else
+                         (from_version,version,href,size,md5)
+                         for (from_version,version,href,size,md5) in links]
+        return links
+
     def find_versions(self,app):
+        self._add_links(self._get_index_links(app))
+        return self.version_graph.get_versions(app.version)
+
+    def _get_index_links(self,app):
+        """Get the (from_version,version,href,size,md5) links in the index.
+
+        The parsed links are cached in the app's update directory, along with
+        the ETag and Last-Modified headers of the index page.  The cache is
+        used without any request if it was checked within the last
+        self.check_interval seconds, and is otherwise revalidated with a
+        conditional GET.
+        """
+        cache = self._load_index_cache(app)
+        if cache is not None:
+            age = time.time() - cache["checked"]
+            if 0 <= age < self.check_interval:
+                self.download_url = cache["url"]
+                return cache["links"]
+        headers = {}
+        if cache is not None:
+            if cache["etag"] is not None:
+                headers["If-None-Match"] = cache["etag"]
+            if cache["last_modified"] is not None:
+                headers["If-Modified-Since"] = cache["last_modified"]
+        try:
+            df = self._open_url(self.download_url,headers)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or cache is None:
+                raise
+            self.download_url = cache["url"]
+        else:
+            # If this followed any redirects, update the recorded URL
+            # to match the final endpoint.
+            try:
+                if df.url != self.download_url:
+                    self.download_url = df.url
+            except AttributeError:
+                pass
+            # TODO: would be nice not to have to guess encoding here.
+            try:
+                downloads = df.read().decode("utf-8")
+                headers = getattr(df,"headers",{})
+            finally:
+                df.close()
+            links = self._parse_index(app,downloads)
+            cache = {"url": self.download_url,
+                     "etag": headers.get("etag",None),
+                     "last_modified": headers.get("last-modified",None),
+                     "links": self._probe_link_sizes(links)}
+        cache["checked"] = time.time()
+        self._save_index_cache(app,cache)
+        return cache["links"]
+
+    def _index_cache_file(self,app):
+        key = hashlib.md5(self._index_key.encode("utf-8")).hexdigest()
+        return os.path.join(self._workdir(app,"index"),key + ".json")
+
+    def _load_index_cache(self,app):
+        """Load the cached download index, or None if not available."""
+        try:
+            with open(self._index_cache_file(app),"r") as f:
+                cache = json.load(f)
+            cache["links"] = [tuple(link) for link in cache["links"]]
+        except (EnvironmentError,ValueError,TypeError,KeyError):
+            return None
+        for link in cache["links"]:
+            if len(link) != 5:
+                return None
+        for key in ("url","etag","last_modified","checked"):
+            if key not in cache:
+                return None
+        return cache
+
+    def _save_index_cache(self,app,cache):
+        """Atomically save the download index cache, ignoring errors.
+
+        The cache is just an optimisation, so it's not a problem if e.g.
+        we don't have permission to write into the update dir.
+        """
+        try:
+            cachefile = self._index_cache_file(app)
+            with open(cachefile + ".new","w") as f:
+                json.dump(cache,f)
+            really_rename(cachefile + ".new",cachefile)
+        except EnvironmentError:
+            pass
+
+    def _parse_index(self,app,downloads):
+        """Parse (from_version,version,href,size,md5) links from the index."""
         version_re = "[a-zA-Z0-9\\.\\-_]+"
         appname_re = "(?P<version>%s)" % (version_re,)
         name_re = "(%s|%s)" % (app.name, urllib.quote(app.name))
@@ -186,30 +452,14 @@ class DefaultVersionFinder(VersionFinder):
         filename_re = "%s\\.(zip|exe|from-(?P<from_version>%s)\\.patch)"
         filename_re = filename_re % (appname_re,version_re,)
         link_re = "href=['\"]?(?P<href>([^'\"]*/)?%s)['\"]?" % (filename_re,)
-        # Read the URL.  If this followed any redirects, update the
-        # recorded URL to match the final endpoint.
-        df = self.open_url(self.download_url)
-        try:
-            if df.url != self.download_url:
-                self.download_url = df.url
-        except AttributeError:
-            pass
-        # TODO: would be nice not to have to guess encoding here.
-        try:
-            downloads = df.read().decode("utf-8")
-        finally:
-            df.close()
+        links = []
         for match in re.finditer(link_re,downloads,re.I):
             version = match.group("version")
             href = match.group("href")
             from_version = match.group("from_version")
-            # TODO: try to assign costs based on file size.
-            if from_version is None:
-                cost = 40
-            else:
-                cost = 1
-            self.version_graph.add_link(from_version or "",version,href,cost)
-        return self.version_graph.get_versions(app.version)
+            size = _listing_size(downloads,match.end())
+            links.append((from_version,version,href,size,None))
+        return links
 
     def fetch_version_iter(self,app,version):
         #  There's always the possibility that a file fails to download or 
@@ -226,24 +476,145 @@ class DefaultVersionFinder(VersionFinder):
                 raise EskyVersionError(version)
             local_path = []
             try:
-                for url in path:
-                    for status in self._fetch_file_iter(app,url):
-                        if status["status"] == "ready":
-                            local_path.append((status["path"],url))
-                        else:
-                            yield status
+                if self.check_base_version and \
+                   not self._check_base_version(app,path):
+                    self.version_graph.remove_links_from(app.version)
+                    continue
+                if self._can_pipeline(app,path):
+                    for status in self._pipelined_update_iter(app,version,
+                                                              path):
+                        yield status
+                    continue
+                for status in self._fetch_files_iter(app,path):
+                    if status["status"] == "ready":
+                        local_path = status["paths"]
+                    else:
+                        yield status
                 self._prepare_version(app,version,local_path)
             except (PatchError,EskyVersionError,EnvironmentError), e:
                 yield {"status":"retrying","size":None,"exception":e}
         yield {"status":"ready","path":name}
 
-    def _fetch_file_iter(self,app,url):
+    def _fetch_files_iter(self,app,urls):
+        """Fetch several files, yielding merged progress updates.
+
+        Up to self.max_connections files are downloaded concurrently, each
+        via _fetch_file_iter.  Progress updates give the combined size and
+        received bytes of all the files.  The final "ready" status has a
+        "paths" key listing (local path,url) pairs in the order given.
+
+        If any download fails, the others are abandoned and its exception
+        is re-raised.  Their connections are shut down and the worker threads
+        joined first, so no partial file is still being written to when a
+        retry starts.
+        """
+        if len(urls) <= 1 or self.max_connections <= 1:
+            paths = []
+            for url in urls:
+                for status in self._fetch_file_iter(app,url):
+                    if status["status"] == "ready":
+                        paths.append((status["path"],url))
+                    else:
+                        yield status
+            yield {"status":"ready","paths":paths}
+            return
+        todo = Queue.Queue()
+        for i in xrange(len(urls)):
+            todo.put(i)
+        events = Queue.Queue()
+        cancelled = []
+        def fetcher():
+            while not cancelled:
+                try:
+                    i = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                fetch = self._fetch_file_iter(app,urls[i])
+                try:
+                    for status in fetch:
+                        if cancelled:
+                            return
+                        events.put((i,status,None))
+                except Exception:
+                    if not cancelled:
+                        events.put((i,None,sys.exc_info()))
+                    return
+                finally:
+                    fetch.close()
+        threads = []
+        for _ in xrange(min(self.max_connections,len(urls))):
+            t = threading.Thread(target=fetcher)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        sizes = [None] * len(urls)
+        received = [0] * len(urls)
+        paths = [None] * len(urls)
+        try:
+            while None in paths:
+                (i,status,exc_info) = events.get()
+                if exc_info is not None:
+                    raise exc_info[0],exc_info[1],exc_info[2]
+                if status["status"] == "ready":
+                    paths[i] = (status["path"],urls[i])
+                    sizes[i] = os.path.getsize(status["path"])
+                    received[i] = sizes[i]
+                else:
+                    sizes[i] = status["size"]
+                    received[i] = status["received"]
+                    if None in sizes:
+                        size = None
+                    else:
+                        size = sum(sizes)
+                    yield {"status": "downloading",
+                           "size": size,
+                           "received": sum(received),
+                    }
+        finally:
+            cancelled.append(True)
+            if None in paths:
+                self._connections.abort()
+            for t in threads:
+                t.join()
+        yield {"status":"ready","paths":paths}
+
+    def _download_name(self,app,url):
+        """Get the local filename for a download from the given url."""
         nm = os.path.basename(urlparse(url).path)
-        outfilenm = os.path.join(self._workdir(app,"downloads"),nm)
+        return os.path.join(self._workdir(app,"downloads"),nm)
+
+    def _fetch_file_iter(self,app,url,tee=None):
+        """Download the file at the given url, yielding progress updates.
+
+        If given, "tee" is called with each chunk of the file's data as it
+        arrives (including any data from a resumed partial download).
+        """
+        outfilenm = self._download_name(app,url)
+        cache_key = None
+        if self.download_cache is not None:
+            cache_key = self._download_cache_key(url)
+        if cache_key is not None and not os.path.exists(outfilenm):
+            if self._get_cached_download(url,outfilenm) and tee is not None:
+                with open(outfilenm,"rb") as f:
+                    data = f.read(1024*64)
+                    while data:
+                        tee(data)
+                        data = f.read(1024*64)
         if not os.path.exists(outfilenm):
+            partfilenm = outfilenm + ".part"
+            # If a download that can be resumed is interrupted, we keep the
+            # partial file.  As long as each attempt makes some progress on
+            # it there's no danger of looping forever, so we keep the link.
+            # Progress means the partial file ended up longer than it was
+            # before this attempt, not just that some data was received.
+            keep_partial = False
+            made_progress = False
+            try:
+                prev_size = os.path.getsize(partfilenm)
+            except EnvironmentError:
+                prev_size = 0
             try:
-                infile = self.open_url(urljoin(self.download_url,url))
-                outfile_size = 0
+                (infile,offset) = self._open_partial_download(url,outfilenm)
                 # The to determine size of download, so that we can
                 # detect corrupted or truncated downloads.
                 try:
@@ -255,40 +626,366 @@ class DefaultVersionFinder(VersionFinder):
                         infile_size = None
                     else:
                         infile_size = os.fstat(fh).st_size
+                if infile_size is not None:
+                    infile_size += offset
+                # If we know the expected digest, check it as we go.  When
+                # resuming, the digest of the existing data may have been
+                # checkpointed by an earlier attempt.
+                md5 = self._link_digests.get(url)
+                hasher = None
+                hashed = 0
+                if md5 is not None:
+                    if offset:
+                        hasher = self._load_digest_checkpoint(partfilenm,
+                                                              offset)
+                        if hasher is not None:
+                            hashed = offset
+                    if hasher is None:
+                        hasher = hashlib.md5()
+                self._digest_checkpoints.pop(partfilenm,None)
                 # Read it into a temporary file, then rename into place.
                 try:
-                    partfilenm = outfilenm + ".part"
-                    partfile = open(partfilenm,"wb")
+                    # If the exact size is known, there's no point
+                    # downloading a file of any other size.
+                    expected_size = self._link_sizes.get(url)
+                    if expected_size is not None:
+                        if infile_size is None:
+                            infile_size = expected_size
+                        elif infile_size != expected_size:
+                            if os.path.exists(partfilenm):
+                                os.unlink(partfilenm)
+                            self._write_partinfo(outfilenm,url,None)
+                            err = "corrupted download: %s" % (url,)
+                            raise IOError(err)
+                    validator = _get_validator(infile)
+                    self._write_partinfo(outfilenm,url,validator)
+                    keep_partial = (validator is not None and offset > 0)
+                    if offset:
+                        partfile = open(partfilenm,"ab")
+                        rehash = (hasher is not None and hashed < offset)
+                        if rehash or tee is not None:
+                            with open(partfilenm,"rb") as f:
+                                data = f.read(1024*64)
+                                while data:
+                                    if rehash:
+                                        hasher.update(data)
+                                    if tee is not None:
+                                        tee(data)
+                                    data = f.read(1024*64)
+                    else:
+                        partfile = open(partfilenm,"wb")
+                    outfile_size = offset
                     try:
                         data = infile.read(1024*64)
                         while data:
                             yield {"status": "downloading",
                                    "size": infile_size,
-                                   "received": partfile.tell(),
+                                   "received": outfile_size,
                             }
-                            partfile.write(data)
                             outfile_size += len(data)
+                            if infile_size is not None:
+                                if outfile_size > infile_size:
+                                    keep_partial = made_progress = False
+                                    err = "corrupted download: %s" % (url,)
+                                    raise IOError(err)
+                            partfile.write(data)
+                            if hasher is not None:
+                                hasher.update(data)
+                                hashed = outfile_size
+                            if tee is not None:
+                                tee(data)
+                            if validator is not None:
+                                keep_partial = True
+                                if outfile_size > prev_size:
+                                    made_progress = True
+                            if self.rate_limiter is not None:
+                                self.rate_limiter.consume(len(data))
                             data = infile.read(1024*64)
                         if infile_size is not None:
-                            if outfile_size != infile_size:
+                            if outfile_size < infile_size:
+                                err = "truncated download: %s" % (url,)
+                                raise IOError(err)
+                        if md5 is not None:
+                            if hasher.hexdigest() != md5:
+                                keep_partial = made_progress = False
                                 err = "corrupted download: %s" % (url,)
                                 raise IOError(err)
                     except Exception:
                         partfile.close()
-                        os.unlink(partfilenm)
+                        if not keep_partial:
+                            os.unlink(partfilenm)
+                            self._write_partinfo(outfilenm,url,None)
+                        elif hasher is not None:
+                            self._save_digest_checkpoint(partfilenm,hashed,
+                                                         hasher)
                         raise
                     else:
                         partfile.close()
                         really_rename(partfilenm,outfilenm)
+                        self._write_partinfo(outfilenm,url,None)
+                        if cache_key is not None:
+                            self.download_cache.put(cache_key,outfilenm)
                 finally:
                     infile.close()
             except Exception:
                 # Something went wrong.  To avoid infinite looping, we
-                # must remove that file from the link graph.
-                self.version_graph.remove_all_links(url)
+                # must remove that file from the link graph -- unless we
+                # made some progress and can resume the download next time.
+                if not made_progress:
+                    self.version_graph.remove_all_links(url)
                 raise
         yield {"status":"ready","path":outfilenm}
 
+    def _download_cache_key(self,url):
+        """Get the key for the given url in the download cache.
+
+        Returns None if the url shouldn't be cached.  Since other users can
+        write to the cache, only files whose digest is given in the index
+        are cached, so that anything read from it can be verified.
+        """
+        md5 = self._link_digests.get(url)
+        if md5 is None:
+            return None
+        return "md5:" + md5
+
+    def _get_cached_download(self,url,outfilenm):
+        """Try to fetch the given url from the download cache.
+
+        Returns True if it was found and matches its digest, in which case
+        it has been copied to the given local file.
+        """
+        key = self._download_cache_key(url)
+        if key is None or not self.download_cache.get(key,outfilenm):
+            return False
+        hasher = hashlib.md5()
+        with open(outfilenm,"rb") as f:
+            data = f.read(1024*64)
+            while data:
+                hasher.update(data)
+                data = f.read(1024*64)
+        if hasher.hexdigest() != self._link_digests[url]:
+            os.unlink(outfilenm)
+            return False
+        return True
+
+    def _save_digest_checkpoint(self,partfilenm,size,hasher):
+        """Remember the digest of the first "size" bytes of a partial file.
+
+        The state of the hash object can't be saved to disk, so checkpoints
+        are only kept for the life of the finder.  They are still useful
+        since interrupted downloads are normally retried straight away.
+        """
+        try:
+            st = os.stat(partfilenm)
+        except EnvironmentError:
+            return
+        if st.st_size == size:
+            checkpoint = (size,st.st_mtime,hasher.copy())
+            self._digest_checkpoints[partfilenm] = checkpoint
+
+    def _load_digest_checkpoint(self,partfilenm,size):
+        """Get a hash object for the first "size" bytes of a partial file.
+
+        Returns None if there's no checkpoint for exactly that data.
+        """
+        checkpoint = self._digest_checkpoints.get(partfilenm)
+        if checkpoint is None or checkpoint[0] != size:
+            return None
+        try:
+            st = os.stat(partfilenm)
+        except EnvironmentError:
+            return None
+        if st.st_size != size or st.st_mtime != checkpoint[1]:
+            return None
+        return checkpoint[2].copy()
+
+    def _open_partial_download(self,url,outfilenm,base_url=None):
+        """Open the given url, resuming any partial download if possible.
+
+        This returns a tuple (infile,offset) where "offset" is the number of
+        bytes already downloaded into the ".part" file.  Partial downloads
+        are resumed with a "Range" request, using the validator saved with
+        the partial file as "If-Range".  If the server ignores the range or
+        the file has changed, the download starts again from scratch.
+
+        Relative urls are resolved against "base_url" if given, and against
+        self.download_url otherwise.
+        """
+        fullurl = urljoin(base_url or self.download_url,url)
+        offset = 0
+        validator = self._read_partinfo(outfilenm,url)
+        if validator is not None:
+            try:
+                offset = os.path.getsize(outfilenm + ".part")
+            except EnvironmentError:
+                offset = 0
+        if offset:
+            headers = {"Range": "bytes=%d-" % (offset,),
+                       "If-Range": validator}
+            try:
+                infile = self._open_url(fullurl,headers)
+            except urllib2.HTTPError, e:
+                if e.code != 416:
+                    raise
+            else:
+                if getattr(infile,"code",None) == 206:
+                    return (infile,offset)
+                return (infile,0)
+        return (self.open_url(fullurl),0)
+
+    def _read_partinfo(self,outfilenm,url):
+        """Read the validator saved with a partial download, if any."""
+        try:
+            with open(outfilenm + ".partinfo","r") as f:
+                info = json.load(f)
+            if info["url"] != url:
+                return None
+            return info["validator"]
+        except (EnvironmentError,ValueError,TypeError,KeyError):
+            return None
+
+    def _write_partinfo(self,outfilenm,url,validator):
+        """Save the validator for a partial download, or remove it if None."""
+        infofilenm = outfilenm + ".partinfo"
+        if validator is None:
+            if os.path.exists(infofilenm):
+                os.unlink(infofilenm)
+        else:
+            with open(infofilenm,"w") as f:
+                json.dump({"url":url,"validator":validator},f)
+
+    def _check_base_version(self,app,path):
+        """Check that the given path can be applied to the current version.
+
+        If the path begins with a patch, the digest of the version that it
+        applies to is compared against that of the current version.  This
+        returns False only if the digests are known and differ.
+        """
+        if not urlparse(path[0]).path.endswith(".patch"):
+            return True
+        expected = self._get_patch_base_digest(app,path[0])
+        if expected is None:
+            return True
+        try:
+            actual = self._get_base_digest(app)
+        except EnvironmentError:
+            #  Missing files would make the patch fail anyway.
+            return False
+        if actual is None:
+            return True
+        return actual == expected
+
+    def _get_base_digest(self,app):
+        """Get the patch digest of the current version, or None if unknown.
+
+        This is the digest that a patch will verify against the current
+        version once it has been staged by _copy_best_version().  Thanks to
+        the digest cache kept in the version dir it is usually cheap to
+        calculate, since only the files' stat info needs to be checked.  The
+        cache isn't written to, since the current version may be in use.
+        """
+        #  TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
+        vdir = join_app_version(app.name,app.version,app.platform)
+        vdirpath = os.path.join(app.appdir,ESKY_APPDATA_DIR,vdir)
+        filelist = os.path.join(vdirpath,ESKY_CONTROL_DIR,ESKY_FILELIST)
+        if not os.path.isfile(filelist):
+            return None
+        return calculate_patch_digest(app.appdir,filelist_file=filelist,
+                                      update_cache=False)
+
+    def _get_patch_base_digest(self,app,url):
+        """Get the digest of the version that the given patch applies to.
+
+        This is read from a downloaded or partially-downloaded copy of the
+        patch if there is one, and otherwise from the first few bytes of the
+        patch on the server.  Returns None if the digest can't be found.
+        """
+        outfilenm = self._download_name(app,url)
+        for filenm in (outfilenm,outfilenm + ".part"):
+            try:
+                if os.path.getsize(filenm) >= PATCH_BASE_DIGEST_SIZE:
+                    with open(filenm,"rb") as f:
+                        return read_base_digest(f)
+            except (EnvironmentError,PatchError):
+                pass
+        headers = {"Range": "bytes=0-%d" % (PATCH_BASE_DIGEST_SIZE - 1,)}
+        try:
+            f = self._open_url(urljoin(self.download_url,url),headers)
+            try:
+                return read_base_digest(f)
+            finally:
+                f.close()
+        except (EnvironmentError,httplib.HTTPException,PatchError):
+            return None
+
+    def _can_pipeline(self,app,path):
+        """Check whether the given path can be downloaded and applied at once.
+
+        This is possible for a chain of patches that haven't been downloaded
+        yet, since they apply to the current version and the patch protocol
+        can be read sequentially.
+        """
+        if not self.pipelined or not path:
+            return False
+        for url in path:
+            if not urlparse(url).path.endswith(".patch"):
+                return False
+            if os.path.exists(self._download_name(app,url)):
+                return False
+        return True
+
+    def _pipelined_update_iter(self,app,version,path):
+        """Download and apply a chain of patches at the same time.
+
+        Each patch is applied in a background thread, reading from a pipe
+        that is fed with data as it is downloaded.  The downloaded data is
+        also saved to disk in the usual way, so if any patch fails to apply
+        we can fall back to _prepare_version() once they're all downloaded.
+        """
+        uppath = tempfile.mkdtemp(dir=self._workdir(app,"unpack"))
+        try:
+            try:
+                self._copy_best_version(app,uppath)
+            except EnvironmentError, e:
+                self.version_graph.remove_all_links(path[0])
+                err = "couldn't copy current version: %s" % (e,)
+                raise PatchError(err)
+            local_path = []
+            applied = True
+            def apply(pipe,errors):
+                try:
+                    apply_patch(uppath,pipe)
+                except Exception:
+                    errors.append(sys.exc_info())
+                #  Don't block the download if we stopped reading early.
+                pipe.abort()
+            for url in path:
+                pipe = _PipeStream()
+                errors = []
+                patcher = None
+                if applied:
+                    patcher = threading.Thread(target=apply,args=(pipe,errors))
+                    patcher.daemon = True
+                    patcher.start()
+                try:
+                    for status in self._fetch_file_iter(app,url,pipe.write):
+                        if status["status"] == "ready":
+                            local_path.append((status["path"],url))
+                        else:
+                            yield status
+                finally:
+                    pipe.close()
+                    if patcher is not None:
+                        patcher.join()
+                if errors:
+                    applied = False
+            if applied:
+                self._install_version(app,version,local_path,uppath)
+        finally:
+            really_rmtree(uppath)
+        if not applied:
+            self._prepare_version(app,version,local_path)
+
     def _prepare_version(self,app,version,path):
         """Prepare the requested version from downloaded data.
 
@@ -313,17 +1010,8 @@ class DefaultVersionFinder(VersionFinder):
                         raise PatchError(err)
                     patches = path
                 else:
-                    #  We're starting from a zipfile.  Extract the first dir
-                    #  containing more than a single item and go from there.
-                    try:
-                        deep_extract_zipfile(path[0][0],uppath)
-                    except (zipfile.BadZipfile,zipfile.LargeZipFile):
-                        self.version_graph.remove_all_links(path[0][1])
-                        try:
-                            os.unlink(path[0][0])
-                        except EnvironmentError:
-                            pass
-                        raise
+                    #  We're starting from a full download.
+                    self._unpack_download(app,path[0][0],path[0][1],uppath)
                     patches = path[1:]
                 # TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
                 # If a patch fails to apply because we've put an appdata dir
@@ -353,57 +1041,82 @@ class DefaultVersionFinder(VersionFinder):
                             raise
                     else:
                         break
-            # Find the actual version dir that we're unpacking.
-            # TODO: remove compatability hooks for ESKY_APPDATA_DIR=""
-            vdir = join_app_version(app.name,version,app.platform)
-            vdirpath = os.path.join(uppath,ESKY_APPDATA_DIR,vdir)
+            self._install_version(app,version,path,uppath)
+        finally:
+            really_rmtree(uppath)
+
+    def _unpack_download(self,app,filenm,url,uppath):
+        """Unpack a downloaded full version into the given directory.
+
+        The download is a zipfile; we extract the first dir containing more
+        than a single item and go from there.
+        """
+        try:
+            deep_extract_zipfile(filenm,uppath)
+        except (zipfile.BadZipfile,zipfile.LargeZipFile):
+            self.version_graph.remove_all_links(url)
+            try:
+                os.unlink(filenm)
+            except EnvironmentError:
+                pass
+            raise
+
+    def _install_version(self,app,version,path,uppath):
+        """Make the version unpacked in the given directory ready for use.
+
+        "path" is the list of (local file,url) pairs that it was prepared
+        from; these files are removed once the version is in place.
+        """
+        # Find the actual version dir that we're unpacking.
+        # TODO: remove compatability hooks for ESKY_APPDATA_DIR=""
+        vdir = join_app_version(app.name,version,app.platform)
+        vdirpath = os.path.join(uppath,ESKY_APPDATA_DIR,vdir)
+        if not os.path.isdir(vdirpath):
+            vdirpath = os.path.join(uppath,vdir)
             if not os.path.isdir(vdirpath):
-                vdirpath = os.path.join(uppath,vdir)
-                if not os.path.isdir(vdirpath):
-                    self.version_graph.remove_all_links(path[0][1])
-                    err = version + ": version directory does not exist"
-                    raise EskyVersionError(err)
-            # Move anything that's not the version dir into "bootstrap" dir.
-            ctrlpath = os.path.join(vdirpath,ESKY_CONTROL_DIR)
-            bspath = os.path.join(ctrlpath,"bootstrap")
-            if not os.path.isdir(bspath):
-                os.makedirs(bspath)
-            for nm in os.listdir(uppath):
-                if nm != vdir and nm != ESKY_APPDATA_DIR:
-                    really_rename(os.path.join(uppath,nm),
-                                  os.path.join(bspath,nm))
-            # Check that it has an esky-files/bootstrap-manifest.txt file
-            bsfile = os.path.join(ctrlpath,"bootstrap-manifest.txt")
-            if not os.path.exists(bsfile):
                 self.version_graph.remove_all_links(path[0][1])
-                err = version + ": version has no bootstrap-manifest.txt"
+                err = version + ": version directory does not exist"
                 raise EskyVersionError(err)
-            # Make it available for upgrading, replacing anything
-            # that we previously had available.
-            rdpath = self._ready_name(app,version)
-            tmpnm = None
-            try:
-                if os.path.exists(rdpath):
-                    tmpnm = rdpath + ".old"
-                    while os.path.exists(tmpnm):
-                        tmpnm = tmpnm + ".old"
-                    really_rename(rdpath,tmpnm)
-                really_rename(vdirpath,rdpath)
-            finally:
-                if tmpnm is not None:
-                    really_rmtree(tmpnm)
-            #  Clean up any downloaded files now that we've used them.
-            for (filenm,_) in path:
-                os.unlink(filenm)
+        # Move anything that's not the version dir into "bootstrap" dir.
+        ctrlpath = os.path.join(vdirpath,ESKY_CONTROL_DIR)
+        bspath = os.path.join(ctrlpath,"bootstrap")
+        if not os.path.isdir(bspath):
+            os.makedirs(bspath)
+        for nm in os.listdir(uppath):
+            if nm != vdir and nm != ESKY_APPDATA_DIR:
+                really_rename(os.path.join(uppath,nm),
+                              os.path.join(bspath,nm))
+        # Check that it has an esky-files/bootstrap-manifest.txt file
+        bsfile = os.path.join(ctrlpath,"bootstrap-manifest.txt")
+        if not os.path.exists(bsfile):
+            self.version_graph.remove_all_links(path[0][1])
+            err = version + ": version has no bootstrap-manifest.txt"
+            raise EskyVersionError(err)
+        # Make it available for upgrading, replacing anything
+        # that we previously had available.
+        rdpath = self._ready_name(app,version)
+        tmpnm = None
+        try:
+            if os.path.exists(rdpath):
+                tmpnm = rdpath + ".old"
+                while os.path.exists(tmpnm):
+                    tmpnm = tmpnm + ".old"
+                really_rename(rdpath,tmpnm)
+            really_rename(vdirpath,rdpath)
         finally:
-            really_rmtree(uppath)
+            if tmpnm is not None:
+                really_rmtree(tmpnm)
+        #  Clean up any downloaded files now that we've used them.
+        for (filenm,_) in path:
+            os.unlink(filenm)
 
     def _copy_best_version(self,app,uppath,force_appdata_dir=True):
         """Copy the best version directory from the given app.
 
         This copies the best version directory from the given app into the
         unpacking path.  It's useful for applying patches against an existing
-        version.
+        version.  Files are cloned rather than copied where possible; the
+        patcher never modifies a file in place, so this is safe.
         """
         best_vdir = join_app_version(app.name,app.version,app.platform)
         #  TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
@@ -419,7 +1132,7 @@ class DefaultVersionFinder(VersionFinder):
         except OSError, e:
             if e.errno not in (errno.EEXIST,183):
                 raise
-        shutil.copytree(source,os.path.join(dest,best_vdir))
+        clone_tree(source,os.path.join(dest,best_vdir),self.link_files)
         mfstnm = os.path.join(source,ESKY_CONTROL_DIR,"bootstrap-manifest.txt")
         with open(mfstnm,"r") as manifest:
             for nm in manifest:
@@ -427,11 +1140,11 @@ class DefaultVersionFinder(VersionFinder):
                 bspath = os.path.join(app.appdir,nm)
                 dstpath = os.path.join(uppath,nm)
                 if os.path.isdir(bspath):
-                    shutil.copytree(bspath,dstpath)
+                    clone_tree(bspath,dstpath,self.link_files)
                 else:
                     if not os.path.isdir(os.path.dirname(dstpath)):
                         os.makedirs(os.path.dirname(dstpath))
-                    shutil.copy2(bspath,dstpath)
+                    clone_file(bspath,dstpath,self.link_files)
 
     def has_version(self,app,version):
         path = self._ready_name(app,version)
@@ -452,7 +1165,7 @@ class S3VersionFinder(DefaultVersionFinder):
     This VersionFinder subclass looks for updates in a specific S3
     bucket.
     """
-    def find_versions(self, app):
+    def _parse_index(self, app, downloads):
         version_re = "[a-zA-Z0-9\\.\\-_]+"
         appname_re = "(?P<version>%s)" % (version_re,)
         name_re = "(%s|%s)" % (app.name, urllib.quote(app.name))
@@ -460,34 +1173,650 @@ class S3VersionFinder(DefaultVersionFinder):
         filename_re = "%s\\.(zip|exe|from-(?P<from_version>%s)\\.patch)"
         filename_re = filename_re % (appname_re, version_re,)
         link_re = "Key>(?P<href>([^<]*/)?%s)<" % (filename_re,)
-        # Read the URL.  If this followed any redirects, update the
-        # recorded URL to match the final endpoint.
-        df = self.open_url(self.download_url)
-        try:
-            if df.url != self.download_url:
-                self.download_url = df.url
-        except AttributeError:
-            pass
-        # TODO: would be nice not to have to guess encoding here.
-        try:
-            downloads = df.read().decode("utf-8")
-        finally:
-            df.close()
         dwl_url = self.download_url
         if "?" in self.download_url:
             dwl_url = self.download_url[0:self.download_url.find("?")]
+        links = []
         for match in re.finditer(link_re, downloads, re.I):
             version = match.group("version")
             href = urllib.quote(match.group("href"))
             from_version = match.group("from_version")
-            # TODO: try to assign costs based on file size.
+            #  The object's size is listed alongside its key.
+            end = downloads.find("</Contents>", match.end())
+            if end == -1:
+                end = len(downloads)
+            size = re.search("<Size>(\\d+)</Size>",
+                             downloads[match.end():end])
+            if size is not None:
+                size = int(size.group(1))
+            links.append((from_version, version, dwl_url + href, size, None))
+        return links
+
+
+class ManifestVersionFinder(DefaultVersionFinder):
+    """VersionFinder that reads a JSON manifest of available downloads.
+
+    This VersionFinder subclass expects its download url to point to a
+    manifest as produced by the "bdist_esky_manifest" command (or to the
+    directory containing it).  The manifest lists each available zipfile
+    and patch along with its exact size and md5 digest, so link costs are
+    exact and downloads are verified as they stream in.
+
+    The manifest is a JSON object with a "files" key listing one object
+    per file, e.g.:
+
+        {"format": 1,
+         "files": [{"name": "app-1.1.win32.from-1.0.patch",
+                    "appname": "app",
+                    "version": "1.1",
+                    "platform": "win32",
+                    "from_version": "1.0",
+                    "size": 31337,
+                    "md5": "f96b697d7cb7938d525a2f31aaf161d0"}]}
+
+    The "name" of each file is a url relative to that of the manifest, and
+    "from_version" is null for full downloads.
+    """
+
+    def __init__(self,download_url,**kwds):
+        if download_url.endswith("/"):
+            download_url += ESKY_MANIFEST
+        super(ManifestVersionFinder,self).__init__(download_url,**kwds)
+
+    def _parse_index(self,app,downloads):
+        manifest = json.loads(downloads)
+        if manifest.get("format",1) != 1:
+            raise EskyVersionError("unsupported manifest format")
+        links = []
+        for entry in manifest.get("files",()):
+            try:
+                if entry["appname"] != app.name:
+                    continue
+                if entry["platform"] != app.platform:
+                    continue
+                links.append((entry.get("from_version"),entry["version"],
+                              entry["name"],entry.get("size"),
+                              entry.get("md5")))
+            except (KeyError,TypeError):
+                continue
+        return links
+
+
+class ChunkVersionFinder(DefaultVersionFinder):
+    """VersionFinder that can download just the content it doesn't have.
+
+    This VersionFinder subclass understands the content-addressed chunk
+    store produced by the "bdist_esky_chunks" command, in addition to the
+    usual zipfiles and patches.  The store holds, for each version, a chunk
+    index "<appname>-<version>.<platform>.chunks.json" and a pack file of
+    the chunks first seen in that version.  The index is a JSON object
+    like this:
+
+        {"format": 1,
+         "vdir": "app-1.1.win32",
+         "chunk_size": 65536,
+         "files": [{"path": "appdata/app-1.1.win32/lib.dll",
+                    "mode": 420,
+                    "size": 70000,
+                    "md5": "f96b697d7cb7938d525a2f31aaf161d0",
+                    "chunks": ["1e8c4e0c...", "86b03d9f..."]}],
+         "dirs": ["appdata/app-1.1.win32/empty"],
+         "chunks": {"1e8c4e0c...": ["app-1.0.win32.chunks", 0, 65536],
+                    "86b03d9f...": ["app-1.1.win32.chunks", 0, 4464]}}
+
+    Each file is split into fixed-size chunks named by their md5 digest,
+    and "chunks" gives the pack file, offset and size of each one.  Pack
+    names are relative to the url of the index.
+
+    A chunk index is treated as a full download of its version, costed as
+    "chunk_cost_factor" times the zipfile for that version since some of
+    its content is expected to be available locally.  To fetch it, files
+    that are unchanged from the current version (by whole-file digest) are
+    copied locally and changed files are chunked to find which chunks are
+    already available.
+    The remaining chunks are downloaded with "Range" requests, merging
+    chunks that are close together in a pack into a single request.
+    """
+
+    #  Missing chunks separated by at most this many bytes are fetched in
+    #  a single range, up to a total range size of max_range_size.
+    max_range_gap = 64 * 1024
+    max_range_size = 4 * 1024 * 1024
+
+    #  Fraction of the cost of the corresponding zipfile charged for
+    #  following a link to a chunk index.
+    chunk_cost_factor = 0.5
+
+    def __init__(self,download_url,**kwds):
+        super(ChunkVersionFinder,self).__init__(download_url,**kwds)
+        self._local_content = {}
+
+    def _add_links(self,links):
+        """Add links to the version graph, discounting chunk indexes."""
+        chunk_links = []
+        other_links = []
+        for link in links:
+            if link[2].endswith(ESKY_CHUNK_INDEX_SUFFIX):
+                chunk_links.append(link)
+            else:
+                other_links.append(link)
+        super(ChunkVersionFinder,self)._add_links(other_links)
+        for (from_version,version,href,size,md5) in chunk_links:
+            cost = self.link_cost(size,from_version,version)
+            cost = int(cost * self.chunk_cost_factor)
+            self.version_graph.add_link(from_version or "",version,href,cost)
+
+    def _parse_index(self,app,downloads):
+        links = super(ChunkVersionFinder,self)._parse_index(app,downloads)
+        full_sizes = {}
+        for (from_version,version,href,size,md5) in links:
             if from_version is None:
-                cost = 40
+                full_sizes[version] = size
+        version_re = "[a-zA-Z0-9\\.\\-_]+"
+        appname_re = "(?P<version>%s)" % (version_re,)
+        name_re = "(%s|%s)" % (app.name,urllib.quote(app.name))
+        appname_re = join_app_version(name_re,appname_re,app.platform)
+        filename_re = appname_re + re.escape(ESKY_CHUNK_INDEX_SUFFIX)
+        link_re = "href=['\"]?(?P<href>([^'\"]*/)?%s)['\"]?" % (filename_re,)
+        for match in re.finditer(link_re,downloads,re.I):
+            version = match.group("version")
+            href = match.group("href")
+            links.append((None,version,href,full_sizes.get(version),None))
+        return links
+
+    def _fetch_file_iter(self,app,url,tee=None):
+        sup = super(ChunkVersionFinder,self)
+        if not url.endswith(ESKY_CHUNK_INDEX_SUFFIX):
+            for status in sup._fetch_file_iter(app,url,tee):
+                yield status
+            return
+        for status in sup._fetch_file_iter(app,url):
+            if status["status"] == "ready":
+                indexfile = status["path"]
             else:
-                cost = 1
-            self.version_graph.add_link(from_version or "", version,
-                                            dwl_url + href, cost)
-        return self.version_graph.get_versions(app.version)
+                yield status
+        index = self._load_chunk_index(indexfile,url)
+        (local_files,local_chunks) = self._find_local_content(app,index)
+        #  Keep these for _unpack_download, to avoid hashing it all again.
+        self._local_content[indexfile] = (local_files,local_chunks)
+        missing = {}
+        for entry in index["files"]:
+            if entry["path"] in local_files:
+                continue
+            for digest in entry["chunks"]:
+                if digest not in local_chunks:
+                    missing[digest] = index["chunks"][digest]
+        for status in self._fetch_chunks_iter(app,url,indexfile,missing):
+            yield status
+        yield {"status":"ready","path":indexfile}
+
+    def _load_chunk_index(self,indexfile,url):
+        """Load and sanity-check a downloaded chunk index."""
+        try:
+            with open(indexfile,"r") as f:
+                index = json.load(f)
+            if index.get("format",1) != 1:
+                raise ValueError("unsupported chunk index format")
+            for entry in index["files"]:
+                _check_index_path(entry["path"])
+                for digest in entry["chunks"]:
+                    index["chunks"][digest]
+            for dirpath in index.setdefault("dirs",[]):
+                _check_index_path(dirpath)
+        except (ValueError,TypeError,KeyError,AttributeError), e:
+            self.version_graph.remove_all_links(url)
+            try:
+                os.unlink(indexfile)
+            except EnvironmentError:
+                pass
+            raise IOError("corrupted chunk index: %s (%s)" % (url,e,))
+        return index
+
+    def _find_local_content(self,app,index):
+        """Find content of the given chunk index in the current version.
+
+        This returns a tuple (local_files,local_chunks).  The first maps
+        the path of each file in the index to an identical local file, and
+        the second maps chunk digests to a (local file,offset,size) tuple.
+        Only chunks of files that have changed are looked for, and only in
+        the local file at the corresponding path.
+        """
+        vdir = join_app_version(app.name,app.version,app.platform)
+        #  TODO: remove compatability hooks for ESKY_APPDATA_DIR="".
+        vdirpath = os.path.join(app.appdir,ESKY_APPDATA_DIR,vdir)
+        if not os.path.isdir(vdirpath):
+            vdirpath = os.path.join(app.appdir,vdir)
+        local = {}
+        for (dirpath,_,filenames) in os.walk(vdirpath):
+            for nm in filenames:
+                path = os.path.join(dirpath,nm)
+                relpath = os.path.relpath(path,vdirpath)
+                local[(True,relpath.replace(os.sep,"/"))] = path
+        ctrlpath = os.path.join(vdirpath,ESKY_CONTROL_DIR)
+        try:
+            with open(os.path.join(ctrlpath,"bootstrap-manifest.txt")) as f:
+                for nm in f:
+                    nm = nm.strip()
+                    path = os.path.join(app.appdir,nm)
+                    if nm and os.path.isfile(path):
+                        local[(False,nm.replace(os.sep,"/"))] = path
+        except EnvironmentError:
+            pass
+        #  Find identical files by whole-file digest.  Only files with the
+        #  size of some wanted file need to be hashed at all.
+        sizes = set(entry["size"] for entry in index["files"])
+        candidates = [p for p in local.itervalues()
+                      if os.path.getsize(p) in sizes]
+        try:
+            digests = calculate_file_digests(ctrlpath,candidates,
+                                             update_cache=False)
+        except EnvironmentError:
+            digests = []
+        by_digest = {}
+        for (path,digest) in zip(candidates,digests):
+            by_digest[binascii.hexlify(digest).decode("ascii")] = path
+        local_files = {}
+        local_chunks = {}
+        for entry in index["files"]:
+            if entry["md5"] in by_digest:
+                local_files[entry["path"]] = by_digest[entry["md5"]]
+                continue
+            path = local.get(_chunk_index_key(entry["path"],index["vdir"]))
+            if path is None:
+                continue
+            wanted = set(entry["chunks"])
+            for (offset,data) in iter_file_chunks(path,index["chunk_size"]):
+                digest = hashlib.md5(data).hexdigest()
+                if digest in wanted and digest not in local_chunks:
+                    local_chunks[digest] = (path,offset,len(data))
+        return (local_files,local_chunks)
+
+    def _fetch_chunks_iter(self,app,url,indexfile,missing):
+        """Download the given chunks, yielding progress updates.
+
+        "missing" maps chunk digests to (pack,offset,size) locations.  The
+        chunks are appended to a data file next to the downloaded index,
+        and their locations in it recorded in a JSON file alongside it, so
+        an interrupted download can be resumed.
+        """
+        datafile = indexfile + ".data"
+        mapfile = indexfile + ".fetched"
+        fetched = {}
+        if os.path.exists(datafile):
+            try:
+                with open(mapfile,"r") as f:
+                    fetched = json.load(f)
+            except (EnvironmentError,ValueError):
+                fetched = {}
+        if not fetched:
+            with open(datafile,"wb"):
+                pass
+        packs = {}
+        for (digest,(pack,offset,size)) in missing.iteritems():
+            if digest not in fetched:
+                packs.setdefault(pack,[]).append((offset,size,digest))
+        total = sum(size for (_,_,size) in missing.itervalues())
+        received = sum(size for (_,size) in fetched.itervalues())
+        made_progress = False
+        baseurl = urljoin(self.download_url,url)
+        try:
+            with open(datafile,"ab") as out:
+                for pack in sorted(packs):
+                    packurl = urljoin(baseurl,pack)
+                    for chunks in self._merge_ranges(sorted(packs[pack])):
+                        start = chunks[0][0]
+                        end = chunks[-1][0] + chunks[-1][1]
+                        rng = "bytes=%d-%d" % (start,end - 1)
+                        infile = self._open_url(packurl,{"Range":rng})
+                        try:
+                            if getattr(infile,"code",None) == 206:
+                                pos = start
+                            else:
+                                pos = 0
+                            for (offset,size,digest) in chunks:
+                                _read_exactly(infile,offset - pos)
+                                data = _read_exactly(infile,size)
+                                if self.rate_limiter is not None:
+                                    self.rate_limiter.consume(offset + size
+                                                              - pos)
+                                pos = offset + size
+                                if hashlib.md5(data).hexdigest() != digest:
+                                    err = "corrupted chunk: %s" % (packurl,)
+                                    raise IOError(err)
+                                out.seek(0,2)
+                                fetched[digest] = (out.tell(),size)
+                                out.write(data)
+                                received += size
+                                made_progress = True
+                                yield {"status":"downloading",
+                                       "size":total,
+                                       "received":received}
+                        finally:
+                            infile.close()
+        except Exception:
+            if not made_progress:
+                self.version_graph.remove_all_links(url)
+            raise
+        finally:
+            with open(mapfile,"w") as f:
+                json.dump(fetched,f)
+
+    def _merge_ranges(self,chunks):
+        """Group sorted (offset,size,digest) chunks into ranges to fetch."""
+        group = []
+        for chunk in chunks:
+            if group:
+                end = group[-1][0] + group[-1][1]
+                if chunk[0] - end > self.max_range_gap or \
+                   chunk[0] + chunk[1] - group[0][0] > self.max_range_size:
+                    yield group
+                    group = []
+            group.append(chunk)
+        if group:
+            yield group
+
+    def _unpack_download(self,app,filenm,url,uppath):
+        if not filenm.endswith(ESKY_CHUNK_INDEX_SUFFIX):
+            sup = super(ChunkVersionFinder,self)
+            return sup._unpack_download(app,filenm,url,uppath)
+        index = self._load_chunk_index(filenm,url)
+        local_content = self._local_content.pop(filenm,None)
+        if local_content is None:
+            local_content = self._find_local_content(app,index)
+        (local_files,local_chunks) = local_content
+        try:
+            with open(filenm + ".fetched","r") as f:
+                fetched = json.load(f)
+        except (EnvironmentError,ValueError):
+            fetched = {}
+        try:
+            with open(filenm + ".data","rb") as data:
+                for dirpath in index["dirs"]:
+                    dirpath = _join_index_path(uppath,dirpath)
+                    if not os.path.isdir(dirpath):
+                        os.makedirs(dirpath)
+                for entry in index["files"]:
+                    self._assemble_file(uppath,entry,local_files,
+                                        local_chunks,fetched,data)
+        except (PatchError,EnvironmentError):
+            self.version_graph.remove_all_links(url)
+            raise
+        finally:
+            for nm in (filenm + ".fetched",filenm + ".data"):
+                try:
+                    os.unlink(nm)
+                except EnvironmentError:
+                    pass
+
+    def _assemble_file(self,uppath,entry,local_files,local_chunks,fetched,
+                       data):
+        """Create a file from a chunk index in the given directory."""
+        target = _join_index_path(uppath,entry["path"])
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        source = local_files.get(entry["path"])
+        if source is not None:
+            mode = os.stat(source).st_mode & 0777
+            clone_file(source,target,
+                       self.link_files and mode == entry["mode"])
+        else:
+            hasher = hashlib.md5()
+            with open(target,"wb") as f:
+                for digest in entry["chunks"]:
+                    if digest in local_chunks:
+                        (path,offset,size) = local_chunks[digest]
+                        with open(path,"rb") as sf:
+                            sf.seek(offset)
+                            chunk = sf.read(size)
+                    elif digest in fetched:
+                        (offset,size) = fetched[digest]
+                        data.seek(offset)
+                        chunk = data.read(size)
+                    else:
+                        raise PatchError("missing chunk: %s" % (digest,))
+                    hasher.update(chunk)
+                    f.write(chunk)
+            if hasher.hexdigest() != entry["md5"]:
+                raise PatchError("incorrect MD5 digest for %s" % (target,))
+        if os.stat(target).st_mode & 0777 != entry["mode"]:
+            os.chmod(target,entry["mode"])
+
+
+class MirrorVersionFinder(DefaultVersionFinder):
+    """VersionFinder that downloads from the fastest of several mirrors.
+
+    MirrorVersionFinder is given a list of download urls, each of which
+    must serve the same index and files; links in the index should be
+    relative so that they can be fetched from any mirror.  When looking
+    for versions the mirrors are probed concurrently with HEAD requests,
+    waiting at most "probe_timeout" seconds for each, and the index and
+    downloads are fetched from the one that responded fastest.
+
+    If a mirror fails, the next-fastest one is used instead.  This includes
+    failures in the middle of a download, which is continued from the new
+    mirror using a "Range" request.  A file that is missing from a mirror
+    is looked for on the others, but doesn't count as a mirror failure.
+
+    The health of each mirror is recorded in the app's update directory.
+    A mirror that has failed is not used for "retry_interval" seconds, so
+    that later runs don't have to wait for it to time out again.  Measured
+    latencies are reused for "check_interval" seconds, like the index.
+    """
+
+    def __init__(self,mirrors,probe_timeout=5,retry_interval=60*60,**kwds):
+        if isinstance(mirrors,basestring):
+            mirrors = [mirrors]
+        mirrors = list(mirrors)
+        if not mirrors:
+            raise ValueError("no mirrors given")
+        super(MirrorVersionFinder,self).__init__(mirrors[0],**kwds)
+        self.mirrors = mirrors
+        self.probe_timeout = probe_timeout
+        self.retry_interval = retry_interval
+        self._index_key = "\n".join(mirrors)
+        self._health = {}
+        self._health_file = None
+        self._health_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = super(MirrorVersionFinder,self).__getstate__()
+        del state["_health_lock"]
+        return state
+
+    def __setstate__(self,state):
+        super(MirrorVersionFinder,self).__setstate__(state)
+        self._health_lock = threading.Lock()
+
+    def _get_index_links(self,app):
+        """Get the links in the index, from the fastest working mirror."""
+        self._load_health(app)
+        self._probe_mirrors()
+        error = None
+        for mirror in self._mirror_order():
+            self.download_url = mirror
+            try:
+                links = super(MirrorVersionFinder,self)._get_index_links(app)
+            except (EnvironmentError,httplib.HTTPException), e:
+                if _is_mirror_failure(e):
+                    self._mirror_failed(mirror)
+                error = e
+            else:
+                #  A cached index may have been fetched from another mirror.
+                self.download_url = mirror
+                self._mirror_succeeded(mirror)
+                return links
+        raise error
+
+    def _open_partial_download(self,url,outfilenm,base_url=None):
+        """Open the given url on the fastest working mirror.
+
+        The returned file continues from another mirror if reading from
+        this one fails part-way through.
+        """
+        if base_url is not None:
+            sup = super(MirrorVersionFinder,self)
+            return sup._open_partial_download(url,outfilenm,base_url)
+        error = None
+        for mirror in self._mirror_order():
+            try:
+                sup = super(MirrorVersionFinder,self)
+                (infile,offset) = sup._open_partial_download(url,outfilenm,
+                                                             mirror)
+            except (EnvironmentError,httplib.HTTPException), e:
+                if _is_mirror_failure(e):
+                    self._mirror_failed(mirror)
+                error = e
+            else:
+                infile = _MirrorResponse(self,url,mirror,infile,offset)
+                return (infile,offset)
+        raise error
+
+    def _open_mirror_range(self,mirror,url,start,total=None):
+        """Open the given url on a mirror, from byte "start" onwards.
+
+        Returns None if the mirror fails or doesn't give exactly that range
+        of a file of the given total size.
+        """
+        fullurl = urljoin(mirror,url)
+        try:
+            if start:
+                f = self._open_url(fullurl,{"Range":"bytes=%d-" % (start,)})
+            else:
+                f = self.open_url(fullurl)
+        except (EnvironmentError,httplib.HTTPException), e:
+            if _is_mirror_failure(e):
+                self._mirror_failed(mirror)
+            return None
+        if start:
+            ok = False
+            if getattr(f,"code",None) == 206:
+                crange = _parse_content_range(f.headers)
+                if crange is not None and crange[0] == start:
+                    ok = (total is None or crange[2] == total)
+        else:
+            size = getattr(f,"size",None)
+            ok = (total is None or size is None or size == total)
+        if not ok:
+            f.close()
+            return None
+        return f
+
+    def _health_file_name(self,app):
+        return os.path.join(self._workdir(app,"index"),"mirrors.json")
+
+    def _load_health(self,app):
+        """Load the recorded health of each mirror from the update dir."""
+        self._health_file = self._health_file_name(app)
+        health = {}
+        try:
+            with open(self._health_file,"r") as f:
+                data = json.load(f)
+            for (mirror,info) in data.iteritems():
+                health[mirror] = dict((k,v) for (k,v) in info.iteritems()
+                                      if isinstance(v,(int,long,float)))
+        except (EnvironmentError,ValueError,TypeError,AttributeError):
+            pass
+        with self._health_lock:
+            self._health = health
+
+    def _save_health(self):
+        """Atomically save the health of each mirror, ignoring errors."""
+        if self._health_file is None:
+            return
+        with self._health_lock:
+            try:
+                with open(self._health_file + ".new","w") as f:
+                    json.dump(self._health,f)
+                really_rename(self._health_file + ".new",self._health_file)
+            except EnvironmentError:
+                pass
+
+    def _is_failed(self,info,now):
+        failed = info.get("failed")
+        return failed is not None and 0 <= now - failed < self.retry_interval
+
+    def _mirror_order(self):
+        """Get the list of mirrors, ordered from best to worst.
+
+        Working mirrors come first, fastest first.  Mirrors that have failed
+        recently are only used as a last resort, least recent failure first.
+        """
+        now = time.time()
+        def order(item):
+            (i,mirror) = item
+            info = self._health.get(mirror,{})
+            if self._is_failed(info,now):
+                return (1,info["failed"],i)
+            return (0,info.get("latency",self.probe_timeout),i)
+        with self._health_lock:
+            ranked = sorted(enumerate(self.mirrors),key=order)
+        return [mirror for (i,mirror) in ranked]
+
+    def _probe_mirrors(self):
+        """Measure the latency of any mirrors not checked recently.
+
+        Mirrors that have failed recently are not probed, and mirrors that
+        don't respond to the probe are recorded as failed.
+        """
+        now = time.time()
+        stale = []
+        with self._health_lock:
+            for mirror in self.mirrors:
+                info = self._health.get(mirror,{})
+                if self._is_failed(info,now):
+                    continue
+                checked = info.get("checked")
+                if checked is None or not 0<=now-checked<self.check_interval:
+                    stale.append(mirror)
+        if not stale:
+            return
+        pool = multiprocessing.pool.ThreadPool(min(8,len(stale)))
+        try:
+            latencies = pool.map(self._probe_mirror,stale)
+        finally:
+            pool.terminate()
+        with self._health_lock:
+            for (mirror,latency) in zip(stale,latencies):
+                info = self._health.setdefault(mirror,{})
+                if latency is None:
+                    info["failed"] = now
+                    info["failures"] = info.get("failures",0) + 1
+                else:
+                    info.pop("failed",None)
+                    info["failures"] = 0
+                    info["latency"] = latency
+                    info["checked"] = now
+        self._save_health()
+
+    def _probe_mirror(self,mirror):
+        """Time a HEAD request to the given mirror, or None if it fails."""
+        pool = _ConnectionPool(timeout=self.probe_timeout)
+        start = time.time()
+        try:
+            pool.open(mirror,method="HEAD").close()
+        except (EnvironmentError,httplib.HTTPException), e:
+            #  A 4xx response still shows that the server is up.
+            if _is_mirror_failure(e):
+                return None
+        finally:
+            pool.close()
+        return time.time() - start
+
+    def _mirror_failed(self,mirror):
+        with self._health_lock:
+            info = self._health.setdefault(mirror,{})
+            info["failed"] = time.time()
+            info["failures"] = info.get("failures",0) + 1
+        self._save_health()
+
+    def _mirror_succeeded(self,mirror):
+        with self._health_lock:
+            info = self._health.setdefault(mirror,{})
+            if "failed" not in info and not info.get("failures"):
+                return
+            info.pop("failed",None)
+            info["failures"] = 0
+        self._save_health()
 
 
 class LocalVersionFinder(DefaultVersionFinder):
@@ -503,21 +1832,851 @@ class LocalVersionFinder(DefaultVersionFinder):
         appname_re = join_app_version(app.name,appname_re,app.platform)
         filename_re = "%s\\.(zip|exe|from-(?P<from_version>%s)\\.patch)"
         filename_re = filename_re % (appname_re,version_re,)
+        links = []
         for nm in os.listdir(self.download_url):
             match = re.match(filename_re,nm)
             if match:
                 version = match.group("version")
                 from_version = match.group("from_version")
-                if from_version is None:
-                    cost = 40
-                else:
-                    cost = 1
-                self.version_graph.add_link(from_version or "",version,nm,cost)
+                size = self.get_file_size(nm)
+                links.append((from_version,version,nm,size,None))
+        self._add_links(links)
         return self.version_graph.get_versions(app.version)
 
-    def open_url(self,url):
+    def open_url(self,url,headers=None):
         return open(os.path.join(self.download_url,url),"rb")
 
+    def get_file_size(self,url):
+        try:
+            return os.stat(os.path.join(self.download_url,url)).st_size
+        except EnvironmentError:
+            return None
+
+
+def iter_file_chunks(path,chunk_size=DEFAULT_CHUNK_SIZE):
+    """Iterate over (offset,data) pairs for fixed-size chunks of a file."""
+    with open(path,"rb") as f:
+        offset = 0
+        data = f.read(chunk_size)
+        while data:
+            yield (offset,data)
+            offset += len(data)
+            data = f.read(chunk_size)
+
+
+def _chunk_index_key(path,vdir):
+    """Key for matching a path in a chunk index to a local file.
+
+    Paths inside the version dir are keyed relative to it, since the local
+    version dir has a different name; bootstrap files are keyed as-is.
+    """
+    for prefix in (ESKY_APPDATA_DIR + "/" + vdir + "/",vdir + "/"):
+        if path.startswith(prefix):
+            return (True,path[len(prefix):])
+    return (False,path)
+
+
+def _check_index_path(path):
+    """Check that a path from a chunk index stays inside the version.
+
+    Paths must be relative and "/"-separated, with no empty, "." or ".."
+    components; anything else raises ValueError.
+    """
+    if not isinstance(path,basestring):
+        raise ValueError("invalid path in chunk index: %r" % (path,))
+    for nm in path.split("/"):
+        if nm in ("",".","..") or "\\" in nm or os.sep in nm:
+            raise ValueError("invalid path in chunk index: %r" % (path,))
+        if os.altsep and os.altsep in nm:
+            raise ValueError("invalid path in chunk index: %r" % (path,))
+    if os.path.splitdrive(path)[0]:
+        raise ValueError("invalid path in chunk index: %r" % (path,))
+
+
+def _join_index_path(root,path):
+    """Join a path from a chunk index onto the given root directory.
+
+    Like Patcher._check_path, this raises PatchError rather than return a
+    path outside the root.
+    """
+    try:
+        _check_index_path(path)
+    except ValueError, e:
+        raise PatchError(str(e))
+    target = os.path.join(root,*path.split("/"))
+    if not os.path.abspath(target).startswith(os.path.abspath(root)+os.sep):
+        raise PatchError("traversed outside root_dir")
+    return target
+
+
+def _read_exactly(infile,size):
+    """Read exactly 'size' bytes from the given file, or raise IOError."""
+    chunks = []
+    while size > 0:
+        data = infile.read(min(size,1024*64))
+        if not data:
+            raise IOError("truncated download")
+        chunks.append(data)
+        size -= len(data)
+    return "".encode("ascii").join(chunks)
+
+
+def _get_validator(response):
+    """Get a validator usable with "If-Range" from the given response.
+
+    This is the response's strong ETag if it has one, otherwise its
+    Last-Modified date.  Returns None if there is no suitable validator.
+    """
+    headers = getattr(response,"headers",None)
+    if headers is None:
+        return None
+    etag = headers.get("etag",None)
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified",None)
+
+
+class _ConnectionPool(object):
+    """Cache of persistent HTTP connections, keyed by scheme, host and port.
+
+    The open() method works like urllib2.urlopen(), following redirects and
+    raising urllib2.HTTPError for error responses, but it sends requests
+    over a kept-alive connection where possible.  A connection is returned
+    to the pool when the response has been read completely and closed.
+    Requests for other url schemes, or that must go through a proxy, are
+    passed on to urllib2.urlopen().
+    """
+
+    max_redirects = 10
+
+    def __init__(self,timeout=30):
+        self.timeout = timeout
+        self._idle = {}
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def open(self,url,headers=None,method="GET"):
+        parts = urlparse(url)
+        if parts.scheme not in ("http","https") or self._use_proxy(parts):
+            req = urllib2.Request(url,headers=headers or {})
+            if method != "GET":
+                req.get_method = lambda: method
+            return urllib2.urlopen(req,timeout=self.timeout)
+        for _ in xrange(self.max_redirects + 1):
+            response = self._request(method,url,headers or {})
+            location = response.headers.get("location",None)
+            if response.code not in (301,302,303,307,308) or not location:
+                break
+            response.discard()
+            url = urljoin(url,location)
+            if urlparse(url).scheme not in ("http","https"):
+                raise urllib2.HTTPError(url,response.code,"bad redirect",
+                                        response.headers,None)
+            if response.code == 303:
+                method = "GET"
+        else:
+            raise urllib2.HTTPError(url,response.code,"too many redirects",
+                                    response.headers,None)
+        if not 200 <= response.code < 300:
+            response.discard()
+            raise urllib2.HTTPError(url,response.code,response.msg,
+                                    response.headers,None)
+        return response
+
+    def abort(self):
+        """Shut down the connections of all open responses.
+
+        This can be called from any thread, and interrupts any reads that
+        are in progress on those connections.
+        """
+        with self._lock:
+            active = list(self._active)
+        for response in active:
+            response.abort()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _use_proxy(self,parts):
+        proxies = urllib.getproxies()
+        if parts.scheme not in proxies:
+            return False
+        return not urllib.proxy_bypass(parts.hostname or "")
+
+    def _request(self,method,url,headers):
+        parts = urlparse(url)
+        key = (parts.scheme,parts.hostname,parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        conn = self._acquire(key)
+        reused = conn is not None
+        if not reused:
+            conn = self._connect(key)
+        try:
+            conn.request(method,path,headers=headers)
+            response = conn.getresponse()
+        except (EnvironmentError,httplib.HTTPException):
+            conn.close()
+            #  The server may have dropped an idle connection, so try
+            #  once more with a fresh one.
+            if not reused:
+                raise
+            conn = self._connect(key)
+            try:
+                conn.request(method,path,headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        response = _PooledResponse(self,key,conn,response,url)
+        with self._lock:
+            self._active.add(response)
+        return response
+
+    def _connect(self,key):
+        (scheme,host,port) = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host,port,timeout=self.timeout)
+        return httplib.HTTPConnection(host,port,timeout=self.timeout)
+
+    def _acquire(self,key):
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def _release(self,key,conn):
+        with self._lock:
+            self._idle.setdefault(key,[]).append(conn)
+
+    def _closed(self,response):
+        with self._lock:
+            self._active.discard(response)
+
+
+class _PipeStream(object):
+    """Bounded in-memory pipe from a writing thread to a reading thread.
+
+    The writer calls write() and finally close(); the reader sees EOF once
+    all data has been read after close().  If the reader stops early it
+    must call abort(), after which any further writes are discarded rather
+    than blocking.
+    """
+
+    def __init__(self,maxsize=1024*1024*4):
+        self.maxsize = maxsize
+        self._chunks = deque()
+        self._size = 0
+        self._closed = False
+        self._aborted = False
+        self._cond = threading.Condition()
+
+    def write(self,data):
+        with self._cond:
+            while self._size >= self.maxsize and not self._aborted:
+                self._cond.wait()
+            if not self._aborted:
+                self._chunks.append(data)
+                self._size += len(data)
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+    def read(self,size=-1):
+        """Read 'size' bytes, returning fewer only at EOF."""
+        chunks = []
+        while size != 0:
+            if size < 0:
+                data = self.read1(self.maxsize)
+            else:
+                data = self.read1(size)
+                size -= len(data)
+            if not data:
+                break
+            chunks.append(data)
+        return "".encode("ascii").join(chunks)
+
+    def read1(self,size=-1):
+        """Read up to 'size' bytes, blocking only if none are available."""
+        with self._cond:
+            while not self._closed and not self._size:
+                self._cond.wait()
+            return self._take(size)
+
+    def _take(self,size):
+        if size < 0 or size > self._size:
+            size = self._size
+        chunks = []
+        remaining = size
+        while remaining:
+            chunk = self._chunks.popleft()
+            if len(chunk) > remaining:
+                self._chunks.appendleft(chunk[remaining:])
+                chunk = chunk[:remaining]
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self._size -= size
+        self._cond.notify_all()
+        return "".encode("ascii").join(chunks)
+
+
+class _PooledResponse(object):
+    """File-like response object for a request made through _ConnectionPool.
+
+    This provides the parts of the urllib2 response interface used by the
+    finders: read(), close(), and the "url", "code", "msg" and "headers"
+    attributes.
+    """
+
+    def __init__(self,pool,key,conn,response,url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self._aborted = False
+
+    def read(self,size=-1):
+        if size is None or size < 0:
+            return self._response.read()
+        return self._response.read(size)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def discard(self):
+        """Read and discard any small remaining body, then close."""
+        length = self._response.length
+        if length is not None and length <= 1024*64:
+            try:
+                self._response.read()
+            except (EnvironmentError,httplib.HTTPException):
+                pass
+        self.close()
+
+    def abort(self):
+        """Shut down the connection, interrupting any read in progress.
+
+        This may be called from another thread; the response must still be
+        closed by the thread using it.
+        """
+        self._aborted = True
+        sock = getattr(self._conn,"sock",None)
+        if sock is None:
+            #  If the server will close the connection, httplib detaches
+            #  it and leaves the response holding the socket.
+            sock = getattr(getattr(self._response,"fp",None),"_sock",None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        """Close the response, returning the connection to the pool if the
+        response was read in full and the server will keep it open."""
+        if self._conn is None:
+            return
+        (conn,self._conn) = (self._conn,None)
+        self._pool._closed(self)
+        #  Responses with no body (e.g. to HEAD requests) may not have
+        #  been read, but can still leave the connection reusable.
+        if not self._response.isclosed() and self._response.length == 0:
+            self._response.read()
+        if self._aborted:
+            self._response.close()
+            conn.close()
+        elif self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key,conn)
+        else:
+            self._response.close()
+            conn.close()
+
+
+def _accepts_headers(open_url):
+    """Check whether an open_url() method takes a "headers" argument.
+
+    Older subclasses override open_url() with the signature open_url(url),
+    and must only ever be called with a single argument.
+    """
+    try:
+        (args,varargs,_,_) = inspect.getargspec(open_url)
+    except TypeError:
+        return False
+    return varargs is not None or len(args) >= 3
+
+
+def _is_mirror_failure(e):
+    """Check whether an error means that a mirror isn't working.
+
+    That is any error other than a 4xx response, which only says that
+    something is wrong with the particular file that was requested.
+    """
+    if isinstance(e,urllib2.HTTPError):
+        return not 400 <= e.code < 500
+    return True
+
+
+class _MirrorResponse(object):
+    """Response for a download that can continue from another mirror.
+
+    This wraps a response from one of the mirrors of a MirrorVersionFinder.
+    If reading from it fails or it ends early, the mirror is recorded as
+    failed and the rest of the file is requested from each of the other
+    mirrors in turn, until one gives the expected range of the file.
+    """
+
+    def __init__(self,finder,url,mirror,response,offset):
+        self._finder = finder
+        self._url = url
+        self._mirror = mirror
+        self._response = response
+        self._tried = set([mirror])
+        self._pos = offset
+        self._total = None
+        self.url = getattr(response,"url",url)
+        self.code = getattr(response,"code",None)
+        self.headers = getattr(response,"headers",None)
+        try:
+            self.size = response.size
+        except AttributeError:
+            pass
+        else:
+            if self.size is not None:
+                self._total = self.size + offset
+
+    def fileno(self):
+        return self._response.fileno()
+
+    def read(self,size=-1):
+        while True:
+            try:
+                data = self._response.read(size)
+            except (EnvironmentError,httplib.HTTPException):
+                exc_info = sys.exc_info()
+                if not self._failover():
+                    raise exc_info[0],exc_info[1],exc_info[2]
+                continue
+            self._pos += len(data)
+            if not data and self._total is not None:
+                if self._pos < self._total and self._failover():
+                    continue
+            return data
+
+    def _failover(self):
+        """Switch to reading the rest of the file from another mirror."""
+        self._finder._mirror_failed(self._mirror)
+        self._response.close()
+        for mirror in self._finder._mirror_order():
+            if mirror in self._tried:
+                continue
+            self._tried.add(mirror)
+            response = self._finder._open_mirror_range(mirror,self._url,
+                                                       self._pos,self._total)
+            if response is not None:
+                self._mirror = mirror
+                self._response = response
+                return True
+        return False
+
+    def close(self):
+        self._response.close()
+
+
+_CONTENT_RANGE_RE = re.compile("^bytes\\s+(\\d+)-(\\d+)/(\\d+|\\*)$",re.I)
+
+def _parse_content_range(headers):
+    """Parse the Content-Range header into a (start,end,total) tuple.
+
+    The total is None if it is not known.  Returns None if the header is
+    missing or invalid.
+    """
+    match = _CONTENT_RANGE_RE.match(headers.get("content-range","").strip())
+    if match is None:
+        return None
+    (start,end,total) = match.groups()
+    if total == "*":
+        total = None
+    else:
+        total = int(total)
+    return (int(start),int(end),total)
+
+
+#  Matches a file size as shown in a typical directory listing,
+#  e.g. "4423091", "4.2M" or "150K".
+_LISTING_SIZE_RE = re.compile("^(\\d+(?:\\.\\d+)?)([KMG]?)B?$",re.I)
+_LISTING_SIZE_SCALES = {"":1,"K":1024,"M":1024**2,"G":1024**3}
+_LISTING_HREF_RE = re.compile("href",re.I)
+
+def _listing_size(listing,pos):
+    """Guess the size of a linked file from an HTML directory listing.
+
+    Servers such as Apache and nginx give the size of each file in the
+    same line as the link to it, after the modification time.  This looks
+    for the last size-like token between 'pos' and the end of the line (or
+    the next link), ignoring any markup.  Returns None if no size is found.
+    """
+    end = listing.find("\n",pos)
+    if end == -1:
+        end = len(listing)
+    nextlink = _LISTING_HREF_RE.search(listing,pos,end)
+    if nextlink is not None:
+        end = nextlink.start()
+    text = re.sub("<[^>]*>?"," ",listing[pos:end])
+    for token in reversed(text.split()):
+        match = _LISTING_SIZE_RE.match(token)
+        if match is not None:
+            scale = _LISTING_SIZE_SCALES[match.group(2).upper()]
+            return int(float(match.group(1)) * scale)
+    return None
+
+
+class LinkCost(object):
+    """Default cost function for links in a VersionGraph.
+
+    The cost of a link is the number of bytes that must be downloaded to
+    follow it, plus a fixed "hop_cost" to account for the time spent
+    unpacking or patching at each step.  Files of unknown size are assigned
+    nominal sizes such that, with the default hop cost, a full download costs
+    forty times as much as a patch - the ratio traditionally used by esky.
+
+    Any callable accepting (size,from_version,version) may be used in its
+    place; "size" is None if unknown and "from_version" is None for a full
+    download.
+    """
+
+    hop_cost = 256 * 1024
+    unknown_patch_size = 1024 * 1024
+    unknown_full_size = 40 * unknown_patch_size + 39 * hop_cost
+
+    def __init__(self,hop_cost=None,unknown_full_size=None,
+                 unknown_patch_size=None):
+        if hop_cost is not None:
+            self.hop_cost = hop_cost
+        if unknown_full_size is not None:
+            self.unknown_full_size = unknown_full_size
+        if unknown_patch_size is not None:
+            self.unknown_patch_size = unknown_patch_size
+
+    def __call__(self,size,from_version,version):
+        if size is None:
+            if from_version is None:
+                size = self.unknown_full_size
+            else:
+                size = self.unknown_patch_size
+        return size + self.hop_cost
+
+
+class DownloadCache(object):
+    """Download cache that can be shared between apps and users.
+
+    A DownloadCache keeps completed downloads in the given directory, so
+    that an update downloaded by one esky can be used by another esky on
+    the same machine (e.g. per-user installs of the same app on a terminal
+    server).  Pass it to DefaultVersionFinder as "download_cache".
+
+    Entries are content-addressed by md5 digest, so only downloads whose
+    digest is given in the update index are cached.  When the total size of
+    the cache exceeds "max_size" bytes the least recently used entries are
+    evicted.  Changes to the cache are serialised with a lock file, and
+    entries are only ever replaced atomically, so it's safe for several
+    processes to use it at once.
+
+    The directory must be writable by everyone that shares it, so only
+    share it between users who trust each other; entries are re-verified
+    against the expected digest when they are used.  The cache is only an
+    optimisation, so any errors in using it are ignored.
+    """
+
+    max_size = 1024 * 1024 * 1024
+
+    def __init__(self,path,max_size=None):
+        self.path = path
+        if max_size is not None:
+            self.max_size = max_size
+
+    def _entry_name(self,key):
+        key = hashlib.md5(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path,key)
+
+    def get(self,key,target):
+        """Copy the entry for the given key to the target file, if present.
+
+        Returns True if the entry was found and copied, False otherwise.
+        """
+        entry = self._entry_name(key)
+        try:
+            with self._lock():
+                if not os.path.exists(entry):
+                    return False
+                #  Bump its mtime, which is what LRU eviction is based on.
+                #  This fails for entries added by other users, in which
+                #  case eviction will be a little less accurate.
+                try:
+                    os.utime(entry,None)
+                except EnvironmentError:
+                    pass
+            #  Entries are never modified in place, only replaced or
+            #  removed, so it's safe to copy it outside the lock.
+            clone_file(entry,target + ".new")
+            really_rename(target + ".new",target)
+        except EnvironmentError:
+            try:
+                os.unlink(target + ".new")
+            except EnvironmentError:
+                pass
+            return False
+        return True
+
+    def put(self,key,source):
+        """Add the given file to the cache under the given key."""
+        entry = self._entry_name(key)
+        tmpnm = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            (fd,tmpnm) = tempfile.mkstemp(dir=self.path,suffix=".new")
+            os.close(fd)
+            clone_file(source,tmpnm,hardlink=False)
+            os.chmod(tmpnm,0644)
+            with self._lock():
+                if sys.platform == "win32" and os.path.exists(entry):
+                    os.unlink(entry)
+                really_rename(tmpnm,entry)
+                tmpnm = None
+                self._evict(keep=entry)
+        except EnvironmentError:
+            if tmpnm is not None:
+                try:
+                    os.unlink(tmpnm)
+                except EnvironmentError:
+                    pass
+
+    def _evict(self,keep=None):
+        """Remove least recently used entries until we're within max_size.
+
+        This must be called with the lock held.
+        """
+        entries = []
+        total = 0
+        for nm in os.listdir(self.path):
+            if nm.endswith(".new") or nm == "lockfile.txt":
+                continue
+            path = os.path.join(self.path,nm)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime,path,st.st_size))
+            total += st.st_size
+        entries.sort()
+        for (_,path,size) in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except EnvironmentError:
+                #  Probably in use by another process on win32.
+                continue
+            total -= size
+
+    @contextmanager
+    def _lock(self):
+        """Context manager holding an exclusive lock on the cache."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        lockfile = os.path.join(self.path,"lockfile.txt")
+        f = open(lockfile,"a")
+        try:
+            os.chmod(lockfile,0666)
+        except EnvironmentError:
+            pass
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(),msvcrt.LK_LOCK,1)
+                    except IOError, e:
+                        if e.errno != errno.EDEADLOCK:
+                            raise
+                    else:
+                        break
+                try:
+                    yield
+                finally:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(),msvcrt.LK_UNLCK,1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+        finally:
+            f.close()
+
+
+class RateLimiter(object):
+    """Token-bucket limit on the rate at which updates are downloaded.
+
+    Downloads are limited to "rate" bytes per second on average, in bursts
+    of at most "burst" bytes (by default, one second's worth).  Pass it to
+    DefaultVersionFinder as "rate_limiter"; all downloads made by the finder
+    share the limit, and it may also be shared between finders.  The limit
+    can be changed at any time by calling set_rate(), and a rate of None
+    means no limit.
+    """
+
+    def __init__(self,rate,burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self._tokens = 0
+        self._last = time.time()
+        self.set_rate(rate,burst)
+        if self.burst is not None:
+            self._tokens = self.burst
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def set_rate(self,rate,burst=None):
+        """Change the rate limit, taking effect immediately."""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            if burst is None and rate is not None:
+                burst = rate
+            self.burst = burst
+            if rate is None:
+                self._tokens = 0
+            else:
+                self._tokens = min(self._tokens,burst)
+
+    def _refill(self):
+        """Add the tokens accumulated since the last refill.
+
+        This must be called with the lock held.
+        """
+        now = time.time()
+        if self.rate is not None:
+            self._tokens += (now - self._last) * self.rate
+            self._tokens = min(self._tokens,self.burst)
+        self._last = now
+
+    def consume(self,size):
+        """Account for "size" bytes of data, sleeping until it's allowed.
+
+        The bytes are taken from the bucket immediately, possibly leaving
+        it in debt; we then wait until the debt has been paid off.  The wait
+        is done in small steps, so that changes to the rate apply quickly.
+        """
+        with self._lock:
+            self._refill()
+            if self.rate is None:
+                return
+            self._tokens -= size
+        while True:
+            with self._lock:
+                self._refill()
+                if self.rate is None or self._tokens >= 0:
+                    return
+                wait = min(-self._tokens / float(self.rate),0.1)
+            time.sleep(wait)
+
+
+class IdleRateLimiter(RateLimiter):
+    """RateLimiter that backs off in favour of other network traffic.
+
+    This limiter measures the rate actually achieved by downloads over each
+    "interval" seconds.  If that falls well short of the current limit, the
+    link is presumably busy with other traffic and so the limit is halved,
+    down to at most "min_rate".  Otherwise it is raised by a tenth of
+    "max_rate", up to at most "max_rate".  Gaps in downloading longer than
+    "interval" are not counted against the achieved rate.
+    """
+
+    #  Fraction of the current limit below which we assume contention.
+    threshold = 0.75
+
+    def __init__(self,max_rate,min_rate=None,interval=2.0):
+        if min_rate is None:
+            min_rate = max_rate / 100
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.interval = interval
+        self._window_start = None
+        self._window_last = None
+        self._window_size = 0
+        super(IdleRateLimiter,self).__init__(max_rate)
+
+    def consume(self,size):
+        with self._lock:
+            now = time.time()
+            if self._window_start is None or \
+               now - self._window_last > self.interval:
+                self._window_start = now
+                self._window_size = 0
+            self._window_last = now
+            self._window_size += size
+            elapsed = now - self._window_start
+            if elapsed >= self.interval:
+                achieved = self._window_size / elapsed
+                self._window_start = now
+                self._window_size = 0
+            else:
+                achieved = None
+        if achieved is not None:
+            self._adjust(achieved)
+        super(IdleRateLimiter,self).consume(size)
+
+    def _adjust(self,achieved):
+        """Adjust the limit given the rate achieved in the last interval."""
+        if achieved < self.rate * self.threshold:
+            rate = max(self.min_rate,self.rate / 2)
+        else:
+            rate = min(self.max_rate,self.rate + self.max_rate / 10)
+        if rate != self.rate:
+            self.set_rate(rate)
+
 
 class VersionGraph(object):
     """Class for managing links between different versions.
@@ -534,6 +2693,13 @@ class VersionGraph(object):
 
     def __init__(self):
         self._links = {"":{}}
+        #  Reverse index from each "via" to the (source,target) pairs it
+        #  links, so that links can be removed without scanning the graph.
+        self._via_links = {}
+        #  Cache of best paths from each source version, and of the best
+        #  link between each pair of versions.  Invalidated on any change.
+        self._best_paths = {}
+        self._best_links = {}
 
     def add_link(self,source,target,via,cost):
         """Add a link from source to target."""
@@ -547,16 +2713,31 @@ class VersionGraph(object):
             to_target[via] = min(to_target[via],cost)
         else:
             to_target[via] = cost
+        self._via_links.setdefault(via,set()).add((source,target))
+        self._invalidate()
 
     def remove_all_links(self,via):
-        for source in self._links:
-            for target in self._links[source]:
-                self._links[source][target].pop(via,None)
+        for (source,target) in self._via_links.pop(via,()):
+            self._links[source][target].pop(via,None)
+        self._invalidate()
+
+    def remove_links_from(self,source):
+        """Remove all links leading directly from the given source."""
+        for (target,vias) in self._links.get(source,{}).iteritems():
+            for via in vias:
+                self._via_links[via].discard((source,target))
+                if not self._via_links[via]:
+                    del self._via_links[via]
+            vias.clear()
+        self._invalidate()
+
+    def _invalidate(self):
+        self._best_paths.clear()
+        self._best_links.clear()
 
     def get_versions(self,source):
         """List all versions reachable from the given source version."""
-        # TODO: be more efficient here
-        best_paths = self.get_best_paths(source)
+        best_paths = self._get_best_paths(source)
         return [k for (k,v) in best_paths.iteritems() if k and v]
 
     def get_best_path(self,source,target):
@@ -565,7 +2746,10 @@ class VersionGraph(object):
         This method returns a list of "via" links representing the lowest-cost
         path from source to target.
         """
-        return self.get_best_paths(source)[target]
+        path = self._get_best_paths(source)[target]
+        if path is not None:
+            path = list(path)
+        return path
 
     def get_best_paths(self,source):
         """Get the best path from source to every other version.
@@ -574,35 +2758,66 @@ class VersionGraph(object):
         Each entry gives the lowest-cost path from the given source version
         to that version.
         """
-        remaining = set(v for v in self._links)
-        best_costs = dict((v,_inf) for v in remaining)
-        best_paths = dict((v,None) for v in remaining)
+        best_paths = {}
+        for (v,path) in self._get_best_paths(source).iteritems():
+            if path is not None:
+                path = list(path)
+            best_paths[v] = path
+        return best_paths
+
+    def _get_best_paths(self,source):
+        """Get the (cached, shared) best paths from the given source."""
+        try:
+            return self._best_paths[source]
+        except KeyError:
+            pass
+        best_costs = {}
+        best_paths = dict((v,None) for v in self._links)
         best_costs[source] = 0
         best_paths[source] = []
         best_costs[""] = 0
         best_paths[""] = []
-        while remaining:
-            (cost,best) = sorted((best_costs[v],v) for v in remaining)[0]
-            if cost is _inf:
-                break
-            remaining.remove(best)
-            for v in self._links[best]:
+        #  Standard Dijkstra with lazy deletion from the heap.  Entries are
+        #  ordered by (cost,version) so ties are broken consistently.
+        queue = [(0,"")]
+        if source != "":
+            queue.append((0,source))
+        heapq.heapify(queue)
+        done = set()
+        while queue:
+            (cost,best) = heapq.heappop(queue)
+            if best in done:
+                continue
+            done.add(best)
+            for v in self._links.get(best,()):
+                if v in done:
+                    continue
                 (v_cost,v_link) = self._get_best_link(best,v)
-                if cost + v_cost < best_costs[v]:
+                if v_cost is _inf:
+                    continue
+                if cost + v_cost < best_costs.get(v,_inf):
                     best_costs[v] = cost + v_cost
                     best_paths[v] = best_paths[best] + [v_link]
+                    heapq.heappush(queue,(cost + v_cost,v))
+        self._best_paths[source] = best_paths
         return best_paths
                 
     def _get_best_link(self,source,target):
+        try:
+            return self._best_links[(source,target)]
+        except KeyError:
+            pass
         if source not in self._links:
             return (_inf,"")
         if target not in self._links[source]:
             return (_inf,"")
         vias = self._links[source][target]
         if not vias:
-            return (_inf,"")
-        vias = sorted((cost,via) for (via,cost) in vias.iteritems())
-        return vias[0]
+            best = (_inf,"")
+        else:
+            best = min((cost,via) for (via,cost) in vias.iteritems())
+        self._best_links[(source,target)] = best
+        return best
 
 
 class _Inf(object):
@@ -29,12 +29,16 @@ to calculate or apply patches from the command-line:
   python -m esky.patch diff <source> <target> <patch>
 
       generate a patch to transform <source> into <target>, and write it into
-      file <patch> (or stdout if not specified).
+      file <patch> (or stdout if not specified).  Pass "--jobs N" to diff
+      files using N worker processes; the output is identical to that of
+      a serial run.
 
   python -m esky.patch patch <source> <patch>
 
       transform <source> by applying the patches in the file <patch> (or
-      stdin if not specified.  The modifications are made in-place.
+      stdin if not specified.  The modifications are made in-place.  Pass
+      "--streaming" to bound memory use when applying large patches, or
+      "--jobs N" to patch files using N threads.
 
 To patch or diff zipfiles as though they were a directory, pass the "-z" or
 "--zipped" option on the command-line, e.g:
@@ -60,14 +64,22 @@ except NameError:
 
 import os
 import sys
+import stat
 import bz2
 import time
+import struct
+import binascii
 import shutil
 import hashlib
 import optparse
 import zipfile
 import tempfile
 import json
+import re
+import copy
+import multiprocessing
+import multiprocessing.pool
+from collections import deque
 if sys.version_info[0] < 3:
     try:
         from cStringIO import StringIO as BytesIO
@@ -186,32 +198,195 @@ class bsdiff4_py(object):
         bcontrol = bz2.decompress(patch[32:e_bcontrol])
         bdiff = bz2.decompress(patch[e_bcontrol:e_bdiff])
         bextra = bz2.decompress(patch[e_bdiff:])
-        #  Decode the control tuples 
-        tcontrol = []
-        for i in xrange(0,len(bcontrol),24):
-            tcontrol.append((
-                _decode_offt(bcontrol[i:i+8]),
-                _decode_offt(bcontrol[i+8:i+16]),
-                _decode_offt(bcontrol[i+16:i+24]),
-            ))
         #  Actually do the patching.
-        #  This is the bdiff4 patch algorithm in slow, pure python.
-        source = BytesIO(source)
-        result = BytesIO()
-        bdiff = BytesIO(bdiff)
-        bextra = BytesIO(bextra)
-        for (x,y,z) in tcontrol:
-            diff_data = bdiff.read(x)
-            orig_data = source.read(x)
-            if sys.version_info[0] < 3:
-                for i in xrange(len(diff_data)):
-                    result.write(chr((ord(diff_data[i])+ord(orig_data[i]))%256))
+        #  This is the bsdiff4 patch algorithm in pure python, but the
+        #  bytewise addition of diff and source data is done in bulk.
+        result = []
+        spos = dpos = epos = 0
+        control = _decode_offts(bcontrol)
+        for i in xrange(0,len(control),3):
+            (x,y,z) = control[i:i+3]
+            if x:
+                orig_data = source[spos:spos+x]
+                diff_data = bdiff[dpos:dpos+x]
+                if len(orig_data) != x or len(diff_data) != x:
+                    raise PatchError("corrupted bsdiff4 patch")
+                result.append(_add_bytes(diff_data,orig_data))
+            result.append(bextra[epos:epos+y])
+            spos += x + z
+            dpos += x
+            epos += y
+        return "".encode("ascii").join(result)
+
+    @staticmethod
+    def patch_stream(source,size,patch,target):
+        """Apply a bsdiff4 patch between file-like objects.
+
+        This patches the next 'size' bytes of the file 'source' using the
+        bsdiff4 data read from the file 'patch', and writes the result into
+        the file 'target'.  Both 'source' and 'patch' must be seekable.  The
+        control, diff and extra blocks are decompressed incrementally and
+        applied in chunks of at most _ADD_CHUNK_SIZE bytes, so the memory
+        used doesn't grow with the size of the file.
+        """
+        sbase = source.tell()
+        source.seek(0,2)
+        if source.tell() - sbase < size:
+            raise PatchError("insufficient source data")
+        pbase = patch.tell()
+        patch.seek(0,2)
+        pend = patch.tell()
+        patch.seek(pbase)
+        header = patch.read(32)
+        if len(header) != 32 or header[:8] != "BSDIFF40".encode("ascii"):
+            raise PatchError("corrupted bsdiff4 patch")
+        #  Read the length headers
+        l_bcontrol = _decode_offt(header[8:16])
+        l_bdiff = _decode_offt(header[16:24])
+        l_target = _decode_offt(header[24:32])
+        #  Set up readers for the three data blocks
+        e_bcontrol = pbase + 32 + l_bcontrol
+        e_bdiff = e_bcontrol + l_bdiff
+        bcontrol = _BZ2SectionReader(patch,pbase + 32,e_bcontrol)
+        bdiff = _BZ2SectionReader(patch,e_bcontrol,e_bdiff)
+        bextra = _BZ2SectionReader(patch,e_bdiff,pend)
+        #  Actually do the patching, one buffer-sized chunk at a time.
+        spos = tpos = 0
+        while tpos < l_target:
+            (x,y,z) = _decode_offts(bcontrol.read(24))
+            if x:
+                if spos < 0 or spos + x > size or tpos + x > l_target:
+                    raise PatchError("corrupted bsdiff4 patch")
+                source.seek(sbase + spos)
+                while x > 0:
+                    n = min(x,_ADD_CHUNK_SIZE)
+                    orig_data = source.read(n)
+                    if len(orig_data) != n:
+                        raise PatchError("insufficient source data")
+                    target.write(_add_bytes(bdiff.read(n),orig_data))
+                    spos += n
+                    tpos += n
+                    x -= n
+            if tpos + y > l_target:
+                raise PatchError("corrupted bsdiff4 patch")
+            while y > 0:
+                n = min(y,_ADD_CHUNK_SIZE)
+                target.write(bextra.read(n))
+                tpos += n
+                y -= n
+            spos += z
+        source.seek(sbase + size)
+
+
+class _BZ2SectionReader(object):
+    """Incrementally decompress a bz2-compressed section of a file.
+
+    Several of these can read from different sections of the same file,
+    since each one seeks to its own position before reading.  Compressed
+    data is fed to the decompressor in small chunks, which are only
+    decompressed as needed; the data buffered at any one time is at most
+    the size of the current read plus the output of one such chunk.
+    """
+
+    def __init__(self,fileobj,start,end):
+        self.fileobj = fileobj
+        self.pos = start
+        self.end = end
+        self._decompressor = bz2.BZ2Decompressor()
+        #  Decompressed chunks not yet read, and the offset of the
+        #  first unread byte in the first of them.
+        self._chunks = deque()
+        self._offset = 0
+        self._buffered = 0
+
+    def read(self,size):
+        """Read exactly 'size' bytes of decompressed data."""
+        while self._buffered < size:
+            if self.pos >= self.end:
+                raise PatchError("corrupted bsdiff4 patch")
+            self.fileobj.seek(self.pos)
+            data = self.fileobj.read(min(self.end - self.pos,1024*8))
+            if not data:
+                raise PatchError("corrupted bsdiff4 patch")
+            self.pos += len(data)
+            try:
+                data = self._decompressor.decompress(data)
+            except EOFError:
+                #  Don't let this escape, the Patcher uses it to stop.
+                raise PatchError("corrupted bsdiff4 patch")
+            if data:
+                self._chunks.append(data)
+                self._buffered += len(data)
+        result = []
+        needed = size
+        while needed:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._offset
+            if available <= needed:
+                if self._offset:
+                    chunk = chunk[self._offset:]
+                result.append(chunk)
+                self._chunks.popleft()
+                self._offset = 0
+                needed -= available
             else:
-                for i in xrange(len(diff_data)):
-                    result.write(bytes([(diff_data[i]+orig_data[i])%256]))
-            result.write(bextra.read(y))
-            source.seek(z,os.SEEK_CUR)
-        return result.getvalue()
+                result.append(chunk[self._offset:self._offset + needed])
+                self._offset += needed
+                needed = 0
+        self._buffered -= size
+        return "".encode("ascii").join(result)
+
+
+#  Helpers for the pure-python bsdiff4 patch.  Bytewise addition modulo 256
+#  is done without per-byte python code by treating a whole chunk of data as
+#  a big integer, and adding the low seven bits of each byte in parallel.
+#  The high bits can then be combined with xor, since any carry out of them
+#  would be discarded anyway.
+
+_ADD_CHUNK_SIZE = 1024 * 256
+_ADD_MASKS = {}
+
+if sys.version_info[0] > 2:
+    def _bytes_to_int(data):
+        return int.from_bytes(data,"big")
+    def _int_to_bytes(x,n):
+        return x.to_bytes(n,"big")
+else:
+    def _bytes_to_int(data):
+        return int(binascii.hexlify(data),16)
+    def _int_to_bytes(x,n):
+        return binascii.unhexlify("%0*x" % (2*n,x))
+
+
+def _add_bytes(data1,data2):
+    """Add two equal-length bytestrings bytewise, modulo 256."""
+    result = []
+    for i in xrange(0,len(data1),_ADD_CHUNK_SIZE):
+        chunk1 = data1[i:i+_ADD_CHUNK_SIZE]
+        chunk2 = data2[i:i+_ADD_CHUNK_SIZE]
+        n = len(chunk1)
+        try:
+            (low,high) = _ADD_MASKS[n]
+        except KeyError:
+            low = _bytes_to_int("\x7f".encode("ascii") * n)
+            high = low ^ ((1 << (8*n)) - 1)
+            if n == _ADD_CHUNK_SIZE:
+                _ADD_MASKS[n] = (low,high)
+        x = _bytes_to_int(chunk1)
+        y = _bytes_to_int(chunk2)
+        result.append(_int_to_bytes(((x & low) + (y & low)) ^ ((x ^ y) & high),n))
+    return "".encode("ascii").join(result)
+
+
+def _decode_offts(data):
+    """Decode a string of packed off_t values into a list of integers."""
+    values = list(struct.unpack("<%dQ" % (len(data)//8,),data))
+    for (i,x) in enumerate(values):
+        if x & _OFFT_SIGN:
+            values[i] = -(x & ~_OFFT_SIGN)
+    return values
+
+_OFFT_SIGN = 1 << 63
 
 
 if bsdiff4_native is not None:
@@ -227,23 +402,50 @@ else:
 #  memory use (and bsdiff is a memory hog at the best of times...)
 DIFF_WINDOW_SIZE = 1024 * 1024 * 4
 
+#  Size and number of the fingerprints sampled from each block of a target
+#  file, used to find the best-matching region of the source file to diff
+#  against.  This makes patch size insensitive to insertions and deletions.
+ANCHOR_SIZE = 32
+ANCHOR_COUNT = 16
+
+#  New files smaller than this are never copied from elsewhere in the source
+#  tree, since the copy command would cost about as much as the data.
+COPY_SOURCE_MIN_SIZE = 512
+
 #  Highest patch version that can be processed by this module.
-HIGHEST_VERSION = 1
+#  Version 2 added the COPY_FROM_ROOT and PF_ZIP_MEMBERS commands; patches
+#  that don't use them are still written as version 1.
+HIGHEST_VERSION = 2
 
 #  Header bytes included in the patch file
 PATCH_HEADER = "ESKYPTCH".encode("ascii")
 
+#  Patches may begin by verifying the digest of the source they apply to,
+#  with the commands SET_PATH("") VERIFY_MD5(digest).  This is the number of
+#  bytes needed to read that digest from the start of a patch.
+PATCH_BASE_DIGEST_SIZE = len(PATCH_HEADER) + 4 + 16
+
 #  Filename of the esky_filelist manifest file.
 #  esky_filelist lists all the files in the project
 ESKY_FILELIST = "esky_filelist.txt"
 
+#  Filename of the digest cache, stored alongside the esky_filelist.
+#  It remembers file digests so that unchanged files need not be re-read.
+ESKY_DIGEST_CACHE = "esky_digests.json"
+
+#  Files modified more recently than this many seconds ago are not entered
+#  into the digest cache, since a further modification might not change
+#  their mtime on filesystems with coarse timestamps.
+DIGEST_CACHE_RACY_TIME = 2
+
 
 from esky.errors import Error
 from esky.util import extract_zipfile, create_zipfile, deep_extract_zipfile,\
-                      zipfile_common_prefix_dir, really_rmtree, really_rename
+                      zipfile_common_prefix_dir, really_rmtree, really_rename,\
+                      clone_file
 
 __all__ = ["PatchError","DiffError","main","write_patch","apply_patch",
-           "Differ","Patcher"]
+           "read_base_digest","Differ","Patcher"]
 
 
 
@@ -282,12 +484,29 @@ _COMMANDS = [
  "PF_BSDIFF4",    # PF_BSDIFF4(n,p):     patch file; bsdiff4 from n input bytes
  "PF_REC_ZIP",    # PF_REC_ZIP(m,cs):    patch file; recurse into zipfile
  "CHMOD",         # CHMOD(mode):         set mode of current target
+ "COPY_FROM_ROOT",# COPY_FROM_ROOT(path): copy item at root-relative path
+ "PF_ZIP_MEMBERS",# PF_ZIP_MEMBERS(m,ms): patch file; patch zipfile members
 ]
 
 # Make commands available as global variables
 for i,cmd in enumerate(_COMMANDS):
     globals()[cmd] = i
 
+#  Argument types of the PF_* commands that depend only on the file being
+#  patched.  A block of these can be read ahead and applied independently
+#  of the rest of the patch, which is what parallel patching does.
+_PF_COMMAND_ARGS = {
+    PF_COPY: ("int",),
+    PF_SKIP: ("int",),
+    PF_INS_RAW: ("bytes",),
+    PF_INS_BZ2: ("bytes",),
+    PF_BSDIFF4: ("int","bytes",),
+}
+
+#  Commands that only manipulate the current path, and so needn't wait
+#  for pending parallel patching jobs.
+_PATH_COMMANDS = (SET_PATH,JOIN_PATH,POP_PATH,POP_JOIN_PATH,)
+
 
 def apply_patch(target,stream,**kwds):
     """Apply patch commands from the given stream to the given target.
@@ -306,10 +525,61 @@ def write_patch(source,target,stream,**kwds):
     an object supporting the write() method.  Patch protocol commands to
     transform 'source' into 'target' will be generated and written sequentially
     to the stream.
+
+    If the keyword argument 'workers' is greater than one, individual files
+    are diffed in a pool of that many worker processes.  The patch written
+    is identical to that produced by a serial run.
+
+    If the keyword argument 'zip_members' is true, zipfiles are diffed
+    member by member using the PF_ZIP_MEMBERS command.  Such patches need
+    version 2 of the patch protocol, so it is off by default.
+
+    If the keyword argument 'copy_from_root' is true, files that have moved
+    between directories are copied from their old location using the
+    COPY_FROM_ROOT command.  This also needs version 2 of the patch protocol,
+    so by default only files in the corresponding source directory are used.
+
+    If the keyword argument 'base_digest' is true, the patch begins by
+    verifying the digest of the source, so that clients can check whether
+    it applies before downloading it (see read_base_digest).  This makes the
+    patch fail on sources with extra files not listed in their filelist,
+    so it is off by default.
     """
     Differ(stream,**kwds).diff(source,target)
 
 
+def read_base_digest(stream):
+    """Read the digest of the source that a patch applies to.
+
+    'stream' must be an object supporting the read() method, positioned at
+    the start of the patch; at most PATCH_BASE_DIGEST_SIZE bytes are read.
+    The md5 digest of the source, as calculated by calculate_patch_digest(),
+    is returned.  If the patch doesn't begin by verifying its source (e.g.
+    because it was generated without the 'base_digest' option) then None
+    is returned.
+    """
+    data = stream.read(PATCH_BASE_DIGEST_SIZE)
+    if not data.startswith(PATCH_HEADER):
+        raise PatchError("not an esky patch file")
+    preamble = BytesIO(data[len(PATCH_HEADER):])
+    try:
+        version = _read_vint(preamble)
+        if version > HIGHEST_VERSION:
+            return None
+        if _read_vint(preamble) != SET_PATH:
+            return None
+        if _read_vint(preamble) != 0:
+            return None
+        if _read_vint(preamble) != VERIFY_MD5:
+            return None
+    except EOFError:
+        return None
+    digest = preamble.read(16)
+    if len(digest) != 16:
+        return None
+    return digest
+
+
 def _read_vint(stream):
     """Read a vint-encoded integer from the given stream."""
     b = stream.read(1)
@@ -329,6 +599,81 @@ def _read_vint(stream):
     x += (b << e)
     return x
 
+class _CommandReader(object):
+    """Buffered reader for a stream of patch commands.
+
+    Parsing vints straight from the stream means a separate read() call for
+    every byte, which is painfully slow on an unbuffered file or a pipe.
+    This reads the stream in large chunks and parses vints, lengths and
+    paths out of an in-memory buffer instead.  Since it reads ahead, the
+    position of the underlying stream is undefined once it has been used.
+    """
+
+    def __init__(self,stream,bufsize=1024*64):
+        self.stream = stream
+        self.bufsize = bufsize
+        #  Prefer read1() where available, so we don't block on a pipe
+        #  waiting for more data than has been written so far.
+        self._read_chunk = getattr(stream,"read1",stream.read)
+        self._buffer = "".encode("ascii")
+        self._pos = 0
+
+    def _fill(self):
+        """Read more data into the buffer, returning False at EOF."""
+        data = self._read_chunk(self.bufsize)
+        if not data:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def read(self,size):
+        """Read up to 'size' bytes, returning fewer only at EOF."""
+        pos = self._pos
+        if pos + size <= len(self._buffer):
+            self._pos = pos + size
+            return self._buffer[pos:pos+size]
+        chunks = [self._buffer[pos:]]
+        size -= len(chunks[0])
+        self._buffer = "".encode("ascii")
+        self._pos = 0
+        while size > 0:
+            data = self.stream.read(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return "".encode("ascii").join(chunks)
+
+    def read_vint(self):
+        """Read a vint-encoded integer."""
+        #  Fast path for single-byte vints, which covers all commands.
+        pos = self._pos
+        if pos < len(self._buffer):
+            b = _byte_ord(self._buffer[pos])
+            if b < 128:
+                self._pos = pos + 1
+                return b
+        x = e = 0
+        while True:
+            if self._pos >= len(self._buffer):
+                if not self._fill():
+                    raise EOFError
+            b = _byte_ord(self._buffer[self._pos])
+            self._pos += 1
+            if b < 128:
+                return x + (b << e)
+            x += (b - 128) << e
+            e += 7
+
+
+if sys.version_info[0] > 2:
+    def _byte_ord(b):
+        return b
+else:
+    _byte_ord = ord
+
+
 if sys.version_info[0] > 2:
     def _write_vint(stream,x):
         """Write a vint-encoded integer to the given stream."""
@@ -364,20 +709,118 @@ def _write_zipfile_metadata(stream,zfin):
     zfout = zipfile.ZipFile(stream,"w")
     try:
         for zinfo in zfin.infolist():
-            zfout.writestr(zinfo,"")
+            #  Copy it, since writestr() modifies the zinfo in-place.
+            zfout.writestr(copy.copy(zinfo),"")
     finally:
         zfout.close()
 
 
+def _zip_member_raw_range(zf,zinfo):
+    """Find the raw bytes of a zipfile member, for copying verbatim.
+
+    This returns a tuple (offset,length) spanning the member's local header
+    and compressed data, or None if the member can't safely be copied as raw
+    bytes (e.g. it is encrypted, has a trailing data descriptor, or needs
+    zip64 extensions).
+    """
+    if zinfo.flag_bits & 0x09:
+        return None
+    limit = zipfile.ZIP64_LIMIT
+    if max(zinfo.file_size,zinfo.compress_size,zinfo.header_offset) >= limit:
+        return None
+    zf.fp.seek(zinfo.header_offset)
+    header = zf.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        return None
+    fields = struct.unpack(zipfile.structFileHeader,header)
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        return None
+    length = zipfile.sizeFileHeader
+    length += fields[zipfile._FH_FILENAME_LENGTH]
+    length += fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+    length += zinfo.compress_size
+    return (zinfo.header_offset,length)
+
+
+def _zip_members_differ(zf1,zinfo1,zf2,zinfo2):
+    """Check whether the raw bytes of two zipfile members differ.
+
+    Members that can't be copied as raw bytes are always considered to
+    differ.
+    """
+    range1 = _zip_member_raw_range(zf1,zinfo1)
+    range2 = _zip_member_raw_range(zf2,zinfo2)
+    if range1 is None or range2 is None or range1[1] != range2[1]:
+        return True
+    (offset1,offset2) = (range1[0],range2[0])
+    size = range1[1]
+    while size > 0:
+        n = min(size,1024*16)
+        zf1.fp.seek(offset1)
+        zf2.fp.seek(offset2)
+        if zf1.fp.read(n) != zf2.fp.read(n):
+            return True
+        offset1 += n
+        offset2 += n
+        size -= n
+    return False
+
+
+def _copy_zip_member_data(zf,zinfo,outfile):
+    """Copy the uncompressed data of a zipfile member into a file."""
+    zf_member = zf.open(zinfo)
+    try:
+        shutil.copyfileobj(zf_member,outfile,1024*16)
+    finally:
+        zf_member.close()
+
+
+def _copy_zip_member_raw(s_zf,t_zf,zinfo):
+    """Copy a member's local header and compressed data between zipfiles.
+
+    The data is copied without decompression from the member of the same
+    name in 's_zf', and added to 't_zf' using 'zinfo' as its metadata.
+    """
+    try:
+        s_info = s_zf.getinfo(zinfo.filename)
+    except KeyError:
+        raise PatchError("missing zip member: %s" % (zinfo.filename,))
+    raw_range = _zip_member_raw_range(s_zf,s_info)
+    if raw_range is None or s_info.compress_type != zinfo.compress_type:
+        raise PatchError("can't copy zip member: %s" % (zinfo.filename,))
+    zinfo.CRC = s_info.CRC
+    zinfo.compress_size = s_info.compress_size
+    zinfo.file_size = s_info.file_size
+    zinfo.header_offset = t_zf.fp.tell()
+    (offset,size) = raw_range
+    while size > 0:
+        s_zf.fp.seek(offset)
+        data = s_zf.fp.read(min(size,1024*16))
+        if not data:
+            raise PatchError("truncated zip member: %s" % (zinfo.filename,))
+        t_zf.fp.write(data)
+        offset += len(data)
+        size -= len(data)
+    t_zf.filelist.append(zinfo)
+    t_zf.NameToInfo[zinfo.filename] = zinfo
+    t_zf._didModify = True
+    if hasattr(t_zf,"start_dir"):
+        t_zf.start_dir = t_zf.fp.tell()
+
+
 def paths_differ(path1,path2):
     """Check whether two paths differ."""
     if os.path.isdir(path1):
         if not os.path.isdir(path2):
             return True
         for nm in os.listdir(path1):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
             if paths_differ(os.path.join(path1,nm),os.path.join(path2,nm)):
                 return True
         for nm in os.listdir(path2):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
             if not os.path.exists(os.path.join(path1,nm)):
                 return True
     elif os.path.isfile(path1):
@@ -411,6 +854,8 @@ def calculate_digest(target,hash=hashlib.md5):
     d = hash()
     if os.path.isdir(target):
         for nm in sorted(os.listdir(target)):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
             d.update(nm.encode("utf8"))
             d.update(calculate_digest(os.path.join(target,nm)))
     else:
@@ -422,31 +867,153 @@ def calculate_digest(target,hash=hashlib.md5):
     return d.digest()
 
 
-def calculate_patch_digest(target, hash=hashlib.md5):
+def calculate_patch_digest(target, hash=hashlib.md5, filelist_file=None,
+                           update_cache=True):
     """Calculate the digest of the entire project based on the files listed
     in the esky_filelist. This will ensure that patches don't break if any
-    superfluous files have been added to the application folder"""
-    filelist = load_filelist(target)
-    if filelist is None:
+    superfluous files have been added to the application folder.
+
+    File digests are remembered in a cache stored next to the filelist, so
+    that files that haven't changed since the last call are not re-read.
+    If 'update_cache' is false an existing cache is used but never written,
+    for trees that esky doesn't own.  If 'filelist_file' is given it is used
+    instead of searching the target for a filelist, e.g. when the target
+    holds several versions."""
+    if filelist_file is None:
+        filelist_file = find_filelist(target)
+    if filelist_file is None:
         # No filelist found, fall back to hashing entire directory
         return calculate_digest(target, hash)
+    filelist = _read_filelist(filelist_file)
+    cache = _DigestCache(os.path.dirname(filelist_file), hash)
     d = hash()
     for f in filelist:
         file_path = os.path.join(target, f)
         d.update(os.path.basename(file_path).encode("utf8"))
-        d.update(calculate_digest(file_path, hash))
+        d.update(cache.get_digest(file_path))
+    if update_cache:
+        cache.save()
     return d.digest()
 
 
+def calculate_file_digests(control_dir, paths, hash=hashlib.md5,
+                           update_cache=True):
+    """Calculate the digests of the given files, using a digest cache.
+
+    The cache is the one kept in the given esky control directory, as used
+    by calculate_patch_digest(); files that haven't changed since they were
+    last hashed are not re-read.  If 'update_cache' is false the cache is
+    never written.  A list of digests is returned, in the same order as the
+    given paths."""
+    cache = _DigestCache(control_dir, hash)
+    #  Only some of the files may be hashed, so keep the other entries.
+    cache.new_entries.update(cache.entries)
+    digests = [cache.get_digest(path) for path in paths]
+    if update_cache:
+        cache.save()
+    return digests
+
+
+def find_filelist(root):
+    '''locates the esky file list, returning its path or None if not found.
+
+    The search is breadth-first, so the filelist of a version directory is
+    found without walking the entire tree beneath it.'''
+    if not os.path.isdir(root):
+        return None
+    dirs = [root]
+    while dirs:
+        subdirs = []
+        for path in dirs:
+            file_path = os.path.join(path, ESKY_FILELIST)
+            if os.path.isfile(file_path):
+                return file_path
+            for nm in sorted(os.listdir(path)):
+                subdir = os.path.join(path, nm)
+                if os.path.isdir(subdir) and not os.path.islink(subdir):
+                    subdirs.append(subdir)
+        dirs = subdirs
+    return None
+
+
 def load_filelist(root):
     '''locates the esky file list, reads it and returns it as a sorted list'''
-    for path, dirs, files in os.walk(root):
-        for f in files:
-            if f == ESKY_FILELIST:
-                file_path = os.path.join(path, f)
-                with open(file_path) as list_file:
-                    filelist = json.loads(list_file.read())
-                    return sorted(filelist)
+    filelist_file = find_filelist(root)
+    if filelist_file is not None:
+        return _read_filelist(filelist_file)
+
+
+def _read_filelist(file_path):
+    with open(file_path) as list_file:
+        filelist = json.loads(list_file.read())
+        return sorted(filelist)
+
+
+class _DigestCache(object):
+    """Persistent cache of file digests, kept in an esky control directory.
+
+    Entries are keyed by path relative to the directory containing the
+    control directory, so they survive the version dir being renamed.  An
+    entry is used only while the file's size, mtime and inode are unchanged.
+    """
+
+    def __init__(self,control_dir,hash=hashlib.md5):
+        self.path = os.path.join(control_dir,ESKY_DIGEST_CACHE)
+        self.root = os.path.dirname(control_dir)
+        self.hash = hash
+        self.hash_name = hash().name
+        self.entries = {}
+        self.new_entries = {}
+        try:
+            with open(self.path,"rb") as f:
+                data = json.loads(f.read().decode("utf8"))
+        except (EnvironmentError,ValueError):
+            pass
+        else:
+            if isinstance(data,dict) and data.get("hash") == self.hash_name:
+                self.entries = data.get("files",{})
+
+    def get_digest(self,path):
+        """Get the digest of the given path, from the cache if possible."""
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            return calculate_digest(path,self.hash)
+        key = os.path.relpath(path,self.root).replace(os.sep,"/")
+        mtime = getattr(st,"st_mtime_ns",None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        stamp = [st.st_size,mtime,st.st_ino]
+        entry = self.entries.get(key)
+        if entry is not None and entry[:3] == stamp:
+            digest = binascii.unhexlify(entry[3].encode("ascii"))
+        else:
+            digest = calculate_digest(path,self.hash)
+        if st.st_mtime < time.time() - DIGEST_CACHE_RACY_TIME:
+            hexdigest = binascii.hexlify(digest).decode("ascii")
+            self.new_entries[key] = stamp + [hexdigest]
+        return digest
+
+    def save(self):
+        """Write the cache back to disk, if it has changed.
+
+        The cache is only an optimisation, so failure to write it (e.g.
+        because the version dir is read-only) is silently ignored.
+        """
+        if self.new_entries == self.entries:
+            return
+        data = json.dumps({"hash":self.hash_name,"files":self.new_entries})
+        tmp_path = self.path + ".new"
+        try:
+            with open(tmp_path,"wb") as f:
+                f.write(data.encode("utf8"))
+            if sys.platform == "win32" and os.path.exists(self.path):
+                os.unlink(self.path)
+            really_rename(tmp_path,self.path)
+        except EnvironmentError:
+            try:
+                os.unlink(tmp_path)
+            except EnvironmentError:
+                pass
 
 
 class Patcher(object):
@@ -455,19 +1022,40 @@ class Patcher(object):
     Instances of this class can be used to apply a sequence of patch commands
     to a target file or directory.  You can think of it as a little automaton
     that edits a directory in-situ.
+
+    If 'streaming' is true then bsdiff4 patches are applied incrementally,
+    so that memory use is bounded by a small fixed-size buffer rather than
+    growing with the diff window size.  This is slower than handing the
+    whole window to bsdiff4 at once, so it is off by default.
+
+    If 'workers' is greater than one, the PF_* commands for each file are
+    read ahead and applied in a pool of that many threads.  Commands that
+    change the directory structure wait for all pending files to finish.
     """
 
-    def __init__(self,target,commands,dry_run=False):
+    streaming = False
+    workers = None
+
+    def __init__(self,target,commands,dry_run=False,streaming=None,
+                 workers=None):
         target = os.path.abspath(target)
         self.target = target
         self.new_target = None
+        if commands is not None and not isinstance(commands,_CommandReader):
+            commands = _CommandReader(commands)
         self.commands = commands
         self.root_dir = self.target
         self.infile = None
         self.outfile = None
         self.dry_run = dry_run
-        self._workdir = tempfile.mkdtemp()
+        if streaming is not None:
+            self.streaming = streaming
+        if workers is not None:
+            self.workers = workers
+        self._workdir = None
         self._context_stack = []
+        self._pool = None
+        self._jobs = deque()
 
     def __del__(self):
         if self.infile:
@@ -477,27 +1065,33 @@ class Patcher(object):
         if self._workdir and shutil:
             really_rmtree(self._workdir)
 
+    def _get_workdir(self):
+        """Get the temporary working directory, creating it if necessary."""
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp()
+        return self._workdir
+
     def _read(self,size):
         """Read the given number of bytes from the command stream."""
         return self.commands.read(size)
 
     def _read_int(self):
         """Read an integer from the command stream."""
-        i = _read_vint(self.commands)
+        i = self.commands.read_vint()
         if self.dry_run:
             print "  ", i
         return i
 
     def _read_command(self):
         """Read the next command to be processed."""
-        cmd = _read_vint(self.commands)
+        cmd = self.commands.read_vint()
         if self.dry_run:
             print _COMMANDS[cmd]
         return cmd
 
     def _read_bytes(self):
         """Read a bytestring from the command stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted bytestring")
@@ -505,9 +1099,25 @@ class Patcher(object):
             print "   [%s bytes]" % (len(bytes),)
         return bytes
 
+    def _iter_bytes(self):
+        """Iterate over a bytestring from the command stream, in chunks.
+
+        This is like _read_bytes() but never holds the whole bytestring
+        in memory at once.
+        """
+        l = self.commands.read_vint()
+        if self.dry_run:
+            print "   [%s bytes]" % (l,)
+        while l > 0:
+            bytes = self.commands.read(min(l,_ADD_CHUNK_SIZE))
+            if not bytes:
+                raise PatchError("corrupted bytestring")
+            l -= len(bytes)
+            yield bytes
+
     def _read_path(self):
         """Read a unicode path from the given stream."""
-        l = _read_vint(self.commands)
+        l = self.commands.read_vint()
         bytes = self.commands.read(l)
         if len(bytes) != l:
             raise PatchError("corrupted path")
@@ -601,7 +1211,7 @@ class Patcher(object):
             for root, dirs, files in os.walk(self.target):
                 dirname = os.path.join(dirname, root)
                 for f in files:
-                    if f == ESKY_FILELIST:
+                    if f in (ESKY_FILELIST,ESKY_DIGEST_CACHE):
                         continue
                     filepath = os.path.join(dirname, f)
                     relpath = os.path.relpath(filepath, self.target)
@@ -622,14 +1232,20 @@ class Patcher(object):
         version = self._read_int()
         if version > HIGHEST_VERSION:
             raise PatchError("esky patch version %d not supported"%(version,))
+        if self.workers and self.workers > 1 and not self.dry_run:
+            self._pool = multiprocessing.pool.ThreadPool(self.workers)
         try:
-            while True:
-                cmd = self._read_command()
-                getattr(self,"_do_" + _COMMANDS[cmd])()
+            self._run_commands()
         except EOFError:
+            self._wait_for_jobs()
             self._check_end_patch()
             self._cleanup_patch()
         finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+                self._jobs.clear()
             if self.infile:
                 self.infile.close()
                 self.infile = None
@@ -637,6 +1253,118 @@ class Patcher(object):
                 self.outfile.close()
                 self.outfile = None
 
+    def _run_commands(self):
+        """Main command loop, dispatching to the _do_<CMD> methods.
+
+        In parallel mode, a block of PF_* commands starting a new file is
+        read ahead and handed off to the thread pool.  Other commands first
+        wait for any pending jobs that they might interfere with.
+        """
+        cmd = self._read_command()
+        while True:
+            if self._pool is not None:
+                if cmd in _PF_COMMAND_ARGS and self.outfile is None:
+                    if not self._context_stack:
+                        cmd = self._dispatch_file_commands(cmd)
+                        continue
+                if self._jobs and cmd not in _PATH_COMMANDS:
+                    if cmd == CHMOD or _COMMANDS[cmd].startswith("PF_"):
+                        self._wait_for_jobs(self.target)
+                    else:
+                        self._wait_for_jobs()
+            getattr(self,"_do_" + _COMMANDS[cmd])()
+            cmd = self._read_command()
+
+    def _apply_commands(self,data):
+        """Apply a block of commands read ahead from the command stream."""
+        commands = self.commands
+        self.commands = _CommandReader(BytesIO(data))
+        try:
+            while True:
+                try:
+                    cmd = self._read_command()
+                except EOFError:
+                    break
+                getattr(self,"_do_" + _COMMANDS[cmd])()
+        finally:
+            self.commands = commands
+
+    def _dispatch_file_commands(self,cmd):
+        """Read ahead the PF_* commands for the current file, and apply them.
+
+        The block of commands is applied to the file in a pool thread.  The
+        next command following the block is returned.
+        """
+        target = self.target
+        self._check_path()
+        data = BytesIO()
+        try:
+            while cmd in _PF_COMMAND_ARGS:
+                _write_vint(data,cmd)
+                for argtype in _PF_COMMAND_ARGS[cmd]:
+                    n = self.commands.read_vint()
+                    _write_vint(data,n)
+                    if argtype == "bytes":
+                        while n > 0:
+                            bytes = self.commands.read(min(n,1024*64))
+                            if not bytes:
+                                raise PatchError("corrupted bytestring")
+                            data.write(bytes)
+                            n -= len(bytes)
+                cmd = self._read_command()
+        except EOFError:
+            cmd = None
+        self._wait_for_jobs(target)
+        if cmd in (PF_REC_ZIP,PF_ZIP_MEMBERS):
+            #  The rest of the file can't be processed independently, so
+            #  apply these commands here and leave the file open.
+            self._check_begin_patch()
+            self._apply_commands(data.getvalue())
+            return cmd
+        while len(self._jobs) >= self.workers * 4:
+            self._jobs.popleft()[1].get()
+        args = (target,data.getvalue())
+        self._jobs.append((target,self._pool.apply_async(self._patch_file,args)))
+        if cmd is None:
+            raise EOFError
+        return cmd
+
+    def _patch_file(self,target,data):
+        """Apply a block of PF_* commands to a single file.
+
+        This runs in a pool thread, using a separate Patcher object to hold
+        the state of the file being patched.
+        """
+        patcher = Patcher(target,None,streaming=self.streaming)
+        patcher.root_dir = self.root_dir
+        try:
+            patcher._apply_commands(data)
+            patcher._check_end_patch()
+        finally:
+            if patcher.infile:
+                patcher.infile.close()
+                patcher.infile = None
+            if patcher.outfile:
+                patcher.outfile.close()
+                patcher.outfile = None
+
+    def _wait_for_jobs(self,path=None):
+        """Wait for pending parallel patching jobs to complete.
+
+        If 'path' is given, only jobs patching that path or something
+        beneath it are waited for; otherwise all jobs are.  Any error
+        raised by a job is re-raised here.
+        """
+        if path is None:
+            while self._jobs:
+                self._jobs.popleft()[1].get()
+        else:
+            prefix = path + os.sep
+            for job in list(self._jobs):
+                if job[0] == path or job[0].startswith(prefix):
+                    self._jobs.remove(job)
+                    job[1].get()
+
     def _do_END(self):
         """Execute the END command.
 
@@ -749,15 +1477,36 @@ class Patcher(object):
         source_path = os.path.join(os.path.dirname(self.target),self._read_path())
         self._check_path(source_path)
         if not self.dry_run:
-            if os.path.exists(self.target):
-                if os.path.isdir(self.target):
-                    really_rmtree(self.target)
-                else:
-                    os.unlink(self.target)
-            if os.path.isfile(source_path):
-                shutil.copy2(source_path,self.target)
+            self._copy_from(source_path)
+
+    def _do_COPY_FROM_ROOT(self):
+        """Execute the COPY_FROM_ROOT command.
+
+        This reads a path from the command stream, and copies whatever is
+        at that path to the current target path.  The source path is
+        interpreted relative to the root directory, using forward slashes
+        as separators; this caters for files that have moved between
+        directories.
+        """
+        self._check_end_patch()
+        path = self._read_path()
+        source_path = os.path.join(self.root_dir,*path.split("/"))
+        source_path = os.path.normpath(source_path)
+        self._check_path(source_path)
+        if not self.dry_run:
+            self._copy_from(source_path)
+
+    def _copy_from(self,source_path):
+        """Copy the given path over the current target path."""
+        if os.path.exists(self.target):
+            if os.path.isdir(self.target):
+                really_rmtree(self.target)
             else:
-                shutil.copytree(source_path,self.target)
+                os.unlink(self.target)
+        if os.path.isfile(source_path):
+            clone_file(source_path,self.target,hardlink=False)
+        else:
+            shutil.copytree(source_path,self.target)
 
     def _do_MOVE_FROM(self):
         """Execute the MOVE_FROM command.
@@ -821,12 +1570,18 @@ class Patcher(object):
 
         This generates new data for the file currently being patched.  It
         reads a bytestring from the command stream, decompresses it using
-        bz2 and and write the result into the target file.
+        bz2 and and write the result into the target file.  Decompression
+        is done incrementally as the bytestring is read.
         """
         self._check_begin_patch()
-        data = bz2.decompress(self._read_bytes())
-        if not self.dry_run:
-            self.outfile.write(data)
+        decompressor = bz2.BZ2Decompressor()
+        for bytes in self._iter_bytes():
+            try:
+                data = decompressor.decompress(bytes)
+            except EOFError:
+                raise PatchError("corrupted bz2 data")
+            if not self.dry_run:
+                self.outfile.write(data)
 
     def _do_PF_BSDIFF4(self):
         """Execute the PF_BSDIFF4 command.
@@ -835,9 +1590,24 @@ class Patcher(object):
         the command stream.  It then reads N bytes from the source file,
         applies the patch to these bytes, and writes the result into the
         target file.
+
+        In streaming mode the patch bytestring is spooled to a temporary
+        file and applied incrementally from there.
         """
         self._check_begin_patch()
         n = self._read_int()
+        if self.streaming and not self.dry_run:
+            with tempfile.SpooledTemporaryFile(1024*1024) as patch:
+                # Restore the standard bsdiff header bytes
+                patch.write("BSDIFF40".encode("ascii"))
+                for bytes in self._iter_bytes():
+                    patch.write(bytes)
+                patch.seek(0)
+                try:
+                    bsdiff4_py.patch_stream(self.infile,n,patch,self.outfile)
+                except PatchError, e:
+                    raise PatchError("%s in %s" % (e,self.target,))
+            return
         # Restore the standard bsdiff header bytes
         patch = "BSDIFF40".encode("ascii") + self._read_bytes()
         if not self.dry_run:
@@ -859,7 +1629,8 @@ class Patcher(object):
         """
         self._check_begin_patch()
         if not self.dry_run:
-            workdir = os.path.join(self._workdir,str(len(self._context_stack)))
+            workdir = os.path.join(self._get_workdir(),
+                                   str(len(self._context_stack)))
             os.mkdir(workdir)
             t_temp = os.path.join(workdir,"contents")
             m_temp = os.path.join(workdir,"meta")
@@ -898,15 +1669,147 @@ class Patcher(object):
             self.root_dir = workdir
             self.target = m_temp
 
+    def _do_PF_ZIP_MEMBERS(self):
+        """Execute the PF_ZIP_MEMBERS command.
+
+        This patches the current target by treating it as a zipfile and
+        patching its members one at a time, without extracting the whole
+        thing to a temp directory.
+
+        This command expects two END-terminated blocks of sub-commands.  The
+        first block patches the zipfile metadata, exactly as for PF_REC_ZIP.
+        The second block has one entry for each member of the new zipfile,
+        in order.  An entry is either COPY_FROM(name), which copies the raw
+        compressed member from the old zipfile, or SET_PATH(name) followed
+        by PF_* commands that generate the member data from the old member
+        of that name.
+        """
+        self._check_begin_patch()
+        if not self.dry_run:
+            workdir = os.path.join(self._get_workdir(),
+                                   str(len(self._context_stack)))
+            os.mkdir(workdir)
+            m_temp = os.path.join(workdir,"meta")
+        cur_state = self._blank_state()
+        #  Once the metadata is patched, we process the member entries.
+        def end_metadata():
+            self._restore_state(cur_state)
+            if self.dry_run:
+                self._patch_zip_members(None,None,None)
+            else:
+                zfmeta = _read_zipfile_metadata(m_temp)
+                try:
+                    s_zf = zipfile.ZipFile(self.target,"r")
+                    try:
+                        t_zf = zipfile.ZipFile(self.outfile,"w")
+                        try:
+                            members = zfmeta.infolist()
+                            self._patch_zip_members(s_zf,t_zf,members)
+                        finally:
+                            t_zf.close()
+                    finally:
+                        s_zf.close()
+                finally:
+                    zfmeta.close()
+                really_rmtree(workdir)
+        self._context_stack.append(end_metadata)
+        if not self.dry_run:
+            #  Begin by writing the current zipfile metadata to a temp file.
+            #  This will be patched, then end_metadata() will be called.
+            with open(m_temp,"wb") as f:
+                zf = zipfile.ZipFile(self.target)
+                try:
+                    _write_zipfile_metadata(f,zf)
+                finally:
+                    zf.close()
+            self.root_dir = workdir
+            self.target = m_temp
+
+    def _patch_zip_members(self,s_zf,t_zf,members):
+        """Process the member entries of a PF_ZIP_MEMBERS command.
+
+        Each patched member is generated from a copy of the old member data
+        into an in-memory buffer, then written into the new zipfile.
+        """
+        state = self._save_state()
+        member = None
+        index = 0
+        try:
+            while True:
+                cmd = self._read_command()
+                if _COMMANDS[cmd].startswith("PF_"):
+                    if member is None or cmd in (PF_REC_ZIP,PF_ZIP_MEMBERS):
+                        raise PatchError("unexpected command in zip members")
+                    getattr(self,"_do_" + _COMMANDS[cmd])()
+                    continue
+                if member is not None:
+                    if not self.dry_run:
+                        t_zf.writestr(member,self.outfile.getvalue())
+                        self.infile.close()
+                    member = None
+                if cmd == END:
+                    break
+                if cmd not in (COPY_FROM,SET_PATH):
+                    raise PatchError("unexpected command in zip members")
+                name = self._read_path()
+                if self.dry_run:
+                    if cmd == SET_PATH:
+                        member = name
+                    continue
+                if index >= len(members) or members[index].filename != name:
+                    raise PatchError("zip member out of order: %s" % (name,))
+                zinfo = members[index]
+                index += 1
+                if cmd == COPY_FROM:
+                    _copy_zip_member_raw(s_zf,t_zf,zinfo)
+                else:
+                    member = zinfo
+                    self.infile = self._open_zip_member(s_zf,name)
+                    self.outfile = BytesIO()
+            if not self.dry_run and index != len(members):
+                raise PatchError("missing zip members in %s" % (self.target,))
+        finally:
+            if member is not None and not self.dry_run:
+                self.infile.close()
+            self._restore_state(state)
+
+    def _open_zip_member(self,zf,name):
+        """Open a seekable copy of the data for the named zipfile member.
+
+        If there is no such member, an empty file is returned.
+        """
+        try:
+            zinfo = zf.getinfo(name)
+        except KeyError:
+            return BytesIO("".encode("ascii"))
+        f = tempfile.SpooledTemporaryFile(1024*1024)
+        try:
+            _copy_zip_member_data(zf,zinfo,f)
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        return f
+
     def _do_CHMOD(self):
         """Execute the CHMOD command.
 
         This reads an integer from the command stream, and sets the mode
-        of the current target to that integer.
+        of the current target to that integer.  If the target is hardlinked
+        elsewhere it is first replaced with a private copy, so that the mode
+        of the other links is not changed.
         """
         self._check_end_patch()
         mod = self._read_int()
         if not self.dry_run:
+            if os.path.isfile(self.target):
+                if os.stat(self.target).st_nlink > 1:
+                    new_target = self.target + ".new"
+                    while os.path.exists(new_target):
+                        new_target += ".new"
+                    clone_file(self.target,new_target,hardlink=False)
+                    os.unlink(self.target)
+                    really_rename(new_target,self.target)
             os.chmod(self.target,mod)
 
 
@@ -917,12 +1820,28 @@ class Differ(object):
     commands to transform one file/directory into another.
     """
 
-    def __init__(self,outfile,diff_window_size=None):
+    def __init__(self,outfile,diff_window_size=None,workers=None,
+                 zip_members=False,copy_from_root=False,base_digest=False):
         if not diff_window_size:
             diff_window_size = DIFF_WINDOW_SIZE
         self.diff_window_size = diff_window_size
         self.outfile = outfile
+        self.workers = workers
+        self.zip_members = zip_members
+        self.copy_from_root = copy_from_root
+        self.base_digest = base_digest
         self._pending_pop_path = 0
+        self._pool = None
+        self._stream = None
+        self._jobs = deque()
+        self._source_root = None
+        self._target_root = None
+        self._copy_plan = {}
+        self._copy_sources = {}
+        self._copy_source_dirs = set()
+        self._moved_sources = set()
+        self._deferred_removals = []
+        self._uses_zip_members = False
 
     def _write(self,data):
         self.outfile.write(data)
@@ -974,13 +1893,71 @@ class Differ(object):
         """
         source = os.path.abspath(source)
         target = os.path.abspath(target)
-        self._write(PATCH_HEADER)
-        self._write_int(HIGHEST_VERSION)
-        self._diff(source,target)
-        self._write_command(SET_PATH)
-        self._write_bytes("".encode("ascii"))
-        self._write_command(VERIFY_MD5)
-        self._write(calculate_patch_digest(target,hashlib.md5))
+        self._plan_copies(source,target)
+        version = 1
+        if self._uses_zip_members:
+            version = 2
+        for (_,same_dir) in self._copy_plan.itervalues():
+            if not same_dir:
+                version = 2
+                break
+        #  In parallel mode, output is buffered into segments interleaved
+        #  with pending diff jobs, and written out in order as they complete.
+        if self.workers and self.workers > 1:
+            self._pool = multiprocessing.Pool(self.workers)
+            self._stream = self.outfile
+            self.outfile = BytesIO()
+        try:
+            self._write(PATCH_HEADER)
+            self._write_int(version)
+            #  Verify the source up front, so a patch against the wrong base
+            #  fails fast and clients can check it before downloading.
+            if self.base_digest and os.path.exists(source):
+                self._write_command(SET_PATH)
+                self._write_bytes("".encode("ascii"))
+                self._write_command(VERIFY_MD5)
+                self._write(calculate_patch_digest(source,hashlib.md5,
+                                                   update_cache=False))
+            self._diff(source,target)
+            #  Remove anything that was kept around as a copy source.
+            for path in self._deferred_removals:
+                self._write_command(SET_PATH)
+                self._write_path(path)
+                self._write_command(REMOVE)
+            self._write_command(SET_PATH)
+            self._write_bytes("".encode("ascii"))
+            self._write_command(VERIFY_MD5)
+            self._write(calculate_patch_digest(target,hashlib.md5,
+                                               update_cache=False))
+            if self._pool is not None:
+                self._jobs.append(self.outfile.getvalue())
+                self._flush_jobs(wait=True)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+                self.outfile = self._stream
+                self._stream = None
+                self._jobs.clear()
+
+    def _flush_jobs(self,wait=False):
+        """Write out the leading run of completed parallel diff jobs.
+
+        Output segments and pending jobs are kept in stream order, so this
+        writes everything up to the first job that is still running.  If
+        'wait' is true then it blocks until all jobs are written.
+        """
+        while self._jobs:
+            job = self._jobs[0]
+            if isinstance(job,bytes):
+                data = job
+            else:
+                if not wait and not job.ready():
+                    break
+                data = job.get()
+            self._stream.write(data)
+            self._jobs.popleft()
 
     def _diff(self,source,target):
         """Recursively generate patch commands to transform source into target.
@@ -1009,6 +1986,8 @@ class Differ(object):
         nm_sibnm_map = {}
         sibnm_nm_map = {}
         for nm in os.listdir(target):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
             s_nm = os.path.join(source,nm)
             if not os.path.exists(s_nm):
                 sibnm = self._find_similar_sibling(source,target,nm)
@@ -1029,6 +2008,13 @@ class Differ(object):
                 self._write_command(COPY_FROM)
             elif len(sibnm_nm_map[sibnm]) > 1:
                 self._write_command(COPY_FROM)
+            elif s_nm in self._copy_source_dirs and \
+                 self._is_original_dir(source,target):
+                #  Files will be copied out of the sibling later on, so
+                #  it must stay where it is until the end of the patch.
+                self._write_command(COPY_FROM)
+                self._deferred_removals.append(self._target_relpath(
+                                                 os.path.join(target,sibnm)))
             else:
                 self._write_command(MOVE_FROM)
             self._write_path(sibnm)
@@ -1036,11 +2022,16 @@ class Differ(object):
             self._write_command(POP_PATH)
         # Every target item now has a source. Diff against it.
         for nm in os.listdir(target):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
             try:
                 s_nm = os.path.join(source,nm_sibnm_map[nm])
             except KeyError:
                 s_nm = os.path.join(source,nm)
             t_nm = os.path.join(target,nm)
+            #  New files may be copied from elsewhere in the source tree.
+            if t_nm in self._copy_plan and not os.path.isfile(s_nm):
+                s_nm = self._write_copy_from(source,target,nm)
             #  Recursively diff against the selected source.
             if paths_differ(s_nm,t_nm):
                 self._write_command(JOIN_PATH)
@@ -1063,8 +2054,22 @@ class Differ(object):
         #  Remove anything that's no longer in the target dir
         if os.path.isdir(source):
             for nm in os.listdir(source):
+                if nm == ESKY_DIGEST_CACHE:
+                    continue
                 if not os.path.exists(os.path.join(target,nm)):
                     if nm not in sibnm_nm_map:
+                        s_nm = os.path.join(source,nm)
+                        if (target,s_nm) in self._moved_sources:
+                            continue
+                        if s_nm in self._copy_sources or \
+                           s_nm in self._copy_source_dirs:
+                            #  Files will be copied out of this later on,
+                            #  so defer its removal to the end of the patch.
+                            if self._is_original_dir(source,target):
+                                path = os.path.join(target,nm)
+                                path = self._target_relpath(path)
+                                self._deferred_removals.append(path)
+                                continue
                         self._write_command(JOIN_PATH)
                         self._write_path(nm)
                         self._write_command(REMOVE)
@@ -1135,9 +2140,11 @@ class Differ(object):
             if t_zf is None:
                 s_zf.close()
                 self._diff_binary_file(source,target)
+            elif not self.zip_members:
+                self._diff_extracted_zipfiles(source,target,s_zf,t_zf)
             else:
                 try:
-                    self._write_command(PF_REC_ZIP)
+                    self._write_command(PF_ZIP_MEMBERS)
                     with _tempdir() as workdir:
                         #  Write commands to transform source metadata file
                         #  into target metadata file.
@@ -1149,18 +2156,96 @@ class Differ(object):
                             _write_zipfile_metadata(f,t_zf)
                         self._diff_binary_file(s_meta,t_meta)
                         self._write_command(END)
-                        #  Write commands to transform source contents
-                        #  directory into target contents directory.
-                        s_workdir = os.path.join(workdir,"source")
-                        t_workdir = os.path.join(workdir,"target")
-                        extract_zipfile(source,s_workdir)
-                        extract_zipfile(target,t_workdir)
-                        self._diff(s_workdir,t_workdir)
+                        #  Write an entry for each member of the target,
+                        #  copying the raw data if it's unchanged.
+                        for (i,t_info) in enumerate(t_zf.infolist()):
+                            try:
+                                s_info = s_zf.getinfo(t_info.filename)
+                            except KeyError:
+                                s_info = None
+                            if s_info is not None:
+                                if not _zip_members_differ(s_zf,s_info,
+                                                           t_zf,t_info):
+                                    self._write_command(COPY_FROM)
+                                    self._write_path(t_info.filename)
+                                    continue
+                            self._write_command(SET_PATH)
+                            self._write_path(t_info.filename)
+                            self._diff_zip_member(s_zf,s_info,t_zf,t_info,
+                                                  os.path.join(workdir,str(i)))
                         self._write_command(END)
+                        #  Any pending jobs refer to files in workdir.
+                        if self._pool is not None:
+                            self._flush_jobs(wait=True)
                 finally:
                     t_zf.close() 
                     s_zf.close() 
 
+    def _diff_extracted_zipfiles(self,source,target,s_zf,t_zf):
+        """Generate a PF_REC_ZIP command by diffing the extracted zipfiles.
+
+        This is understood by version 1 of the patch protocol, but needs
+        both zipfiles to be extracted to a temporary directory.
+        """
+        try:
+            self._write_command(PF_REC_ZIP)
+            with _tempdir() as workdir:
+                #  Write commands to transform source metadata file
+                #  into target metadata file.
+                s_meta = os.path.join(workdir,"s_meta")
+                with open(s_meta,"wb") as f:
+                    _write_zipfile_metadata(f,s_zf)
+                t_meta = os.path.join(workdir,"t_meta")
+                with open(t_meta,"wb") as f:
+                    _write_zipfile_metadata(f,t_zf)
+                self._diff_binary_file(s_meta,t_meta)
+                self._write_command(END)
+                #  Write commands to transform source contents
+                #  directory into target contents directory.
+                s_workdir = os.path.join(workdir,"source")
+                t_workdir = os.path.join(workdir,"target")
+                extract_zipfile(source,s_workdir)
+                extract_zipfile(target,t_workdir)
+                self._diff(s_workdir,t_workdir)
+                self._write_command(END)
+                #  Any pending jobs refer to files in workdir.
+                if self._pool is not None:
+                    self._flush_jobs(wait=True)
+        finally:
+            t_zf.close()
+            s_zf.close()
+
+    def _diff_zip_member(self,s_zf,s_info,t_zf,t_info,workpath):
+        """Generate PF_* commands to produce one zipfile member.
+
+        The member data is streamed out of the zipfiles.  In parallel mode
+        it is written to temp files instead, named after 'workpath', since
+        the worker processes need files to read from.
+        """
+        if self._pool is not None:
+            s_path = workpath + ".source"
+            t_path = workpath + ".target"
+            with open(t_path,"wb") as f:
+                _copy_zip_member_data(t_zf,t_info,f)
+            if s_info is not None:
+                with open(s_path,"wb") as f:
+                    _copy_zip_member_data(s_zf,s_info,f)
+            self._diff_binary_file(s_path,t_path)
+            return
+        sfile = None
+        if s_info is not None:
+            sfile = tempfile.SpooledTemporaryFile(1024*1024)
+            _copy_zip_member_data(s_zf,s_info,sfile)
+            sfile.seek(0)
+        try:
+            tfile = t_zf.open(t_info)
+            try:
+                self._diff_binary_stream(sfile,tfile)
+            finally:
+                tfile.close()
+        finally:
+            if sfile is not None:
+                sfile.close()
 
     def _diff_binary_file(self,source,target):
         """Diff a generic binary file.
@@ -1168,50 +2253,261 @@ class Differ(object):
         This is the per-file diffing method used when we don't know enough
         about the file to do anything fancier.  It's basically a windowed
         bsdiff.
+
+        In parallel mode the work is handed off to the process pool, and
+        its output is slotted into the stream once it completes.
         """
-        spos = 0
+        if self._pool is not None:
+            self._jobs.append(self.outfile.getvalue())
+            self.outfile = BytesIO()
+            args = (source,target,self.diff_window_size)
+            self._jobs.append(self._pool.apply_async(_diff_binary_file_job,args))
+            self._flush_jobs()
+            return
         with open(target,"rb") as tfile:
             if os.path.isfile(source):
                 sfile = open(source,"rb")
             else:
                 sfile = None
             try:
-                #  Process the file in diff_window_size blocks.  This
-                #  will produce slightly bigger patches but we avoid
-                #  running out of memory for large files.
-                tdata = tfile.read(self.diff_window_size)
-                if not tdata:
-                    #  The file is empty, do a raw insert of zero bytes.
-                    self._write_command(PF_INS_RAW)
-                    self._write_bytes("".encode("ascii"))
-                else:
-                    while tdata:
-                        sdata = b""
-                        if sfile is not None:
-                            sdata = sfile.read(self.diff_window_size)
-                        #  Look for a shared prefix.
-                        i = 0; maxi = min(len(tdata),len(sdata))
-                        while i < maxi and tdata[i] == sdata[i]:
-                            i += 1
-                        #  Copy it in directly, unless it's tiny.
-                        if i > 8:
-                            skipbytes = sfile.tell() - len(sdata) - spos
-                            if skipbytes > 0:
-                                self._write_command(PF_SKIP)
-                                self._write_int(skipbytes)
-                                spos += skipbytes
-                            self._write_command(PF_COPY)
-                            self._write_int(i)
-                            tdata = tdata[i:]; sdata = sdata[i:]
-                            spos += i
-                        #  Write the rest of the block as a diff
-                        if tdata:
-                            spos += self._write_file_patch(sdata,tdata)
-                        tdata = tfile.read(self.diff_window_size)
+                self._diff_binary_stream(sfile,tfile)
             finally:
                 if sfile is not None:
                     sfile.close()
 
+    def _diff_binary_stream(self,sfile,tfile):
+        """Diff generic binary data read from file-like objects.
+
+        The target data is read sequentially from 'tfile'.  The source data
+        is read from 'sfile', which must be seekable, or None if there is no
+        source data.
+        """
+        #  Process the file in diff_window_size blocks.  This
+        #  will produce slightly bigger patches but we avoid
+        #  running out of memory for large files.  Each block is
+        #  diffed against at most diff_window_size bytes of source,
+        #  though finding those reads up to three windows of it.
+        tdata = tfile.read(self.diff_window_size)
+        if not tdata:
+            #  The file is empty, do a raw insert of zero bytes.
+            self._write_command(PF_INS_RAW)
+            self._write_bytes("".encode("ascii"))
+        else:
+            #  'spos' tracks how far the patcher has read into the
+            #  source file, while 'sexp' tracks where we expect the
+            #  source data matching the next block to begin.
+            spos = sexp = 0
+            while tdata:
+                sdata = "".encode("ascii")
+                sstart = spos
+                tcut = None
+                if sfile is not None:
+                    (sstart,sdata,tcut) = self._find_source_window(
+                                            sfile,spos,sexp,tdata)
+                #  Only process the portion of the block that was
+                #  matched; the rest is carried into the next one.
+                if tcut is not None:
+                    tnext = tdata[tcut:]
+                    tdata = tdata[:tcut]
+                else:
+                    tnext = "".encode("ascii")
+                prev_sexp = sexp
+                prev_spos = spos
+                sexp = sstart + len(sdata)
+                #  Look for a shared prefix.
+                i = 0; maxi = min(len(tdata),len(sdata))
+                while i < maxi and tdata[i] == sdata[i]:
+                    i += 1
+                #  Copy it in directly, unless it's tiny.
+                if i > 8:
+                    if sstart > spos:
+                        self._write_command(PF_SKIP)
+                        self._write_int(sstart - spos)
+                        spos = sstart
+                    self._write_command(PF_COPY)
+                    self._write_int(i)
+                    tdata = tdata[i:]; sdata = sdata[i:]
+                    spos += i; sstart += i
+                #  Write the rest of the block as a diff
+                if tdata:
+                    skipbytes = sstart - spos
+                    spos += self._write_file_patch(sdata,tdata,
+                                                   skipbytes)
+                #  If nothing matched and no source data was used,
+                #  this was most likely inserted data.  Expect the
+                #  source to pick up again where it left off.
+                if tcut is None and spos == prev_spos:
+                    sexp = prev_sexp
+                tdata = tnext
+                tdata += tfile.read(self.diff_window_size-len(tdata))
+
+    def _find_source_window(self,sfile,spos,sexp,tdata):
+        """Find the region of the source file that best matches a block.
+
+        Rather than diffing aligned windows of source and target, we sample
+        a few fingerprints from the target block and look for their nearest
+        occurrences around the expected position in the source.  This keeps
+        the two files in step across inserted or deleted data.  Since the
+        patcher can only read forward, the region never starts before 'spos'.
+
+        Returns a tuple (start,sdata,tcut) where 'sdata' is the source data
+        found at offset 'start', and 'tcut' is the length of the target prefix
+        that it corresponds to.  If no fingerprints could be found then 'tcut'
+        is None and 'sdata' is the window at the expected position.
+
+        The search itself reads up to three times len(tdata) bytes of the
+        source, but 'sdata' is never longer than 'tdata'.
+        """
+        n = len(tdata)
+        if sexp - spos <= 2 * n:
+            base = spos
+        else:
+            base = sexp - n
+        sfile.seek(base)
+        sbuf = sfile.read((sexp - base) + 2 * n)
+        expected = sexp - base
+        first = last = None
+        if n >= ANCHOR_SIZE:
+            offsets = set()
+            for k in xrange(ANCHOR_COUNT):
+                offsets.add((n - ANCHOR_SIZE) * k // (ANCHOR_COUNT - 1))
+            for o in sorted(offsets):
+                sample = tdata[o:o+ANCHOR_SIZE]
+                #  Runs of a single byte would match just about anywhere.
+                if sample.count(sample[:1]) == ANCHOR_SIZE:
+                    continue
+                e = max(expected + o,0)
+                found = [p for p in (sbuf.find(sample,e),
+                                     sbuf.rfind(sample,0,e+ANCHOR_SIZE-1))
+                           if p >= 0]
+                if found:
+                    p = min(found,key=lambda p: abs(p - e))
+                    if first is None:
+                        first = (o,p)
+                    last = (o,p)
+        if first is not None:
+            start = max(first[1] - first[0],0)
+            end = last[1] + ANCHOR_SIZE
+            tcut = last[0] + ANCHOR_SIZE
+            if start < end <= start + tcut + n:
+                end = min(end,start + n)
+                return (base + start,sbuf[start:end],tcut)
+        start = max(sexp,spos) - base
+        return (base + start,sbuf[start:start+n],None)
+
+    def _plan_copies(self,source,target):
+        """Plan which new files should be copied from the source tree.
+
+        This indexes every file in the source tree, then walks the target
+        tree the same way _diff_dir() does to find files that will have
+        nothing to diff against at their own path.  Each of those is
+        looked up in the index, so that files which have been renamed or
+        moved between directories can be copied and diffed rather than
+        inserted in full.
+
+        Copy sources are always read from their original location, so any
+        directory that contains one is kept in place until the end of the
+        patch rather than being moved or removed.
+        """
+        self._source_root = source
+        self._target_root = target
+        self._copy_plan = {}
+        self._copy_sources = {}
+        self._copy_source_dirs = set()
+        self._moved_sources = set()
+        self._deferred_removals = []
+        self._uses_zip_members = (self.zip_members and
+                                  _is_zip_pair(source,target))
+        if not os.path.isdir(source) or not os.path.isdir(target):
+            return
+        self._plan_dir_copies(_SourceIndex(source,target),source,target)
+        for s_path in self._copy_sources:
+            s_dir = os.path.dirname(s_path)
+            while s_dir != source and s_dir not in self._copy_source_dirs:
+                self._copy_source_dirs.add(s_dir)
+                s_dir = os.path.dirname(s_dir)
+
+    def _plan_dir_copies(self,index,source,target):
+        """Recursively plan copies for the files in a target directory."""
+        nm_sibnm_map = {}
+        for nm in os.listdir(target):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
+            if not os.path.exists(os.path.join(source,nm)):
+                sibnm = self._find_similar_sibling(source,target,nm)
+                if sibnm:
+                    nm_sibnm_map[nm] = sibnm
+        for nm in os.listdir(target):
+            if nm == ESKY_DIGEST_CACHE:
+                continue
+            s_nm = os.path.join(source,nm_sibnm_map.get(nm,nm))
+            t_nm = os.path.join(target,nm)
+            if os.path.isdir(t_nm):
+                self._plan_dir_copies(index,s_nm,t_nm)
+            elif os.path.isfile(t_nm):
+                if not os.path.isfile(s_nm):
+                    if self.copy_from_root:
+                        s_path = index.find_source(t_nm)
+                    else:
+                        s_path = index.find_source(t_nm,source)
+                    if s_path is not None:
+                        same_dir = (os.path.dirname(s_path) == source)
+                        self._copy_plan[t_nm] = (s_path,same_dir)
+                        count = self._copy_sources.get(s_path,0)
+                        self._copy_sources[s_path] = count + 1
+                        s_nm = s_path
+                if self.zip_members and _is_zip_pair(s_nm,t_nm):
+                    self._uses_zip_members = True
+
+    def _write_copy_from(self,source,target,nm):
+        """Write commands to copy a planned source file into target entry nm.
+
+        Sources in the corresponding directory are copied (or moved, if
+        nothing else needs them) using relative paths; sources elsewhere in
+        the tree are copied using the root-relative COPY_FROM_ROOT.  The
+        path of the chosen source is returned.
+        """
+        (s_path,same_dir) = self._copy_plan[os.path.join(target,nm)]
+        self._write_command(JOIN_PATH)
+        self._write_path(nm)
+        if same_dir:
+            sibnm = os.path.basename(s_path)
+            if self._copy_sources[s_path] == 1 and \
+               not os.path.exists(os.path.join(target,sibnm)):
+                self._write_command(MOVE_FROM)
+                self._moved_sources.add((target,s_path))
+            else:
+                self._write_command(COPY_FROM)
+            self._write_path(sibnm)
+        else:
+            self._write_command(COPY_FROM_ROOT)
+            path = os.path.relpath(s_path,self._source_root)
+            self._write_path(path.replace(os.sep,"/"))
+        self._write_command(POP_PATH)
+        return s_path
+
+    def _is_original_dir(self,source,target):
+        """Check whether source is being patched in its original location.
+
+        This is false for directories that have been copied or moved from
+        a sibling, and for anything not under the root of the current diff.
+        """
+        if self._source_root is None:
+            return False
+        if not source.startswith(self._source_root + os.sep):
+            if source != self._source_root:
+                return False
+        if not target.startswith(self._target_root + os.sep):
+            if target != self._target_root:
+                return False
+        s_rel = os.path.relpath(source,self._source_root)
+        t_rel = os.path.relpath(target,self._target_root)
+        return s_rel == t_rel
+
+    def _target_relpath(self,path):
+        """Get the root-relative path of an entry in the target tree."""
+        return os.path.relpath(path,self._target_root).replace(os.sep,"/")
+
     def _find_similar_sibling(self,source,target,nm):
         """Find a sibling of an entry against which we can calculate a diff.
 
@@ -1225,7 +2521,8 @@ class Differ(object):
         """
         t_nm = os.path.join(target,nm)
         if os.path.isfile(t_nm):
-             # For files, I haven't decided on a good heuristic yet...
+            #  Files are matched against the whole source tree instead,
+            #  see _plan_copies().
             return None
         elif os.path.isdir(t_nm):
             #  For directories, decide similarity based on the number of
@@ -1248,12 +2545,16 @@ class Differ(object):
         else:
             return None
 
-    def _write_file_patch(self,sdata,tdata):
+    def _write_file_patch(self,sdata,tdata,skipbytes=0):
         """Write a series of PF_* commands to generate tdata from sdata.
 
         This function tries the various PF_* commands to find the one which can
         generate tdata from sdata with the smallest command size.  Usually that
         will be BSDIFF4, but you never know :-)
+
+        If 'skipbytes' is given, sdata begins that many bytes past the current
+        source position; they are skipped only if the source is actually used.
+        Returns the number of source bytes consumed.
         """
         options = []
         #  We could just include the raw data
@@ -1269,13 +2570,146 @@ class Differ(object):
         options = [(len(cmd[-1]),cmd) for cmd in options]
         options.sort()
         best_option = options[0][1]
+        if best_option[0] and skipbytes:
+            self._write_command(PF_SKIP)
+            self._write_int(skipbytes)
         self._write_command(best_option[1])
         for arg in best_option[2:]:
             if isinstance(arg,(str,unicode,bytes)):
                 self._write_bytes(arg)
             else:
                 self._write_int(arg)
-        return best_option[0]
+        if best_option[0]:
+            return best_option[0] + skipbytes
+        return 0
+
+
+def _diff_binary_file_job(source,target,diff_window_size):
+    """Generate the PF_* commands for a single file, returning the bytes.
+
+    This is the unit of work handed to worker processes in parallel mode.
+    """
+    output = BytesIO()
+    Differ(output,diff_window_size)._diff_binary_file(source,target)
+    return output.getvalue()
+
+
+class _SourceIndex(object):
+    """Index of the files in a source tree, for finding copy sources.
+
+    Files are indexed by size, to find exact copies, and by normalised name,
+    to find near matches such as files that have gained a version suffix.
+    Only files that are guaranteed to still be intact at their original
+    location while the patch is being applied are considered.
+    """
+
+    def __init__(self,source,target):
+        self.source = source
+        self.target = target
+        self.by_size = {}
+        self.by_name = {}
+        self._digests = {}
+        self._usable = {}
+        for (dirpath,dirnames,filenames) in os.walk(source):
+            for nm in filenames:
+                if nm == ESKY_DIGEST_CACHE or nm.endswith((".pyc",".pyo")):
+                    continue
+                path = os.path.join(dirpath,nm)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                if size < COPY_SOURCE_MIN_SIZE:
+                    continue
+                self.by_size.setdefault(size,[]).append(path)
+                self.by_name.setdefault(_normalise_name(nm),[]).append(path)
+
+    def find_source(self,t_path,s_dir=None):
+        """Find the best source file from which to produce t_path.
+
+        An exact copy is preferred, then the closest-sized file with the same
+        normalised name.  If 's_dir' is given, only files directly within
+        that directory are considered.  Returns None if there is no suitable
+        source.
+        """
+        t_size = os.path.getsize(t_path)
+        if t_size < COPY_SOURCE_MIN_SIZE:
+            return None
+        t_nm = os.path.basename(t_path)
+        t_dirnm = os.path.basename(os.path.dirname(t_path))
+        exact = []
+        for s_path in self.by_size.get(t_size,()):
+            if s_dir is not None and os.path.dirname(s_path) != s_dir:
+                continue
+            if self._is_usable(s_path):
+                if self._digest(s_path) == self._digest(t_path):
+                    exact.append((os.path.basename(s_path) != t_nm,s_path))
+        if exact:
+            return min(exact)[1]
+        near = []
+        for s_path in self.by_name.get(_normalise_name(t_nm),()):
+            s_size = os.path.getsize(s_path)
+            if s_size * 2 < t_size or t_size * 2 < s_size:
+                continue
+            if s_dir is not None and os.path.dirname(s_path) != s_dir:
+                continue
+            if self._is_usable(s_path):
+                s_dirnm = os.path.basename(os.path.dirname(s_path))
+                near.append((s_dirnm != t_dirnm,abs(s_size-t_size),s_path))
+        if near:
+            return min(near)[2]
+        return None
+
+    def _digest(self,path):
+        try:
+            return self._digests[path]
+        except KeyError:
+            self._digests[path] = digest = calculate_digest(path)
+            return digest
+
+    def _is_usable(self,s_path):
+        """Check whether s_path will be intact while the patch is applied.
+
+        The file must be either unchanged or absent in the target, and none
+        of its parent directories may be replaced by a file.  Anything that
+        is absent in the target has its removal deferred by the Differ.
+        """
+        try:
+            return self._usable[s_path]
+        except KeyError:
+            pass
+        usable = True
+        relpath = os.path.relpath(s_path,self.source)
+        parts = relpath.split(os.sep)
+        for i in xrange(1,len(parts)):
+            t_dir = os.path.join(self.target,*parts[:i])
+            if not os.path.lexists(t_dir):
+                break
+            if os.path.islink(t_dir) or not os.path.isdir(t_dir):
+                usable = False
+                break
+        else:
+            t_path = os.path.join(self.target,relpath)
+            if os.path.lexists(t_path):
+                if os.path.islink(t_path) or not os.path.isfile(t_path):
+                    usable = False
+                elif paths_differ(s_path,t_path):
+                    usable = False
+        self._usable[s_path] = usable
+        return usable
+
+
+def _is_zip_pair(source,target):
+    """Check whether source and target would be diffed as zipfiles."""
+    if not os.path.isfile(source) or not os.path.isfile(target):
+        return False
+    return source.endswith(".zip") and target.endswith(".zip")
+
+
+_VERSION_SUFFIX_RE = re.compile(r"[-_.]?v?\d+(?:[-_.]\d+)*")
+
+def _normalise_name(nm):
+    """Normalise a filename by stripping out any version numbers."""
+    return _VERSION_SUFFIX_RE.sub("",nm.lower())
 
 
 class _tempdir(object):
@@ -1341,6 +2775,19 @@ def main(args):
                       help="set the window size for diffing files")
     parser.add_option("","--dry-run",dest="dry_run",action="store_true",
                       help="print commands instead of executing them")
+    parser.add_option("","--streaming",dest="streaming",action="store_true",
+                      help="apply patches using a small fixed-size buffer")
+    parser.add_option("-j","--jobs",dest="jobs",type="int",metavar="N",
+                      help="use N workers for diffing or patching files")
+    parser.add_option("","--zip-members",dest="zip_members",
+                      action="store_true",
+                      help="diff zipfiles member by member (needs version 2)")
+    parser.add_option("","--copy-from-root",dest="copy_from_root",
+                      action="store_true",
+                      help="copy files moved between dirs (needs version 2)")
+    parser.add_option("","--base-digest",dest="base_digest",
+                      action="store_true",
+                      help="verify the source digest at the start of the patch")
     (opts,args) = parser.parse_args(args)
     if opts.deep_zipped:
         opts.zipped = True
@@ -1386,7 +2833,10 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            write_patch(source,target,stream,diff_window_size=opts.diff_window)
+            write_patch(source,target,stream,diff_window_size=opts.diff_window,
+                        workers=opts.jobs,zip_members=opts.zip_members,
+                        copy_from_root=opts.copy_from_root,
+                        base_digest=opts.base_digest)
         elif cmd == "patch":
             #  Patch a file or directory.
             #  If --zipped is specified, the target is unzipped to a temporary
@@ -1406,7 +2856,8 @@ def main(args):
                         deep_extract_zipfile(target_zip,target)
                     else:
                         extract_zipfile(target_zip,target)
-            apply_patch(target,stream,dry_run=opts.dry_run)
+            apply_patch(target,stream,dry_run=opts.dry_run,
+                        streaming=opts.streaming,workers=opts.jobs)
             if opts.zipped and target_zip is not None:
                 target_dir = os.path.dirname(target_zip)
                 (fd,target_temp) = tempfile.mkstemp(dir=target_dir)
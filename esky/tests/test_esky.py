@@ -11,25 +11,35 @@ import subprocess
 import shutil
 import zipfile
 import threading
+import SocketServer
+import socket
 import tempfile
+import urllib
 import urllib2
 import hashlib
 import tarfile
 import time
+import json
+import pickle
+import bz2
+import itertools
+from io import BytesIO
 from contextlib import contextmanager
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 from distutils.core import setup as dist_setup
+import distutils.dist
 from distutils import dir_util
 
 import esky
 import esky.patch
+import esky.finder
 from esky.bdist_esky import Executable, bdist_esky
 import esky.bdist_esky
 from esky.util import extract_zipfile, deep_extract_zipfile, get_platform, \
                       ESKY_CONTROL_DIR, files_differ, ESKY_APPDATA_DIR, \
-                      really_rmtree, LOCAL_HTTP_PORT
+                      really_rmtree, create_zipfile, LOCAL_HTTP_PORT
 from esky.fstransact import FSTransaction
 import pytest
 
@@ -62,7 +72,6 @@ def assert_freezedir_exists(dist):
 
 
 if not hasattr(HTTPServer,"shutdown"):
-    import socket
     def socketserver_shutdown(self):
         try:
             self.socket.close()
@@ -676,6 +685,30 @@ class TestPatch(unittest.TestCase):
         finally:
             really_rmtree(tdir)
 
+    def test_patch_bigfile_with_insertion_and_deletion(self):
+        tdir = tempfile.mkdtemp()
+        try:
+            data = os.urandom(1024*1024*2)
+            with open(os.path.join(tdir,"source"),"wb") as f:
+                f.write(data)
+            with open(os.path.join(tdir,"target"),"wb") as f:
+                f.write(data[:300000])
+                f.write(os.urandom(100000))
+                f.write(data[300000:1200000])
+                f.write(data[1250000:])
+            with open(os.path.join(tdir,"patch"),"wb") as f:
+                esky.patch.write_patch(os.path.join(tdir,"source"),
+                                       os.path.join(tdir,"target"),f,
+                                       diff_window_size=64*1024)
+            #  Misaligned windows would mean a patch the size of the file.
+            self.assertTrue(os.path.getsize(os.path.join(tdir,"patch")) < 200000)
+            with open(os.path.join(tdir,"patch"),"rb") as f:
+                esky.patch.apply_patch(os.path.join(tdir,"source"),f)
+            self.assertEquals(esky.patch.calculate_digest(os.path.join(tdir,"source")),
+                              esky.patch.calculate_digest(os.path.join(tdir,"target")))
+        finally:
+            really_rmtree(tdir)
+
     def test_diffing_back_and_forth(self):
         for (tf1,_) in self._TEST_FILES:
             for (tf2,_) in self._TEST_FILES:
@@ -690,6 +723,15 @@ class TestPatch(unittest.TestCase):
                 self.assertEquals(esky.patch.calculate_digest(path1),
                                   esky.patch.calculate_digest(path2))
 
+    def test_parallel_diff_matches_serial_diff(self):
+        path1, path2 = self._extract("pyenchant-1.2.0.tar.gz",
+                                     "pyenchant-1.6.0.tar.gz")
+        serial = BytesIO()
+        esky.patch.write_patch(path1,path2,serial)
+        parallel = BytesIO()
+        esky.patch.write_patch(path1,path2,parallel,workers=4)
+        self.assertEquals(serial.getvalue(),parallel.getvalue())
+
     def test_apply_patch_old(self):
         '''uses the old method which calculates the digest for the entire
         folder when comparing, application has no filelist'''
@@ -867,6 +909,137 @@ class TestPatch(unittest.TestCase):
             self._test_apply_patch_fail_when_sourcefile_has_been_deleted()
 
 
+    def test_patch_moved_and_renamed_files(self):
+        moved = os.urandom(20000)
+        lib = os.urandom(50000)
+        for d in (self.src_dir,self.tgt_dir):
+            os.makedirs(os.path.join(d,"pkgB"))
+            os.makedirs(os.path.join(d,"lib"))
+        os.makedirs(os.path.join(self.src_dir,"pkgA"))
+        with open(os.path.join(self.src_dir,"pkgA","mod.bin"),"wb") as f:
+            f.write(moved)
+        with open(os.path.join(self.tgt_dir,"pkgB","mod.bin"),"wb") as f:
+            f.write(moved)
+        with open(os.path.join(self.src_dir,"lib","libfoo-1.0.so"),"wb") as f:
+            f.write(lib)
+        with open(os.path.join(self.src_dir,"lib","libbar.so"),"wb") as f:
+            f.write(lib)
+        with open(os.path.join(self.tgt_dir,"lib","libbar.so"),"wb") as f:
+            f.write(lib)
+        with open(os.path.join(self.tgt_dir,"pkgB","libfoo-1.1.so"),"wb") as f:
+            f.write(lib[:1000] + "changed" + lib[1000:])
+        #  By default the moved files are inserted in full, so that the
+        #  patch can be applied by clients that only know version 1.
+        copy_dir = os.path.join(self.workdir,"copy")
+        shutil.copytree(self.src_dir,copy_dir)
+        patch = BytesIO()
+        esky.patch.write_patch(self.src_dir,self.tgt_dir,patch)
+        header_size = len(esky.patch.PATCH_HEADER)
+        self.assertEquals(patch.getvalue()[header_size],chr(1))
+        self.assertTrue(len(patch.getvalue()) > 70000)
+        patch.seek(0)
+        esky.patch.apply_patch(copy_dir,patch)
+        self.assertEquals(esky.patch.calculate_digest(copy_dir),
+                          esky.patch.calculate_digest(self.tgt_dir))
+        if esky.patch.bsdiff4_py.diff is None:
+            raise unittest.SkipTest("no bsdiff4 implementation to diff with")
+        patch = BytesIO()
+        esky.patch.write_patch(self.src_dir,self.tgt_dir,patch,
+                               copy_from_root=True)
+        self.assertEquals(patch.getvalue()[header_size],chr(2))
+        #  Without copying from elsewhere in the tree, the random data
+        #  would have to be inserted in full.
+        self.assertTrue(len(patch.getvalue()) < 2000)
+        patch.seek(0)
+        esky.patch.apply_patch(self.src_dir,patch)
+        self.assertEquals(esky.patch.calculate_digest(self.src_dir),
+                          esky.patch.calculate_digest(self.tgt_dir))
+
+    def test_patch_zipfile_members_without_extracting(self):
+        members = [("mod%d.py" % (i,),("x = %d\n" % (i,)) * 500)
+                   for i in xrange(20)]
+        members.append(("data.bin",os.urandom(30000)))
+        for (d,changes) in ((self.src_dir,{}),
+                            (self.tgt_dir,{"mod3.py":"changed\n" * 300})):
+            os.makedirs(d)
+            zf = zipfile.ZipFile(os.path.join(d,"library.zip"),"w",
+                                 compression=zipfile.ZIP_DEFLATED)
+            for (nm,data) in members:
+                zf.writestr(nm,changes.get(nm,data))
+            if changes:
+                zf.writestr("newmod.py","y = 1\n" * 100)
+            zf.close()
+        def no_extract(*args,**kwds):
+            raise AssertionError("zipfile should not be extracted")
+        orig_extract_zipfile = esky.patch.extract_zipfile
+        esky.patch.extract_zipfile = no_extract
+        try:
+            for workers in (None,2):
+                shutil.rmtree(self.src_dir + ".tmp",ignore_errors=True)
+                shutil.copytree(self.src_dir,self.src_dir + ".tmp")
+                patch = BytesIO()
+                esky.patch.write_patch(self.src_dir,self.tgt_dir,patch,
+                                       workers=workers,zip_members=True)
+                #  The random data member should be copied, not inserted.
+                self.assertTrue(len(patch.getvalue()) < 10000)
+                patch.seek(0)
+                esky.patch.apply_patch(self.src_dir + ".tmp",patch)
+                self.assertEquals(
+                    esky.patch.calculate_digest(self.src_dir + ".tmp"),
+                    esky.patch.calculate_digest(self.tgt_dir))
+        finally:
+            esky.patch.extract_zipfile = orig_extract_zipfile
+        #  By default, zipfiles are diffed so older clients can patch them.
+        patch = BytesIO()
+        esky.patch.write_patch(self.src_dir,self.tgt_dir,patch)
+        patch.seek(len(esky.patch.PATCH_HEADER))
+        self.assertEquals(esky.patch._read_vint(patch),1)
+        patch.seek(0)
+        esky.patch.apply_patch(self.src_dir,patch)
+        self.assertEquals(esky.patch.calculate_digest(self.src_dir),
+                          esky.patch.calculate_digest(self.tgt_dir))
+
+    def test_digest_cache_only_rehashes_patched_files(self):
+        files = ["file%d.txt" % (i,) for i in xrange(10)]
+        for d in (self.src_dir,self.tgt_dir):
+            os.makedirs(os.path.join(d,ESKY_CONTROL_DIR))
+            with open(os.path.join(d,ESKY_CONTROL_DIR,
+                                   esky.patch.ESKY_FILELIST),"w") as f:
+                f.write(json.dumps(files))
+            for nm in files:
+                with open(os.path.join(d,nm),"wb") as f:
+                    f.write(nm * 1000)
+        for nm in files[:3]:
+            with open(os.path.join(self.tgt_dir,nm),"ab") as f:
+                f.write("changed")
+        #  Backdate the source files so they're not considered racy,
+        #  then prime the digest cache.
+        mtime = time.time() - 60
+        for nm in files:
+            os.utime(os.path.join(self.src_dir,nm),(mtime,mtime))
+        esky.patch.calculate_patch_digest(self.src_dir)
+        assert os.path.exists(os.path.join(self.src_dir,ESKY_CONTROL_DIR,
+                                           esky.patch.ESKY_DIGEST_CACHE))
+        patch_fname = os.path.join(self.workdir,"patch")
+        with open(patch_fname,"wb") as patchfile:
+            esky.patch.write_patch(self.src_dir,self.tgt_dir,patchfile)
+        #  Applying the patch should only read the files that it changed.
+        hashed = []
+        orig_calculate_digest = esky.patch.calculate_digest
+        def calculate_digest(target,*args,**kwds):
+            hashed.append(os.path.basename(target))
+            return orig_calculate_digest(target,*args,**kwds)
+        esky.patch.calculate_digest = calculate_digest
+        try:
+            with open(patch_fname,"rb") as patchfile:
+                esky.patch.apply_patch(self.src_dir,patchfile)
+        finally:
+            esky.patch.calculate_digest = orig_calculate_digest
+        self.assertEquals(sorted(hashed),sorted(files[:3]))
+        self.assertEquals(esky.patch.calculate_patch_digest(self.src_dir),
+                          esky.patch.calculate_patch_digest(self.tgt_dir))
+
+
 
 class TestPatch_cxbsdiff(TestPatch):
     """Test the patching code with cx-bsdiff rather than bsdiff4."""
@@ -893,8 +1066,151 @@ class TestPatch_pybsdiff(TestPatch):
     def tearDown(self):
         esky.patch.bsdiff4 = self.__orig_bsdiff4
         return super(TestPatch_pybsdiff,self).tearDown()
-    
-        
+
+    def test_pybsdiff_add_bytes(self):
+        #  Check the bulk addition against a plain bytewise loop, with
+        #  lengths either side of the chunk size and bytes that overflow.
+        for n in (0,1,7,esky.patch._ADD_CHUNK_SIZE - 1,
+                  esky.patch._ADD_CHUNK_SIZE,esky.patch._ADD_CHUNK_SIZE * 3 + 5):
+            data1 = os.urandom(n)
+            data2 = chr(255) * (n // 2) + os.urandom(n - n // 2)
+            expected = "".join(chr((ord(a) + ord(b)) % 256)
+                               for (a,b) in zip(data1,data2))
+            self.assertEquals(esky.patch._add_bytes(data1,data2),expected)
+
+    def test_pybsdiff_patch_matches_native(self):
+        if esky.patch.bsdiff4_native is None:
+            raise unittest.SkipTest("no native bsdiff4 to compare against")
+        source = os.urandom(1024 * 1024 * 2)
+        target = bytearray(source)
+        for i in xrange(0,len(target),997):
+            target[i] = (target[i] + 1) % 256
+        target = bytes(target[:500000]) + os.urandom(30000) + \
+                 bytes(target[600000:])
+        patch = esky.patch.bsdiff4_native.diff(source,target)
+        self.assertEquals(esky.patch.bsdiff4_native.patch(source,patch),target)
+        self.assertEquals(esky.patch.bsdiff4_py.patch(source,patch),target)
+
+
+class TestPatch_streaming(TestPatch):
+    """Test the patching code with streaming application of bsdiff4."""
+
+    def setUp(self):
+        self.__orig_streaming = esky.patch.Patcher.streaming
+        esky.patch.Patcher.streaming = True
+        return super(TestPatch_streaming,self).setUp()
+
+    def tearDown(self):
+        esky.patch.Patcher.streaming = self.__orig_streaming
+        return super(TestPatch_streaming,self).tearDown()
+
+    def test_streaming_patch_matches_inmemory_patch(self):
+        source = os.urandom(1024 * 1024)
+        target = bytearray(source)
+        for i in xrange(0,len(target),1009):
+            target[i] = (target[i] + 7) % 256
+        target = bytes(target[:300000]) + os.urandom(20000) + \
+                 bytes(target[350000:])
+        if esky.patch.bsdiff4_py.diff is None:
+            raise unittest.SkipTest("no bsdiff4 implementation to diff with")
+        patch = esky.patch.bsdiff4_py.diff(source,target)
+        result = BytesIO()
+        sourcefile = BytesIO("prefix" + source + "suffix")
+        sourcefile.read(6)
+        esky.patch.bsdiff4_py.patch_stream(sourcefile,len(source),
+                                           BytesIO(patch),result)
+        self.assertEquals(result.getvalue(),target)
+        self.assertEquals(sourcefile.read(),"suffix")
+        self.assertEquals(result.getvalue(),
+                          esky.patch.bsdiff4_py.patch(source,patch))
+
+
+    def test_bz2_section_reader(self):
+        data = os.urandom(5000) + "x".encode("ascii") * 300000 + \
+               os.urandom(5000)
+        compressed = bz2.compress(data)
+        fileobj = BytesIO("prefix" + compressed + "suffix")
+        reader = esky.patch._BZ2SectionReader(fileobj,6,6 + len(compressed))
+        chunks = []
+        pos = 0
+        for size in itertools.cycle((1,4095,70000,3)):
+            size = min(size,len(data) - pos)
+            if not size:
+                break
+            chunks.append(reader.read(size))
+            self.assertEquals(len(chunks[-1]),size)
+            pos += size
+        self.assertEquals("".join(chunks),data)
+        self.assertRaises(esky.patch.PatchError,reader.read,1)
+
+
+class TestPatch_parallel(TestPatch):
+    """Test the patching code with files patched in parallel."""
+
+    def setUp(self):
+        self.__orig_workers = esky.patch.Patcher.workers
+        esky.patch.Patcher.workers = 4
+        return super(TestPatch_parallel,self).setUp()
+
+    def tearDown(self):
+        esky.patch.Patcher.workers = self.__orig_workers
+        return super(TestPatch_parallel,self).tearDown()
+
+
+class TestCommandReader(unittest.TestCase):
+    """Testcases for the buffered patch command reader."""
+
+    def _parse(self,read_vint,read):
+        """Parse a stream of commands into a list of (command,arg) pairs."""
+        cmds = []
+        while True:
+            try:
+                cmd = read_vint()
+            except EOFError:
+                return cmds
+            if cmd in (esky.patch.JOIN_PATH,esky.patch.PF_INS_RAW):
+                cmds.append((cmd,read(read_vint())))
+            elif cmd == esky.patch.PF_COPY:
+                cmds.append((cmd,read_vint()))
+            else:
+                cmds.append((cmd,None))
+
+    def test_command_reader_matches_unbuffered(self):
+        #  Use names and data of varying length and vints of varying size,
+        #  so that commands straddle buffer boundaries at every offset.
+        stream = BytesIO()
+        for i in xrange(2000):
+            esky.patch._write_vint(stream,esky.patch.JOIN_PATH)
+            name = ("file%d.py" % (i,)).encode("ascii")
+            esky.patch._write_vint(stream,len(name))
+            stream.write(name)
+            esky.patch._write_vint(stream,esky.patch.PF_COPY)
+            esky.patch._write_vint(stream,i ** 4)
+            esky.patch._write_vint(stream,esky.patch.PF_INS_RAW)
+            esky.patch._write_vint(stream,i % 300)
+            stream.write("x".encode("ascii") * (i % 300))
+            esky.patch._write_vint(stream,esky.patch.POP_PATH)
+        data = stream.getvalue()
+        f = BytesIO(data)
+        expected = self._parse(lambda: esky.patch._read_vint(f),f.read)
+        self.assertEquals(len(expected),8000)
+        for bufsize in (1,2,3,7,100,1024*64):
+            reader = esky.patch._CommandReader(BytesIO(data),bufsize=bufsize)
+            cmds = self._parse(reader.read_vint,reader.read)
+            self.assertEquals(cmds,expected)
+
+    def test_command_reader_vints_and_short_reads(self):
+        stream = BytesIO()
+        values = [0,1,127,128,300,2**20,2**40]
+        for x in values:
+            esky.patch._write_vint(stream,x)
+        stream.write("tail".encode("ascii"))
+        reader = esky.patch._CommandReader(BytesIO(stream.getvalue()),
+                                           bufsize=3)
+        self.assertEquals([reader.read_vint() for _ in values],values)
+        self.assertEquals(reader.read(10),"tail".encode("ascii"))
+        self.assertRaises(EOFError,reader.read_vint)
+
 
 class TestFilesDiffer(unittest.TestCase):
 
@@ -922,3 +1238,903 @@ class TestFilesDiffer(unittest.TestCase):
     def tearDown(self):
         really_rmtree(self.tdir)
 
+
+
+class TestVersionGraph(unittest.TestCase):
+    """Testcases for the upgrade-planning VersionGraph."""
+
+    def test_best_paths(self):
+        graph = esky.finder.VersionGraph()
+        graph.add_link("","1.3","full-1.3",100)
+        graph.add_link("1.0","1.1","patch-1.1",10)
+        graph.add_link("1.1","1.2","patch-1.2",10)
+        graph.add_link("1.2","1.3","patch-1.3",10)
+        graph.add_link("1.0","1.3","squashed-1.3",40)
+        self.assertEquals(graph.get_best_path("1.0","1.3"),
+                          ["patch-1.1","patch-1.2","patch-1.3"])
+        self.assertEquals(sorted(graph.get_versions("1.0")),
+                          ["1.1","1.2","1.3"])
+        #  Removing a link must invalidate any cached paths.
+        graph.remove_all_links("patch-1.2")
+        self.assertEquals(graph.get_best_path("1.0","1.3"),["squashed-1.3"])
+        self.assertEquals(graph.get_best_path("1.2","1.3"),["patch-1.3"])
+        graph.remove_all_links("squashed-1.3")
+        self.assertEquals(graph.get_best_path("1.0","1.3"),["full-1.3"])
+        self.assertEquals(graph.get_best_path("1.0","1.2"),None)
+        #  Returned paths are copies, not views into the cache.
+        graph.get_best_path("1.0","1.3").append("junk")
+        self.assertEquals(graph.get_best_path("1.0","1.3"),["full-1.3"])
+
+    def test_large_graph(self):
+        graph = esky.finder.VersionGraph()
+        versions = ["1.%d" % (i,) for i in xrange(600)]
+        for (i,v) in enumerate(versions):
+            graph.add_link("",v,"full-"+v,1000)
+            for j in xrange(max(0,i-20),i):
+                graph.add_link(versions[j],v,"%s-%s" % (versions[j],v),i-j+5)
+        for _ in xrange(10):
+            self.assertEquals(len(graph.get_versions("1.0")),599)
+            path = graph.get_best_path("1.0","1.599")
+        self.assertEquals(len(path),30)
+        graph.remove_all_links(path[0])
+        self.assertNotEquals(graph.get_best_path("1.0","1.599")[0],path[0])
+
+    def test_link_costs_from_file_sizes(self):
+        class FakeApp(object):
+            name = "app"
+            version = "1.0"
+            platform = "plat"
+        tdir = tempfile.mkdtemp()
+        try:
+            files = {"app-1.3.plat.zip":90000,
+                     "app-1.1.plat.from-1.0.patch":60000,
+                     "app-1.2.plat.from-1.1.patch":60000,
+                     "app-1.3.plat.from-1.2.patch":88000,
+                     "app-1.2.plat.from-1.0.patch":5000}
+            for (nm,size) in files.iteritems():
+                with open(os.path.join(tdir,nm),"wb") as f:
+                    f.write("x".encode("ascii") * size)
+            #  By size, the full download beats the three-patch chain.
+            cost = esky.finder.LinkCost(hop_cost=0)
+            finder = esky.finder.LocalVersionFinder(tdir,link_cost=cost)
+            self.assertEquals(sorted(finder.find_versions(FakeApp)),
+                              ["1.1","1.2","1.3"])
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.3"),
+                              ["app-1.3.plat.zip"])
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.2"),
+                              ["app-1.2.plat.from-1.0.patch"])
+            #  Files of unknown size keep the traditional 40:1 ratio.
+            cost = esky.finder.LinkCost()
+            self.assertEquals(cost(None,None,"1.3"),
+                              40 * cost(None,"1.2","1.3"))
+            #  A custom cost function can ignore sizes altogether.
+            def fixed_cost(size,from_version,version):
+                if from_version is None:
+                    return 40
+                return 1
+            finder = esky.finder.LocalVersionFinder(tdir,link_cost=fixed_cost)
+            finder.find_versions(FakeApp)
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.3"),
+                              ["app-1.2.plat.from-1.0.patch",
+                               "app-1.3.plat.from-1.2.patch"])
+        finally:
+            really_rmtree(tdir)
+
+    def test_listing_sizes(self):
+        apache = '<a href="app-1.3.zip">app-1.3.zip</a>  14-Mar-2010 12:00  4.2M\n'
+        nginx = '<a href="app-1.3.zip">app-1.3.zip</a>  14-Mar-2010 12:00  4423091\n'
+        table = '<tr><td><a href="app-1.3.zip">app-1.3.zip</a></td>' \
+                '<td align="right">2010-03-14 12:00  </td>' \
+                '<td align="right">150K</td></tr><tr><td><a href="x">'
+        plain = '<li><a href="app-1.3.zip">app-1.3.zip</a>\n'
+        for (listing,size) in ((apache,int(4.2*1024*1024)),(nginx,4423091),
+                               (table,150*1024),(plain,None)):
+            pos = listing.index("app-1.3.zip") + len("app-1.3.zip") + 1
+            self.assertEquals(esky.finder._listing_size(listing,pos),size)
+
+
+class TestDefaultVersionFinder(unittest.TestCase):
+    """Testcases for the update index handling of DefaultVersionFinder."""
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        tdir = self.tdir
+        class FakeApp(object):
+            name = "app"
+            version = "1.0"
+            platform = "plat"
+            appdir = tdir
+            def _get_update_dir(self):
+                return os.path.join(tdir,"updates")
+        self.app = FakeApp()
+        self.requests = []
+
+    def tearDown(self):
+        really_rmtree(self.tdir)
+
+    def _make_finder(self,**kwds):
+        """Make a finder that serves a fake index, logging each request."""
+        class FakeResponse(BytesIO):
+            url = "http://example.com/downloads/"
+            headers = {"etag":'"v1"'}
+        requests = self.requests
+        class FakeFinder(esky.finder.DefaultVersionFinder):
+            index = '<a href="app-1.1.plat.zip">app-1.1.plat.zip</a>\n'
+            def open_url(self,url,headers=None):
+                requests.append(headers)
+                if headers and headers.get("If-None-Match") == '"v1"':
+                    raise urllib2.HTTPError(url,304,"Not Modified",{},None)
+                return FakeResponse(self.index.encode("utf-8"))
+            def _parse_index(self,app,downloads):
+                self.parsed = True
+                return super(FakeFinder,self)._parse_index(app,downloads)
+        return FakeFinder("http://example.com/downloads/",**kwds)
+
+    def test_conditional_get_reuses_cached_index(self):
+        finder = self._make_finder()
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(self.requests,[None])
+        #  A new instance revalidates the cached index, without parsing.
+        finder = self._make_finder()
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(self.requests[-1],{"If-None-Match":'"v1"'})
+        self.assertFalse(getattr(finder,"parsed",False))
+
+    def test_check_interval_is_shared_between_instances(self):
+        finder = self._make_finder(check_interval=3600)
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(len(self.requests),1)
+        finder = self._make_finder(check_interval=3600)
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(len(self.requests),1)
+        finder = self._make_finder(check_interval=0)
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(len(self.requests),2)
+
+    def test_manifest_version_finder(self):
+        distdir = os.path.join(self.tdir,"dist")
+        os.mkdir(distdir)
+        files = {"app-1.1.plat.zip":"full".encode("ascii") * 1000,
+                 "app-1.1.plat.from-1.0.patch":"patch".encode("ascii") * 10,
+                 "app-1.1.other.zip":"other".encode("ascii"),
+                 "otherapp-1.1.plat.zip":"other".encode("ascii")}
+        for (nm,data) in files.iteritems():
+            with open(os.path.join(distdir,nm),"wb") as f:
+                f.write(data)
+        dist = distutils.dist.Distribution({"name":"app","version":"1.1"})
+        cmd = esky.bdist_esky.bdist_esky_manifest(dist)
+        cmd.dist_dir = distdir
+        cmd.ensure_finalized()
+        cmd.run()
+        url = "file://" + urllib.pathname2url(distdir) + "/"
+        finder = esky.finder.ManifestVersionFinder(url)
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        patch = "app-1.1.plat.from-1.0.patch"
+        self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                          [patch])
+        #  Downloads are verified against the digest in the manifest.
+        for status in finder._fetch_file_iter(self.app,patch):
+            pass
+        self.assertEquals(status["status"],"ready")
+        os.unlink(status["path"])
+        with open(os.path.join(distdir,patch),"wb") as f:
+            f.write("PATCH".encode("ascii") * 10)
+        try:
+            for status in finder._fetch_file_iter(self.app,patch):
+                pass
+        except IOError, e:
+            self.assertTrue("corrupted" in str(e))
+        else:
+            self.fail("corrupted download was not detected")
+        self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                          ["app-1.1.plat.zip"])
+
+    def test_concurrent_fetch_of_multiple_files(self):
+        active = []
+        peak = []
+        class SlowResponse(BytesIO):
+            def __init__(self,data):
+                BytesIO.__init__(self,data)
+                self.size = len(data)
+                active.append(self)
+                peak.append(len(active))
+            def read(self,size=-1):
+                time.sleep(0.05)
+                return BytesIO.read(self,size)
+            def close(self):
+                active.remove(self)
+        class SlowFinder(esky.finder.DefaultVersionFinder):
+            def open_url(self,url,headers=None):
+                if "broken" in url:
+                    raise IOError("broken download")
+                return SlowResponse(url.encode("ascii") * 1000)
+        finder = SlowFinder("http://example.com/downloads/",
+                            max_connections=2)
+        urls = ["patch%d" % (i,) for i in xrange(4)]
+        events = list(finder._fetch_files_iter(self.app,urls))
+        self.assertEquals(max(peak),2)
+        self.assertEquals(events[-1]["status"],"ready")
+        self.assertEquals([url for (_,url) in events[-1]["paths"]],urls)
+        for (path,url) in events[-1]["paths"]:
+            with open(path,"rb") as f:
+                data = (finder.download_url + url).encode("ascii")
+                self.assertEquals(f.read(),data * 1000)
+        received = [e["received"] for e in events[:-1]]
+        self.assertEquals(received,sorted(received))
+        #  A failed download removes its links and aborts the others.
+        finder.version_graph.add_link("1.0","1.1","broken",1)
+        self.assertRaises(IOError,list,
+                          finder._fetch_files_iter(self.app,["x","broken"]))
+        self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),None)
+        #  Nothing is still downloading once the error has been raised.
+        self.assertEquals(active,[])
+
+    def test_resume_interrupted_download(self):
+        data = os.urandom(256*1024)
+        requests = []
+        honour_ranges = [True]
+        class FlakyHandler(BaseHTTPRequestHandler):
+            """Serves the data, dropping each connection after 100K."""
+            def log_message(self,*args):
+                pass
+            def do_GET(self):
+                start = 0
+                requests.append(self.headers.get("Range"))
+                if honour_ranges[0] and self.headers.get("Range"):
+                    if self.headers.get("If-Range") == '"v1"':
+                        start = int(self.headers["Range"][6:-1])
+                if start:
+                    self.send_response(206)
+                    self.send_header("Content-Range","bytes %d-%d/%d"
+                                     % (start,len(data)-1,len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header("ETag",'"v1"')
+                self.send_header("Content-Length",str(len(data)-start))
+                self.end_headers()
+                self.wfile.write(data[start:start+100*1024])
+        server = HTTPServer(("localhost",0),FlakyHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            url = "http://localhost:%d/" % (server.server_address[1],)
+            finder = esky.finder.DefaultVersionFinder(url)
+            finder.version_graph.add_link("","1.1","app-1.1.plat.zip",1)
+            def fetch():
+                try:
+                    for status in finder._fetch_file_iter(self.app,
+                                                          "app-1.1.plat.zip"):
+                        pass
+                except IOError:
+                    return None
+                with open(status["path"],"rb") as f:
+                    return f.read()
+            #  Each attempt picks up where the last one left off,
+            #  and the link is kept since progress is being made.
+            self.assertEquals(fetch(),None)
+            self.assertEquals(fetch(),None)
+            self.assertEquals(fetch(),data)
+            self.assertEquals(requests,[None,"bytes=102400-","bytes=204800-"])
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                              ["app-1.1.plat.zip"])
+            #  If the server ignores ranges, we start again from scratch.
+            finder.cleanup(self.app)
+            del requests[:]
+            honour_ranges[0] = False
+            self.assertEquals(fetch(),None)
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                              ["app-1.1.plat.zip"])
+            self.assertEquals(fetch(),None)
+            self.assertEquals(requests,[None,"bytes=102400-"])
+            #  Restarting from scratch isn't progress, so the link is
+            #  removed rather than being retried forever.
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                              None)
+        finally:
+            server.shutdown()
+
+    def test_finder_can_be_pickled(self):
+        #  The esky, and hence its finder, is pickled for the cleanup process.
+        finder = esky.finder.DefaultVersionFinder("http://example.com/d/")
+        finder.version_graph.add_link("1.0","1.1","app-1.1.plat.zip",1)
+        finder._workdir(self.app,"downloads")
+        finder2 = pickle.loads(pickle.dumps(finder,pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(finder2.download_url,"http://example.com/d/")
+        self.assertEquals(finder2.version_graph.get_best_path("1.0","1.1"),
+                          ["app-1.1.plat.zip"])
+        self.assertEquals(finder2._created_workdirs,set())
+        limiter = esky.finder.IdleRateLimiter(100*1024)
+        finder = esky.finder.DefaultVersionFinder("http://example.com/d/",
+                                                  rate_limiter=limiter)
+        finder2 = pickle.loads(pickle.dumps(finder,pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(finder2.rate_limiter.rate,100*1024)
+        finder2.rate_limiter.consume(10)
+        finder = esky.finder.MirrorVersionFinder(["http://a.example.com/",
+                                                  "http://b.example.com/"])
+        finder2 = pickle.loads(pickle.dumps(finder,pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(finder2.mirrors,finder.mirrors)
+        self.assertEquals(finder2._mirror_order(),finder.mirrors)
+
+    def test_open_url_overridden_without_headers(self):
+        #  Subclasses written against the original open_url(url) signature
+        #  still work; requests that need extra headers become plain GETs.
+        opened = []
+        class OldStyleFinder(esky.finder.DefaultVersionFinder):
+            def open_url(self,url):
+                opened.append(url)
+                return BytesIO("data".encode("ascii"))
+        finder = OldStyleFinder("http://example.com/downloads/")
+        outfilenm = os.path.join(self.tdir,"app-1.1.plat.zip")
+        with open(outfilenm + ".part","wb") as f:
+            f.write("da".encode("ascii"))
+        finder._write_partinfo(outfilenm,"app-1.1.plat.zip",'"v1"')
+        (infile,offset) = finder._open_partial_download("app-1.1.plat.zip",
+                                                        outfilenm)
+        self.assertEquals(offset,0)
+        self.assertEquals(infile.read(),"data".encode("ascii"))
+        self.assertEquals(opened,
+                          ["http://example.com/downloads/app-1.1.plat.zip"])
+
+    def test_connections_are_kept_alive(self):
+        index = '<a href="app-1.1.plat.zip">app-1.1.plat.zip</a>\n'
+        files = {"/downloads/": index.encode("ascii"),
+                 "/downloads/app-1.1.plat.zip": os.urandom(100000)}
+        clients = []
+        class KeepAliveHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self,*args):
+                pass
+            def do_HEAD(self):
+                self.do_GET(body=False)
+            def do_GET(self,body=True):
+                clients.append(self.client_address)
+                if self.path == "/old/":
+                    self.send_response(301)
+                    self.send_header("Location","/downloads/")
+                    self.send_header("Content-Length","0")
+                    self.end_headers()
+                    return
+                data = files[self.path]
+                self.send_response(200)
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(data)
+        class ThreadingHTTPServer(SocketServer.ThreadingMixIn,HTTPServer):
+            daemon_threads = True
+        server = ThreadingHTTPServer(("localhost",0),KeepAliveHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            url = "http://localhost:%d/old/" % (server.server_address[1],)
+            finder = esky.finder.DefaultVersionFinder(url,probe_sizes=True)
+            self.assertEquals(finder.find_versions(self.app),["1.1"])
+            #  The redirect is followed and recorded.
+            self.assertTrue(finder.download_url.endswith("/downloads/"))
+            for status in finder._fetch_file_iter(self.app,"app-1.1.plat.zip"):
+                pass
+            with open(status["path"],"rb") as f:
+                self.assertEquals(f.read(),files["/downloads/app-1.1.plat.zip"])
+            #  Redirect, listing, size probe and download all used
+            #  a single connection.
+            self.assertEquals(len(clients),4)
+            self.assertEquals(len(set(clients)),1)
+            finder._connections.close()
+        finally:
+            server.shutdown()
+
+    def _make_version_tree(self,path,version,data,platform="plat"):
+        """Make a tree laid out like an unpacked version of the fake app."""
+        vdir = os.path.join(path,"appdata","app-%s.%s" % (version,platform))
+        os.makedirs(os.path.join(vdir,"esky-files"))
+        with open(os.path.join(vdir,"esky-files","bootstrap-manifest.txt"),"w") as f:
+            f.write("script\n")
+        with open(os.path.join(vdir,"lib.bin"),"wb") as f:
+            f.write(data)
+        with open(os.path.join(path,"script"),"wb") as f:
+            f.write(version.encode("ascii"))
+
+    def test_pipelined_patch_update(self):
+        data = os.urandom(1024*1024)
+        appdir = os.path.join(self.tdir,"app")
+        self._make_version_tree(appdir,"1.0",data)
+        target = os.path.join(self.tdir,"target")
+        self._make_version_tree(target,"1.1",data[:1000]+data[2000:]+data[:1000])
+        patch = BytesIO()
+        esky.patch.write_patch(appdir,target,patch)
+        patch = patch.getvalue()
+        self.app.appdir = appdir
+        prepared = []
+        class PatchResponse(BytesIO):
+            size = len(patch)
+            def read(self,size=-1):
+                time.sleep(0.001)
+                return BytesIO.read(self,size)
+        class PatchFinder(esky.finder.DefaultVersionFinder):
+            def open_url(self,url,headers=None):
+                return PatchResponse(patch)
+            def _prepare_version(self,app,version,path):
+                prepared.append(version)
+                super(PatchFinder,self)._prepare_version(app,version,path)
+        finder = PatchFinder("http://example.com/downloads/",pipelined=True)
+        finder.version_graph.add_link("1.0","1.1","app-1.1.plat.from-1.0.patch",1)
+        vpath = finder.fetch_version(self.app,"1.1")
+        self.assertEquals(prepared,[])
+        with open(os.path.join(vpath,"lib.bin"),"rb") as f:
+            with open(os.path.join(target,"appdata","app-1.1.plat","lib.bin"),"rb") as f2:
+                self.assertEquals(f.read(),f2.read())
+        bsdir = os.path.join(vpath,"esky-files","bootstrap")
+        with open(os.path.join(bsdir,"script"),"rb") as f:
+            self.assertEquals(f.read(),"1.1".encode("ascii"))
+        #  If the patch can't be applied on the fly, we fall back to the
+        #  usual process once it has been downloaded.
+        finder.cleanup(self.app)
+        with open(os.path.join(appdir,"appdata","app-1.0.plat","lib.bin"),"wb") as f:
+            f.write("modified".encode("ascii"))
+        self.assertRaises(esky.EskyVersionError,finder.fetch_version,self.app,"1.1")
+        self.assertEquals(prepared,["1.1"])
+
+    def test_patching_staged_version_leaves_original_intact(self):
+        data = os.urandom(1024*64)
+        appdir = os.path.join(self.tdir,"app")
+        self._make_version_tree(appdir,"1.0",data)
+        vdir = os.path.join(appdir,"appdata","app-1.0.plat")
+        target = os.path.join(self.tdir,"target")
+        self._make_version_tree(target,"1.0",data+data)
+        tvdir = os.path.join(target,"appdata","app-1.0.plat")
+        for d in (vdir,tvdir):
+            with open(os.path.join(d,"other.bin"),"wb") as f:
+                f.write(data)
+        os.chmod(os.path.join(tvdir,"other.bin"),0700)
+        patch = BytesIO()
+        esky.patch.write_patch(appdir,target,patch)
+        self.app.appdir = appdir
+        finder = esky.finder.DefaultVersionFinder("http://example.com/")
+        uppath = os.path.join(self.tdir,"unpack")
+        os.mkdir(uppath)
+        finder._copy_best_version(self.app,uppath)
+        staged = os.path.join(uppath,"appdata","app-1.0.plat")
+        self.assertFalse(files_differ(os.path.join(staged,"lib.bin"),
+                                      os.path.join(vdir,"lib.bin")))
+        #  A mode-only change to a staged file must not leak back into
+        #  the running version, even if the two are hardlinked.
+        original_mode = os.stat(os.path.join(vdir,"other.bin")).st_mode
+        modepatch = BytesIO()
+        esky.patch.write_patch(os.path.join(vdir,"other.bin"),
+                               os.path.join(tvdir,"other.bin"),modepatch)
+        modepatch.seek(0)
+        esky.patch.apply_patch(os.path.join(staged,"other.bin"),modepatch)
+        self.assertEquals(os.stat(os.path.join(staged,"other.bin")).st_mode&0777,
+                          0700)
+        self.assertEquals(os.stat(os.path.join(vdir,"other.bin")).st_mode,
+                          original_mode)
+        #  Likewise for changes to the contents of a staged file.
+        patch.seek(0)
+        esky.patch.apply_patch(uppath,patch)
+        self.assertFalse(files_differ(os.path.join(staged,"lib.bin"),
+                                      os.path.join(tvdir,"lib.bin")))
+        with open(os.path.join(vdir,"lib.bin"),"rb") as f:
+            self.assertEquals(f.read(),data)
+
+    def test_patch_base_digest_precheck(self):
+        data = os.urandom(1024*64)
+        appdir = os.path.join(self.tdir,"app")
+        self._make_version_tree(appdir,"1.0",data)
+        filelist = os.path.join(appdir,"appdata","app-1.0.plat","esky-files",
+                                esky.patch.ESKY_FILELIST)
+        with open(filelist,"w") as f:
+            json.dump(["./script","appdata/app-1.0.plat/lib.bin"],f)
+        cache = os.path.join(os.path.dirname(filelist),
+                             esky.patch.ESKY_DIGEST_CACHE)
+        target = os.path.join(self.tdir,"target")
+        self._make_version_tree(target,"1.1",data+data)
+        #  The base digest is only written on request.
+        patch = BytesIO()
+        esky.patch.write_patch(appdir,target,patch)
+        self.assertEquals(esky.patch.read_base_digest(BytesIO(patch.getvalue())),
+                          None)
+        patch = BytesIO()
+        esky.patch.write_patch(appdir,target,patch,base_digest=True)
+        patch = patch.getvalue()
+        self.assertEquals(esky.patch.read_base_digest(BytesIO(patch)),
+                          esky.patch.calculate_patch_digest(appdir,
+                                                    update_cache=False))
+        #  Diffing never writes digest caches into the trees being diffed.
+        self.assertFalse(os.path.exists(cache))
+        self.app.appdir = appdir
+        requests = []
+        class PatchFinder(esky.finder.DefaultVersionFinder):
+            def open_url(self,url,headers=None):
+                requests.append((os.path.basename(url),headers))
+                if url.endswith(".patch"):
+                    return BytesIO(patch)
+                raise urllib2.HTTPError(url,404,"Not Found",{},None)
+        finder = PatchFinder("http://example.com/downloads/",
+                             check_base_version=True)
+        finder.version_graph.add_link("1.0","1.1","app-1.1.plat.from-1.0.patch",1)
+        finder.version_graph.add_link("","1.1","app-1.1.plat.zip",10)
+        self.assertTrue(finder._check_base_version(self.app,
+                                    ["app-1.1.plat.from-1.0.patch"]))
+        self.assertFalse(os.path.exists(cache))
+        #  Once the local version has drifted, the patch is never
+        #  downloaded; we go straight to the full download instead.
+        with open(os.path.join(appdir,"script"),"wb") as f:
+            f.write("modified".encode("ascii"))
+        del requests[:]
+        self.assertRaises(esky.EskyVersionError,finder.fetch_version,self.app,"1.1")
+        self.assertEquals([nm for (nm,_) in requests],
+                          ["app-1.1.plat.from-1.0.patch","app-1.1.plat.zip"])
+        self.assertTrue("Range" in requests[0][1])
+        #  By default, no extra request is made to check the base version.
+        finder = PatchFinder("http://example.com/downloads/")
+        finder.version_graph.add_link("1.0","1.1","app-1.1.plat.from-1.0.patch",1)
+        del requests[:]
+        self.assertRaises(esky.EskyVersionError,finder.fetch_version,self.app,"1.1")
+        self.assertEquals(requests,[("app-1.1.plat.from-1.0.patch",None)])
+
+    def test_chunk_version_finder(self):
+        platform = get_platform()
+        self.app.platform = platform
+        data = os.urandom(1024*1024)
+        newdata = data[:500000] + os.urandom(1000) + data[501000:]
+        distdir = os.path.join(self.tdir,"dist")
+        os.mkdir(distdir)
+        appdir = os.path.join(self.tdir,"app")
+        for (version,libdata) in (("1.0",data),("1.1",newdata)):
+            vtree = os.path.join(self.tdir,"build-"+version)
+            self._make_version_tree(vtree,version,libdata,platform)
+            if version == "1.0":
+                shutil.copytree(vtree,appdir)
+            else:
+                with open(os.path.join(vtree,"new.txt"),"w") as f:
+                    f.write("new file")
+            vdir = "app-%s.%s" % (version,platform)
+            create_zipfile(vtree,os.path.join(distdir,vdir+".zip"))
+            dist = distutils.dist.Distribution({"name":"app","version":version})
+            cmd = esky.bdist_esky.bdist_esky_chunks(dist)
+            cmd.dist_dir = distdir
+            cmd.ensure_finalized()
+            cmd.run()
+        #  Only chunks that are new in 1.1 are added to the store.
+        pack = "app-1.1.%s.chunks" % (platform,)
+        self.assertTrue(os.path.getsize(os.path.join(distdir,pack)) < 1024*100)
+        self.app.appdir = appdir
+        ranges = []
+        scans = []
+        class ChunkFinder(esky.finder.ChunkVersionFinder):
+            def _find_local_content(self,app,index):
+                scans.append(index["vdir"])
+                sup = super(ChunkFinder,self)
+                return sup._find_local_content(app,index)
+            def open_url(self,url,headers=None):
+                nm = url.rsplit("/",1)[-1]
+                if not nm:
+                    index = "".join('<a href="%s">%s</a>\n' % (nm,nm)
+                                    for nm in os.listdir(distdir))
+                    return BytesIO(index.encode("ascii"))
+                with open(os.path.join(distdir,nm),"rb") as f:
+                    content = f.read()
+                response = BytesIO(content)
+                if headers and "Range" in headers:
+                    (start,end) = headers["Range"][6:].split("-")
+                    ranges.append((nm,int(start),int(end)))
+                    response = BytesIO(content[int(start):int(end)+1])
+                    response.code = 206
+                response.size = len(response.getvalue())
+                return response
+        finder = ChunkFinder("http://example.com/downloads/")
+        self.assertEquals(finder.find_versions(self.app),["1.1"])
+        self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                          ["app-1.1.%s.chunks.json" % (platform,)])
+        costs = finder.version_graph._links[""]["1.1"]
+        self.assertTrue(costs["app-1.1.%s.chunks.json" % (platform,)] <
+                        costs["app-1.1.%s.zip" % (platform,)])
+        vpath = finder.fetch_version(self.app,"1.1")
+        #  The local files are only scanned once.
+        self.assertEquals(len(scans),1)
+        with open(os.path.join(vpath,"lib.bin"),"rb") as f:
+            self.assertEquals(f.read(),newdata)
+        bsdir = os.path.join(vpath,"esky-files","bootstrap")
+        with open(os.path.join(bsdir,"script"),"rb") as f:
+            self.assertEquals(f.read(),"1.1".encode("ascii"))
+        with open(os.path.join(bsdir,"new.txt"),"rb") as f:
+            self.assertEquals(f.read(),"new file".encode("ascii"))
+        #  Only the changed content was downloaded, in a single request.
+        self.assertEquals([nm for (nm,_,_) in ranges],[pack])
+        self.assertTrue(sum(end+1-start for (_,start,end) in ranges) < 1024*100)
+
+    def test_chunk_index_paths_are_checked(self):
+        url = "app-1.1.plat.chunks.json"
+        indexfile = os.path.join(self.tdir,url)
+        finder = esky.finder.ChunkVersionFinder("http://example.com/downloads/")
+        for path in ("../evil","/tmp/evil","appdata/../../evil","a//evil",
+                     "a\\..\\..\\evil"):
+            for (files,dirs) in (([path],[]),([],[path])):
+                finder.version_graph.add_link("",  "1.1",url,1)
+                index = {"format":1,"vdir":"app-1.1.plat","chunk_size":1,
+                         "files":[{"path":nm,"mode":0644,"size":0,
+                                   "md5":hashlib.md5().hexdigest(),
+                                   "chunks":[]} for nm in files],
+                         "dirs":dirs,"chunks":{}}
+                with open(indexfile,"w") as f:
+                    json.dump(index,f)
+                self.assertRaises(IOError,finder._load_chunk_index,
+                                  indexfile,url)
+                self.assertFalse(os.path.exists(indexfile))
+                self.assertEquals(finder.version_graph.get_versions("1.0"),[])
+        self.assertRaises(esky.patch.PatchError,esky.finder._join_index_path,
+                          self.tdir,"../evil")
+
+    def test_shared_download_cache(self):
+        cache = esky.finder.DownloadCache(os.path.join(self.tdir,"cache"),
+                                          max_size=3000)
+        content = "update".encode("ascii") * 100
+        requests = []
+        class CountingFinder(esky.finder.DefaultVersionFinder):
+            def open_url(self,url,headers=None):
+                requests.append(url)
+                response = BytesIO(content)
+                response.size = len(content)
+                return response
+        url = "app-1.1.plat.from-1.0.patch"
+        #  Two installs of the app, e.g. for different users.
+        for (i,expected) in ((1,[url]),(2,[])):
+            tdir = os.path.join(self.tdir,"user%d" % (i,))
+            os.mkdir(tdir)
+            class FakeApp(object):
+                def _get_update_dir(self):
+                    return os.path.join(tdir,"updates")
+            app = FakeApp()
+            app.appdir = tdir
+            del requests[:]
+            finder = CountingFinder("http://example.com/downloads/",
+                                    download_cache=cache)
+            finder._add_links([("1.0","1.1",url,len(content),
+                                hashlib.md5(content).hexdigest())])
+            for status in finder._fetch_file_iter(app,url):
+                pass
+            self.assertEquals([r.rsplit("/",1)[-1] for r in requests],expected)
+            with open(status["path"],"rb") as f:
+                self.assertEquals(f.read(),content)
+        #  Files whose digest isn't in the index can't be verified, so
+        #  they're neither read from nor added to the cache.
+        os.unlink(status["path"])
+        del requests[:]
+        finder = CountingFinder("http://example.com/downloads/",
+                                download_cache=cache)
+        for status in finder._fetch_file_iter(app,url):
+            pass
+        self.assertEquals([r.rsplit("/",1)[-1] for r in requests],[url])
+        self.assertEquals(finder._download_cache_key(url),None)
+        #  Least recently used entries are evicted once it's too big.
+        entry = cache._entry_name("md5:" + hashlib.md5(content).hexdigest())
+        source = os.path.join(self.tdir,"source")
+        for i in xrange(5):
+            with open(source,"wb") as f:
+                f.write(content)
+            os.utime(entry,(time.time()-100+i,time.time()-100+i))
+            cache.put("url:%d" % (i,),source)
+        self.assertFalse(os.path.exists(entry))
+        self.assertTrue(os.path.exists(cache._entry_name("url:4")))
+        self.assertTrue(cache.get("url:4",os.path.join(self.tdir,"out")))
+
+    def test_rate_limited_download(self):
+        data = os.urandom(200*1024)
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self,*args):
+                pass
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        server = HTTPServer(("localhost",0),Handler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        try:
+            url = "http://localhost:%d/" % (server.server_address[1],)
+            limiter = esky.finder.RateLimiter(400*1024,burst=16*1024)
+            finder = esky.finder.DefaultVersionFinder(url,rate_limiter=limiter)
+            start = time.time()
+            for status in finder._fetch_file_iter(self.app,"app-1.1.plat.zip"):
+                pass
+            elapsed = time.time() - start
+            with open(status["path"],"rb") as f:
+                self.assertEquals(f.read(),data)
+            #  That's (200KB - 16KB burst) at 400KB/s.
+            self.assertTrue(elapsed >= 0.4)
+            #  The limit can be lifted while running.
+            os.unlink(status["path"])
+            limiter.set_rate(None)
+            start = time.time()
+            for status in finder._fetch_file_iter(self.app,"app-1.1.plat.zip"):
+                pass
+            self.assertTrue(time.time() - start < 0.4)
+            finder._connections.close()
+        finally:
+            server.shutdown()
+
+    def test_idle_rate_limiter_backs_off(self):
+        limiter = esky.finder.IdleRateLimiter(1000,min_rate=100)
+        self.assertEquals(limiter.rate,1000)
+        #  Falling well short of the limit means other traffic is busy.
+        limiter._adjust(500)
+        self.assertEquals(limiter.rate,500)
+        for _ in xrange(3):
+            limiter._adjust(10)
+        self.assertEquals(limiter.rate,100)
+        #  Once we can keep up with the limit again it's slowly raised.
+        limiter._adjust(100)
+        self.assertEquals(limiter.rate,200)
+        for _ in xrange(20):
+            limiter._adjust(limiter.rate)
+        self.assertEquals(limiter.rate,1000)
+
+    def test_download_digest_checkpoint(self):
+        data = os.urandom(256*1024)
+        lengths = [len(data)]
+        class FlakyHandler(BaseHTTPRequestHandler):
+            """Serves the data, dropping each connection after 100K."""
+            def log_message(self,*args):
+                pass
+            def do_GET(self):
+                start = 0
+                if self.headers.get("Range"):
+                    start = int(self.headers["Range"][6:-1])
+                    self.send_response(206)
+                    self.send_header("Content-Range","bytes %d-%d/%d"
+                                     % (start,len(data)-1,len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header("ETag",'"v1"')
+                self.send_header("Content-Length",str(lengths[0]-start))
+                self.end_headers()
+                self.wfile.write(data[start:start+100*1024])
+        server = HTTPServer(("localhost",0),FlakyHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        hashed = []
+        class CountingMD5(object):
+            def __init__(self,hasher=None):
+                self._hasher = hasher or hashlib.md5()
+            def update(self,data):
+                hashed.append(len(data))
+                self._hasher.update(data)
+            def copy(self):
+                return CountingMD5(self._hasher.copy())
+            def hexdigest(self):
+                return self._hasher.hexdigest()
+        class counting_hashlib(object):
+            md5 = CountingMD5
+        try:
+            url = "http://localhost:%d/" % (server.server_address[1],)
+            finder = esky.finder.DefaultVersionFinder(url)
+            md5 = hashlib.md5(data).hexdigest()
+            finder._add_links([(None,"1.1","app-1.1.plat.zip",len(data),md5)])
+            def fetch():
+                try:
+                    for status in finder._fetch_file_iter(self.app,
+                                                          "app-1.1.plat.zip"):
+                        pass
+                except IOError:
+                    return None
+                with open(status["path"],"rb") as f:
+                    return f.read()
+            #  Resumed downloads carry on from the checkpointed digest,
+            #  rather than hashing the data already downloaded again.
+            esky.finder.hashlib = counting_hashlib
+            try:
+                self.assertEquals(fetch(),None)
+                self.assertEquals(fetch(),None)
+                self.assertEquals(fetch(),data)
+            finally:
+                esky.finder.hashlib = hashlib
+            self.assertEquals(sum(hashed),len(data))
+            #  A download of the wrong size is rejected before reading it.
+            finder.cleanup(self.app)
+            lengths[0] += 1
+            self.assertEquals(fetch(),None)
+            partfile = finder._download_name(self.app,"app-1.1.plat.zip")
+            self.assertFalse(os.path.exists(partfile + ".part"))
+            self.assertEquals(finder.version_graph.get_best_path("1.0","1.1"),
+                              None)
+        finally:
+            server.shutdown()
+
+    def test_mirror_failover(self):
+        data = os.urandom(256*1024)
+        index = '<a href="app-1.1.plat.zip">app-1.1.plat.zip</a>\n'
+        requests = []
+        def make_handler(name,delay,truncate):
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self,*args):
+                    pass
+                def do_HEAD(self):
+                    requests.append((name,"HEAD",None))
+                    time.sleep(delay)
+                    self.send_response(200)
+                    self.send_header("Content-Length",str(len(index)))
+                    self.end_headers()
+                def do_GET(self):
+                    byte_range = self.headers.get("Range")
+                    requests.append((name,self.path,byte_range))
+                    if self.path == "/missing.zip":
+                        self.send_error(404)
+                        return
+                    if self.path == "/":
+                        body = index
+                        self.send_response(200)
+                    else:
+                        start = 0
+                        if byte_range:
+                            start = int(byte_range[6:-1])
+                        body = data[start:]
+                        if start:
+                            self.send_response(206)
+                            self.send_header("Content-Range","bytes %d-%d/%d"
+                                             % (start,len(data)-1,len(data)))
+                        else:
+                            self.send_response(200)
+                    self.send_header("Content-Length",str(len(body)))
+                    self.end_headers()
+                    if truncate:
+                        body = body[:truncate]
+                    self.wfile.write(body)
+            return Handler
+        servers = []
+        mirrors = []
+        try:
+            for (name,delay,truncate) in (("good",0.2,None),
+                                          ("flaky",0,100*1024)):
+                server = HTTPServer(("localhost",0),
+                                    make_handler(name,delay,truncate))
+                server_thread = threading.Thread(target=server.serve_forever)
+                server_thread.daemon = True
+                server_thread.start()
+                servers.append(server)
+                mirrors.append("http://localhost:%d/"
+                               % (server.server_address[1],))
+            (good,flaky) = mirrors
+            #  Find a port with nothing listening on it.
+            s = socket.socket()
+            s.bind(("localhost",0))
+            dead = "http://localhost:%d/" % (s.getsockname()[1],)
+            s.close()
+            mirrors = [dead,good,flaky]
+            #  The index is fetched from the fastest mirror, and the download
+            #  continues from the next one when that fails part-way through.
+            finder = esky.finder.MirrorVersionFinder(mirrors)
+            self.assertEquals(finder.find_versions(self.app),["1.1"])
+            self.assertEquals(finder.download_url,flaky)
+            for status in finder._fetch_file_iter(self.app,"app-1.1.plat.zip"):
+                pass
+            with open(status["path"],"rb") as f:
+                self.assertEquals(f.read(),data)
+            self.assertEquals([r for r in requests if r[1] != "HEAD"],
+                              [("flaky","/",None),
+                               ("flaky","/app-1.1.plat.zip",None),
+                               ("good","/app-1.1.plat.zip","bytes=102400-")])
+            #  Later runs skip the failed mirrors without trying them.
+            del requests[:]
+            finder = esky.finder.MirrorVersionFinder(mirrors)
+            self.assertEquals(finder.find_versions(self.app),["1.1"])
+            self.assertEquals(finder.download_url,good)
+            self.assertEquals(requests,[("good","HEAD",None),
+                                        ("good","/",None)])
+            #  A file missing from a mirror doesn't make it a bad mirror.
+            self.assertRaises(urllib2.HTTPError,list,
+                              finder._fetch_file_iter(self.app,"missing.zip"))
+            healthfile = os.path.join(self.app._get_update_dir(),
+                                      "index","mirrors.json")
+            with open(healthfile,"r") as f:
+                health = json.load(f)
+            self.assertTrue("failed" in health[dead])
+            self.assertTrue("failed" in health[flaky])
+            self.assertFalse("failed" in health[good])
+        finally:
+            for server in servers:
+                server.shutdown()
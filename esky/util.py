@@ -570,6 +570,61 @@ def really_rmtree(path):
             shutil.rmtree(path)
 
 
+#  ioctl request number for cloning a file's extents on linux (FICLONE).
+_FICLONE = 0x40049409
+
+def clone_file(source,target,hardlink=True):
+    """Like shutil.copy2, but share the underlying storage where possible.
+
+    On filesystems that support it (e.g. btrfs, xfs) the target is created
+    as a reflink of the source, so no data is copied until one of them
+    is modified.  Failing that the target is hardlinked to the source if
+    "hardlink" is true, and as a last resort the data is copied.
+
+    A hardlinked target shares its inode with the source, so it must never
+    be modified in place; write a new file and rename it over the target.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            import fcntl
+        except ImportError:
+            pass
+        else:
+            with open(source,"rb") as fsrc:
+                with open(target,"wb") as fdst:
+                    try:
+                        fcntl.ioctl(fdst.fileno(),_FICLONE,fsrc.fileno())
+                    except (EnvironmentError,ValueError):
+                        cloned = False
+                    else:
+                        cloned = True
+            if cloned:
+                shutil.copystat(source,target)
+                return
+            os.unlink(target)
+    if hardlink and hasattr(os,"link") and not os.path.islink(source):
+        try:
+            os.link(source,target)
+        except EnvironmentError:
+            pass
+        else:
+            return
+    shutil.copy2(source,target)
+
+
+def clone_tree(source,target,hardlink=True):
+    """Like shutil.copytree, but using clone_file() to copy each file."""
+    os.mkdir(target)
+    for nm in os.listdir(source):
+        srcpath = os.path.join(source,nm)
+        dstpath = os.path.join(target,nm)
+        if os.path.isdir(srcpath):
+            clone_tree(srcpath,dstpath,hardlink)
+        else:
+            clone_file(srcpath,dstpath,hardlink)
+    shutil.copystat(source,target)
+
+
 def compile_to_bytecode(source_code, compile_filename=None):
     """Given source_code, return its compiled bytecode."""
     if sys.version_info[:2] < (3, 1):